@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+_API = {'mirror': 'pymirror.api', 'options': 'pymirror.api',
+        'Result': 'pymirror.results', 'Results': 'pymirror.results'}
+
+
+def __getattr__(name: str):
+    # `from pymirror import mirror` without importing the uploaders every
+    # time a submodule is imported.
+    if name in _API:
+        import importlib
+        globals()[name] = getattr(importlib.import_module(_API[name]), name)
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+from pathlib import Path
+from typing import AsyncIterator, Union
+
+from pymirror import tracing
+from pymirror.api_upload import APIUpload
+from pymirror.archive import ArchiveStream, write_archive
+from pymirror.catalogue import Catalogue
+from pymirror.cli import expand_inputs, parser
+from pymirror.deadline import CEILING, Deadline, HostStats
+from pymirror.handlers import firefoxInterrupt
+from pymirror.helpers import load_data
+from pymirror.journal import Journal
+from pymirror.registry import registry
+from pymirror.results import Result, Results
+from pymirror.scheduler import LinkBudget, Slots, TokenBucket, link_budget
+from pymirror.verify import verify
+
+CANCEL_TIMEOUT = 30
+
+
+def options(**kwargs) -> argparse.Namespace:
+    # The command line defaults with `kwargs` applied, so library callers
+    # never build an `argparse.Namespace` themselves. `input` is one path
+    # or a list, expanded like on the command line.
+    args = parser().parse_args([])
+    for k, v in kwargs.items():
+        if not hasattr(args, k):
+            raise TypeError(f'Unknown option: {k}')
+        setattr(args, k, v)
+    if args.input:
+        paths = args.input
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        args.inputs = expand_inputs([str(p) for p in paths])
+        if not args.inputs:
+            raise FileNotFoundError(f'No input matches {paths}')
+        args.input = args.inputs[0]
+    return args
+
+
+class Pipeline:
+    # One run over `args.inputs`: the API uploads and the browser-based
+    # providers as concurrent stages. The drivers and temporary archives it
+    # creates belong to this run and are released when it ends or is
+    # cancelled through `results`. A `pool` or `stats` passed in are shared
+    # with other runs and left as they are.
+
+    def __init__(self,
+                 args: argparse.Namespace,
+                 results: Results,
+                 journal: Journal = None,
+                 servers: list = None,
+                 data: dict = None,
+                 stats: HostStats = None,
+                 pool=None,
+                 bucket: TokenBucket = None,
+                 slots: Slots = None) -> None:
+        self.args = args
+        self.results = results
+        self.journal = journal
+        self.data = registry(data or load_data())
+        if servers is not None:
+            self.data = self.data.subset(servers)
+        self.stats = stats
+        self.pool = pool
+        # The bandwidth bucket and slots of a process that runs several
+        # pipelines at once, so they share the uplink instead of each
+        # pacing itself to all of it.
+        self.bucket = bucket
+        self.slots = slots
+        self._owns_pool = pool is None
+
+    def archive(self,
+                path: str,
+                servers: list = None) -> Union[str, ArchiveStream]:
+        codec = getattr(self.args, 'codec', 'gzip')
+        stream = ArchiveStream(path, codec)
+        # Stream the archive straight into the uploads when every host that
+        # would receive it accepts chunked bodies; browser-based providers
+        # need a real file.
+        if servers is not None and not self.args.more_links:
+            api = APIUpload(self.data, self.args)
+            size = stream.estimate / 1e+6
+            chosen = [k for k in servers if api.fits(k, stream.name, size)]
+            if chosen and all(api.accepts_stream(k) for k in chosen):
+                return stream
+        return write_archive(path, codec)
+
+    def _browser_stages(self, file: str, budget: LinkBudget) -> list:
+        # The browser-based providers pull in selenium; API-only runs never
+        # import them.
+        from pymirror.experimental.more_links import MoreLinks
+        from pymirror.mirroredto import Mirroredto
+        from pymirror.multiup import MultiUp
+        args = argparse.Namespace(**{**vars(self.args), 'input': file})
+        stages = [('mirroredto',
+                   Mirroredto(args, budget, self.results, self.pool).upload),
+                  ('multiup', MultiUp(args, budget, self.results).upload)]
+        if self.args.experimental:
+            stages.append(('morelinks',
+                           MoreLinks(args, self.pool, budget,
+                                     self.results).upload_to_all_))
+        return stages
+
+    def _run_stage(self, name: str, stage, file: str) -> list:
+        links = []
+        start = time.time()
+        try:
+            with tracing.span('stage', server=name), \
+                    Deadline(CEILING, name) as deadline, \
+                    self.results.cancelling(deadline.cancel):
+                results = stage()
+        except Exception as e:
+            self.results.emit(file, name, 'error',
+                              duration=time.time() - start, error=repr(e))
+            raise
+        # Mirroredto returns one list per batch.
+        for x in results or []:
+            if isinstance(x, list):
+                links += x
+            elif x:
+                links.append(x)
+        if self.journal is not None:
+            self.journal.record(file, name, 'ok', links)
+        return links
+
+    def _done(self, file: str, server: str) -> bool:
+        return self.journal is not None and self.journal.done(file, server)
+
+    def run(self) -> None:
+        servers = APIUpload(self.data, self.args).servers()
+        files = {}
+        for path in self.args.inputs:
+            if not Path(path).exists():
+                raise FileNotFoundError(
+                    f'{path}: If you are sure the path is correct, rename '
+                    'the file removing any illegal characters, then try '
+                    'again.')
+            if Path(path).is_dir():
+                files[path] = self.archive(path, servers)
+            else:
+                files[path] = path
+        try:
+            self._run(files)
+        finally:
+            for path, file in files.items():
+                if isinstance(file, str) and file != path:
+                    os.remove(file)
+
+    def _run(self, files: dict) -> None:
+        if self.args.more_links and self._owns_pool:
+            # Firefox starts up while the API uploads run.
+            from pymirror.start_driver import DriverPool
+            self.pool = DriverPool(self.args.browsers)
+            self.pool.warm()
+        owned = self.pool if self._owns_pool else None
+
+        budget = link_budget(self.args)
+        for file, links in self.results.links_by_file.items():
+            # Links recovered from an interrupted run count as well.
+            budget.settle(file, 0, len(links))
+
+        catalogue = None if self.args.no_cache else Catalogue()
+        api = APIUpload(self.data,
+                        self.args,
+                        catalogue,
+                        stats=self.stats,
+                        journal=self.journal,
+                        budget=budget,
+                        results=self.results)
+        api.bucket, api.slots = self.bucket, self.slots
+        # The API uploads and the browser-based providers run as concurrent
+        # stages. The API jobs take their share of the budget first; the
+        # other stages get what is left, or what failed uploads give back.
+        try:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                stages = [
+                    executor.submit(api.api_uploads, None,
+                                    list(files.values()))
+                ]
+                api.planned.wait()
+                if self.args.more_links:
+                    for file in files.values():
+                        for name, stage in self._browser_stages(file,
+                                                                budget):
+                            if not self._done(file, name):
+                                stages.append(
+                                    executor.submit(self._run_stage, name,
+                                                    stage, file))
+                if owned is not None:
+                    with self.results.cancelling(owned.terminate):
+                        concurrent.futures.wait(stages)
+                for future in concurrent.futures.as_completed(stages):
+                    future.result()
+            if (getattr(self.args, 'verify', False)
+                    and not self.results.cancelled.is_set()):
+                # Streamed archives have no local copy to compare with.
+                local = {
+                    str(f): f if isinstance(f, str) else None
+                    for f in files.values()
+                }
+                verify(self.results, local, data=self.data)
+        finally:
+            if catalogue is not None:
+                catalogue.close()
+            if owned is not None:
+                owned.close()
+                if self.results.cancelled.is_set():
+                    firefoxInterrupt(owned.pids)
+
+
+async def stream(args: argparse.Namespace,
+                 results: Results = None,
+                 servers: list = None,
+                 journal: Journal = None,
+                 data: dict = None,
+                 stats: HostStats = None,
+                 pool=None,
+                 bucket: TokenBucket = None,
+                 slots: Slots = None) -> AsyncIterator[Result]:
+    # Runs a pipeline in a thread of its own and yields its results as they
+    # happen. Closing or cancelling the iteration cancels the run: running
+    # uploads are stopped, curl processes killed and browsers quit.
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+    done = object()
+    results = results or Results()
+
+    def push(result: Result) -> None:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, result)
+        except RuntimeError:
+            # The event loop is gone; nobody is listening any more.
+            pass
+
+    results.listener = push
+    pipeline = Pipeline(args, results, journal, servers, data, stats, pool,
+                        bucket, slots)
+    future = concurrent.futures.Future()
+
+    def run() -> None:
+        try:
+            future.set_result(pipeline.run())
+        except BaseException as e:  # noqa
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    work = asyncio.wrap_future(future)
+    work.add_done_callback(lambda _: queue.put_nowait(done))
+    try:
+        while True:
+            result = await queue.get()
+            if result is done:
+                break
+            yield result
+        await work
+    finally:
+        if not work.done():
+            results.cancel()
+            await asyncio.wait([work], timeout=CANCEL_TIMEOUT)
+
+
+async def mirror(path: Union[str, os.PathLike, list],
+                 servers: list = None,
+                 limit: int = None,
+                 journal: Journal = None,
+                 **kwargs) -> AsyncIterator[Result]:
+    # Mirrors the file(s) or folder(s) at `path` and yields a `Result` for
+    # every link and every failed upload as soon as it happens:
+    #
+    #     async for result in mirror('foo.txt', limit=5):
+    #         print(result.server, result.link)
+    #
+    # `servers` restricts the API uploads to these keys of
+    # `servers_data.json` and `limit` is the number of links to stop at.
+    # Other keyword arguments are the command line options by their long
+    # name (e.g. `more_links=True`, `workers=4`). Each call has state of
+    # its own, so calls can run side by side.
+    args = options(input=path, number=limit, **kwargs)
+    async for result in stream(args, servers=servers, journal=journal):
+        yield result
@@ -2,21 +2,27 @@
 # coding: utf-8
 
 import argparse
-import json
-import mimetypes
-import platform
+import concurrent.futures
 import shlex
-import signal
-import statistics
-import subprocess
+import threading
 import time
 from pathlib import Path
-from typing import Optional, Generator
-
-from dracula import DraculaPalette as Dp
+from typing import Mapping, Optional, Union
 
+from pymirror import tracing
+from pymirror.archive import ArchiveStream
+from pymirror.catalogue import Catalogue, file_hash
+from pymirror.deadline import Deadline, DeadlineExceeded, HostStats
+from pymirror.fanout import FanOut, Reader, SharedFiles
+from pymirror.config import upload_speed
 from pymirror.handlers import custom_error_traceback
-from pymirror.helpers import Shared, logger, console
+from pymirror.helpers import logger
+from pymirror.journal import Journal
+from pymirror.registry import registry
+from pymirror.results import Results
+from pymirror.scheduler import (SMALL_JOB, LinkBudget, Slots, TokenBucket,
+                                capacity, concurrency, link_budget)
+from pymirror.transport import CurlTransport, TransportError, get_transport
 
 
 class Error(Exception):
@@ -25,117 +31,321 @@ class Error(Exception):
 
 class APIUpload:
 
-    def __init__(self, data: dict, args: argparse.Namespace) -> None:
-        self.data = data
+    def __init__(self,
+                 data: Mapping,
+                 args: argparse.Namespace,
+                 catalogue: Catalogue = None,
+                 stats: HostStats = None,
+                 journal: Journal = None,
+                 budget: LinkBudget = None,
+                 results: Results = None) -> None:
+        self.data = registry(data)
         self.args = args
+        self.catalogue = catalogue
+        self.stats = stats
+        self.journal = journal
+        self.budget = budget or link_budget(args)
+        self.results = results or Results()
+        # Set once the jobs are chosen and their link budget is taken.
+        self.planned = threading.Event()
+        # How long each (input, server) upload took, in seconds.
+        self.durations = {}
+        # The hosts each input can go to and its size, worked out once
+        # before any upload starts.
+        self._eligible = {}
+        self._sizes = {}
+        self.bucket = None
+        self.slots = None
+        # MB/s each large transfer can count on while the others run.
+        self.share = None
+        self.transport = getattr(args, 'transport', 'native')
 
-    @staticmethod
-    def ping(ip: str) -> bool:
-
-        def _ping(flag: str, _ip: str) -> int:
-            out = subprocess.Popen(shlex.split(f'ping {flag} 1 {_ip}'),
-                                   stdout=subprocess.PIPE,
-                                   shell=False)
-            out.communicate()
-            return out.returncode
-
-        if platform.system() == 'Windows':
-            response = _ping('-n', ip[0])
-        else:
-            response = _ping('-c', ip[0])
-        if response in [0, 256, 512]:
-            console.print(
-                f'[[{Dp.g}] OK [/{Dp.g}]] [{Dp.c}]{ip[1]}[/{Dp.c}] is online!')
-            logger.info(f'{ip[1]} is online!')
-            return True
-        console.print(
-            f'[[{Dp.r}] ERROR! [/{Dp.r}]] [{Dp.c}]{ip[1]}[/{Dp.c}] is '
-            'down!')
-        logger.warning(f'{ip[1]} is offline!')
-        return False
-
-    def curl(self, server: str) -> Optional[str]:
-
-        def find_value(key: str, d: dict) -> Generator[str, None, None]:
-            for k, v in (d.items() if type(d) is dict else
-                         enumerate(d) if type(d) is list else []):
-                if k == key:
-                    yield v
-                if type(v) in [dict, list]:
-                    for value in find_value(key, v):
-                        yield value
-
-        if server in ['midi']:
-            mimetypes.init()
-            mime = mimetypes.guess_type(self.args.input)[0]
-            if mime is not None:
-                mime = mime.split('/')[0]
-                if mime in ['audio', 'video', 'image']:
-                    pass
-                else:
-                    return
+    def eligible_servers(self, file: Union[str, ArchiveStream]) -> tuple:
+        if file not in self._eligible:
+            if isinstance(file, ArchiveStream):
+                servers = tuple(
+                    k for k in self.data.eligible(file.name,
+                                                  self.size_of(file))
+                    if self.accepts_stream(k))
+            else:
+                servers = self.data.eligible(file, self.size_of(file))
+            self._eligible[file] = servers
+        return self._eligible[file]
+
+    def eligible(self, server: str, file: Union[str, ArchiveStream]) -> bool:
+        return server in self.eligible_servers(file)
+
+    def fits(self, server: str, name: str, file_size: float) -> bool:
+        return server in self.data.eligible(name, file_size)
+
+    def accepts_stream(self, server: str) -> bool:
+        # Only hosts known to accept chunked request bodies can take an
+        # archive that is still being compressed.
+        return (self.transport != 'curl' and self.data[server].chunked
+                and self.data[server].spec is not None)
 
-        file_size = Path(self.args.input).stat().st_size / 1e+6
-        size_limit = self.data[server]['limit']
-        if file_size > size_limit:
+    def curl(self,
+             server: str,
+             source: FanOut = None,
+             file: Union[str, ArchiveStream] = None) -> Optional[str]:
+        file = file or self.args.input
+        if not self.eligible(server, file):
             return
-        srv = self.data[server]['server']
-        keys = self.data[server]['keys']
-        flags = self.data[server]['flags']
-        parameter = self.data[server]['parameter']
-        curl = f'curl {flags} "{parameter}{self.args.input}" {srv}'
-        curl = shlex.split(curl)
+        entry = self.data[server]
+        srv = entry.url
+        flags = entry.flags
+        parameter = entry.parameter
+        spec = entry.spec
         try:
-            out = subprocess.run(curl, stdout=subprocess.PIPE, check=True)
-        except subprocess.CalledProcessError:
+            if isinstance(file, ArchiveStream):
+                out = get_transport().upload(srv,
+                                             file.name,
+                                             source=source,
+                                             bucket=self.bucket,
+                                             **spec)
+            elif spec is None or self.transport == 'curl':
+                out = CurlTransport.run(
+                    shlex.split(f'curl {flags} "{parameter}{file}" {srv}'))
+            else:
+                out = get_transport().upload(srv,
+                                             file,
+                                             source=source,
+                                             bucket=self.bucket,
+                                             **spec)
+        except TransportError:
             return
-        try:
-            link = json.loads(out.stdout)
-        except json.decoder.JSONDecodeError:
-            link = out.stdout.decode('UTF-8').strip('\n')
-        if keys:
-            link = list(find_value(keys[-1], link))
-            if link:
-                link = link[0]
-        if server == 'oshi':
-            link = link.split('\n')[1].replace('DL: ', '')
-        return link
+        with tracing.span('parse'):
+            return entry.extract(out)
 
-    def api_uploads(self, responses: list = None) -> Optional[list]:
-        times = []
-        api_uploads_links = []
+    def servers(self, responses: list = None) -> list:
         if responses is None:
             responses = [True] * len(self.data)
-        for n, ((k, _), res) in enumerate(zip(self.data.items(), responses)):
+        servers = []
+        for n, (k, res) in enumerate(zip(self.data, responses)):
             if self.args.number and n == int(self.args.number):
                 break
             if self.args.debug and n == 1:
                 break
             if res is False:
                 continue
+            servers.append(k)
+        return servers
+
+    def schedule(self, files: list, servers: list) -> list:
+        # Diagonal order: each round pairs every file with a different
+        # server, so hosts are spread out and only a few files are in
+        # flight at any time.
+        # Within a file, hosts expected to finish first go first, so small
+        # transfers are out of the way before the big ones share the uplink.
+        jobs = []
+        for fi, file in enumerate(files):
+            allowed = self.eligible_servers(file)
+            eligible = [k for k in servers if k in allowed]
+            if self.stats is not None:
+                eligible.sort(key=lambda k: self.stats.deadline(
+                    k, self.size_of(file), self.max_bandwidth(), floor=0))
+            jobs += [(fi + r, fi, file, k) for r, k in enumerate(eligible)]
+        return [(file, k) for _, _, file, k in sorted(jobs)]
+
+    def size_of(self, file: Union[str, ArchiveStream]) -> float:
+        if file not in self._sizes:
+            if isinstance(file, ArchiveStream):
+                self._sizes[file] = file.estimate / 1e+6
+            else:
+                self._sizes[file] = Path(file).stat().st_size / 1e+6
+        return self._sizes[file]
+
+    def _job(self,
+             sources: SharedFiles,
+             file: Union[str, ArchiveStream],
+             server: str,
+             reader: Reader = None) -> Optional[str]:
+        size = self.size_of(file)
+        # Large transfers wait for one of the bandwidth slots; small ones
+        # (and streams, whose readers must all run together) never do.
+        slot = None
+        if reader is None and size >= SMALL_JOB:
+            slot = self.slots
+        try:
+            if slot is not None:
+                with tracing.span('queued', server=server):
+                    slot.acquire()
+            if self.results.cancelled.is_set():
+                return
+            seconds = self.stats.deadline(server, size, self.share)
+            start = time.time()
             try:
-                signal.signal(signal.SIGALRM, lambda x, y: 1 / 0)
-                start = time.time()
-                if len(times) > 2:
-                    signal.alarm(int(statistics.mean(times)) + 5)
-                link = self.curl(k)
-                if not link:
-                    continue
-                if ('bad gateway' in link.lower() or 'error' in link.lower()
+                with tracing.span('job', server=server, file=str(file)), \
+                        Deadline(seconds, server) as deadline, \
+                        self.results.cancelling(deadline.cancel):
+                    link = self.curl(server, reader or sources.acquire(file),
+                                     file)
+            finally:
+                self.durations[(str(file), server)] = time.time() - start
+            if link:
+                self.stats.record(server, size, time.time() - start)
+            return link
+        finally:
+            if slot is not None:
+                slot.release()
+            if reader is not None:
+                reader.close()
+            sources.release(file)
+
+    def _emit(self, file: Union[str, ArchiveStream], server: str, link: str,
+              links: list) -> None:
+        links.append(link)
+        self._record(file, server, 'ok', link)
+
+    def _record(self,
+                file: Union[str, ArchiveStream],
+                server: str,
+                status: str,
+                link: str = None,
+                error: str = None) -> None:
+        if self.journal is not None:
+            self.journal.record(file, server, status, [link] if link else [],
+                                error)
+        self.results.emit(file, server, status, link,
+                          round(self.size_of(file) * 1e+6),
+                          self.durations.get((str(file), server)), error)
+
+    def _cached(self, jobs: list, links: list) -> list:
+        # Reuse still-valid links from the catalogue and return the jobs
+        # that actually need an upload.
+        known = {}
+        remaining = []
+        for file, k in jobs:
+            if isinstance(file, ArchiveStream):
+                remaining.append((file, k))
+                continue
+            if file not in known:
+                digest = self.catalogue.fingerprint(file)
+                known[file] = self.catalogue.links(digest) if digest else {}
+            if k in known[file]:
+                self._emit(file, k, known[file][k], links)
+                self.budget.settle(str(file), 0, 1)
+            else:
+                remaining.append((file, k))
+        return remaining
+
+    def _remember(self, uploaded: list, digests: dict) -> None:
+        hashes = {}
+        for file, k, link in uploaded:
+            if file not in hashes:
+                hashes[file] = (digests.get(file)
+                                or self.catalogue.fingerprint(file)
+                                or file_hash(file))
+                self.catalogue.remember(file, hashes[file])
+            expires = self.data[k].expires
+            if expires == 0:
+                continue
+            self.catalogue.record(hashes[file], k, link,
+                                  None if expires is None else expires * 3600)
+
+    def plan(self, responses: list, files: list, links: list) -> list:
+        try:
+            if self.stats is None:
+                self.stats = HostStats()
+            servers = self.servers(responses)
+            jobs = self.schedule(files, servers)
+            if self.journal is not None:
+                # Jobs that finished before an interrupted run was resumed.
+                jobs = [(f, k) for f, k in jobs
+                        if not self.journal.done(f, k)]
+            if self.catalogue is not None:
+                jobs = self._cached(jobs, links)
+            return [(f, k) for f, k in jobs if self.budget.take(str(f))]
+        finally:
+            self.planned.set()
+
+    def max_bandwidth(self) -> Optional[float]:
+        return getattr(self.args, 'max_bandwidth', None)
+
+    def uplink(self) -> Optional[float]:
+        # A cap on the bandwidth spares the speed test.
+        cap = self.max_bandwidth()
+        return capacity(None if cap else upload_speed(), cap)
+
+    def _result(self, future: concurrent.futures.Future,
+                file: Union[str, ArchiveStream], k: str) -> Optional[str]:
+        try:
+            link = future.result()
+        except DeadlineExceeded as e:
+            if self.args.log:
+                logger.error(f'{k} Timed out!')
+            self._record(file, k, 'timeout', error=str(e))
+            return
+        except Exception as e:  # noqa
+            custom_error_traceback(e,
+                                   f'[ ERROR! ] Error in {k}...',
+                                   log=self.args.log)
+            self._record(file, k, 'error', error=repr(e))
+            return
+        if not link or ('bad gateway' in link.lower()
+                        or 'error' in link.lower()
                         or 'https://' not in link.lower()):
+            self._record(file, k, 'failed', error=link or None)
+            return
+        return link
+
+    def api_uploads(self,
+                    responses: list = None,
+                    files: list = None) -> Optional[list]:
+        api_uploads_links = []
+        if files is None:
+            files = getattr(self.args, 'inputs', None) or [self.args.input]
+        jobs = self.plan(responses, files, api_uploads_links)
+        if not jobs:
+            return api_uploads_links
+        servers = sorted({k for _, k in jobs})
+
+        counts = {}
+        for file, _ in jobs:
+            counts[file] = counts.get(file, 0) + 1
+        streamed = [(f, k) for f, k in jobs if isinstance(f, ArchiveStream)]
+        uplink = self.uplink()
+        if uplink and self.bucket is None:
+            self.bucket = TokenBucket(uplink * 1e+6, burst=uplink * 1e+6 / 4)
+        workers = getattr(self.args, 'workers', None)
+        if self.slots is None:
+            self.slots = Slots(
+                int(workers) if workers else
+                concurrency([self.stats.measured(k) for k in servers],
+                            uplink) or 1)
+        if self.bucket is not None:
+            # Every slot and every stream draws on the same bucket, so a
+            # deadline allows for the share of the uplink a transfer gets,
+            # not the whole of it.
+            self.share = self.bucket.rate / 1e+6 / (self.slots.size +
+                                                    len(streamed))
+        workers = min(int(workers or len(servers)), len(jobs))
+        uploaded = []
+        # Every reader of a stream must be running at once (the stream
+        # cannot be rewound), so streamed jobs get a pool of their own.
+        with SharedFiles(counts) as sources, \
+                concurrent.futures.ThreadPoolExecutor(workers) as executor, \
+                concurrent.futures.ThreadPoolExecutor(
+                    max(len(streamed), 1)) as stream_executor:
+            futures = {}
+            for file, k in jobs:
+                if isinstance(file, ArchiveStream):
+                    reader = sources.acquire(file).reader()
+                    future = stream_executor.submit(self._job, sources, file,
+                                                    k, reader)
+                else:
+                    future = executor.submit(self._job, sources, file, k)
+                futures[future] = (file, k)
+            for future in concurrent.futures.as_completed(futures):
+                file, k = futures[future]
+                link = self._result(future, file, k)
+                self.budget.settle(str(file), 1, 1 if link else 0)
+                if not link:
                     continue
-                console.print(f'[[{Dp.g}] OK [/{Dp.g}]]', link)
-                Shared.all_links.append(link)
-                api_uploads_links.append(link)
-                logger.info(f'[ OK ] {link}')
-                times.append(time.time() - start)
-            except ZeroDivisionError:
-                if self.args.log:
-                    logger.error(f'{k} Timed out!')
-            except Error as e:
-                custom_error_traceback(e,
-                                       f'[ ERROR! ] Error in {k}...',
-                                       log=self.args.log)
-            finally:
-                signal.alarm(0)
+                self._emit(file, k, link, api_uploads_links)
+                if not isinstance(file, ArchiveStream):
+                    uploaded.append((file, k, link))
+        self.stats.save()
+        if self.catalogue is not None and uploaded:
+            self._remember(uploaded, sources.digests)
         return api_uploads_links
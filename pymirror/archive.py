@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import collections
+import concurrent.futures
+import os
+import queue
+import tarfile
+import threading
+import zlib
+from pathlib import Path
+from typing import Iterator
+
+from pymirror.fanout import FanOut
+
+BLOCK_SIZE = 1 << 20
+SUFFIXES = {'gzip': '.tar.gz', 'zstd': '.tar.zst'}
+
+
+class _Pipe:
+
+    def __init__(self, q: queue.Queue, stop: threading.Event) -> None:
+        self.q = q
+        self.stop = stop
+
+    def put(self, item: object) -> bool:
+        # False once the consumer went away, instead of blocking on a full
+        # queue nobody reads any more.
+        while not self.stop.is_set():
+            try:
+                self.q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, b: bytes) -> int:
+        if not self.put(bytes(b)):
+            raise BrokenPipeError('Archive consumer went away')
+        return len(b)
+
+
+def tar_blocks(path: str) -> Iterator[bytes]:
+    q = queue.Queue(maxsize=8)
+    stop = threading.Event()
+
+    pipe = _Pipe(q, stop)
+
+    def produce():
+        try:
+            with tarfile.open(fileobj=pipe, mode='w|',
+                              bufsize=BLOCK_SIZE) as t:
+                t.add(path, arcname=Path(path).name)
+            pipe.put(None)
+        except BaseException as e:  # noqa
+            pipe.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _gzip_member(block: bytes, level: int) -> bytes:
+    # zlib releases the GIL while deflating, so blocks compress in parallel.
+    # Each block becomes its own gzip member; concatenated members are a
+    # valid gzip stream.
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(block) + c.flush()
+
+
+def _rebuffer(blocks: Iterator[bytes], size: int) -> Iterator[bytes]:
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def gzip_blocks(blocks: Iterator[bytes],
+                level: int = 6,
+                workers: int = None) -> Iterator[bytes]:
+    workers = workers or os.cpu_count() or 1
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for block in _rebuffer(blocks, BLOCK_SIZE):
+            pending.append(executor.submit(_gzip_member, block, level))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def zstd_blocks(blocks: Iterator[bytes], level: int = 3) -> Iterator[bytes]:
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('The zstd codec requires the `zstandard` package: '
+                        'pip install zstandard')
+    cobj = zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+    for block in blocks:
+        out = cobj.compress(block)
+        if out:
+            yield out
+    yield cobj.flush()
+
+
+def archive_blocks(path: str, codec: str = 'gzip') -> Iterator[bytes]:
+    if codec == 'zstd':
+        return zstd_blocks(tar_blocks(path))
+    return gzip_blocks(tar_blocks(path))
+
+
+def archive_name(path: str, codec: str = 'gzip') -> str:
+    return f'{Path(path).parent}/{Path(path).name}{SUFFIXES[codec]}'
+
+
+def write_archive(path: str, codec: str = 'gzip') -> str:
+    out_file = archive_name(path, codec)
+    with open(out_file, 'wb') as f:
+        for block in archive_blocks(path, codec):
+            f.write(block)
+    return out_file
+
+
+class ArchiveStream:
+    # A directory that is archived on the fly while it is being uploaded,
+    # without a temporary file. Its size is unknown until the stream ends,
+    # so `estimate` (the uncompressed size) is used for host size limits.
+
+    def __init__(self, path: str, codec: str = 'gzip') -> None:
+        self.path = path
+        self.codec = codec
+        self.name = Path(archive_name(path, codec)).name
+        self.estimate = sum(p.stat().st_size for p in Path(path).rglob('*')
+                            if p.is_file())
+        self._fanout = None
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return archive_name(self.path, self.codec)
+
+    def fanout(self) -> FanOut:
+        with self._lock:
+            if self._fanout is None:
+                blocks = archive_blocks(self.path, self.codec)
+                self._fanout = FanOut(lambda: next(blocks, b''))
+            return self._fanout
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import http.server
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+import psutil
+from rich.table import Table
+
+from pymirror import tracing
+from pymirror.api_upload import APIUpload
+from pymirror.deadline import HostStats
+from pymirror.helpers import console
+
+SIZES = [0.1, 1, 10]
+CONCURRENCY = [1, 4, 12]
+READ_SIZE = 64 * 1024
+RSS_POLL = 0.02
+
+
+def servers_data() -> dict:
+    # The server list shipped with this version of pymirror, not the copy
+    # in the config folder.
+    with open(Path(__file__).parent / 'data' / 'servers_data.json') as j:
+        return json.load(j)
+
+
+def response(entry: dict, link: str) -> bytes:
+    # What the real host answers with: the link nested under the `keys`
+    # path, oshi's text listing, or the bare link.
+    if urlsplit(entry['server']).netloc == 'oshi.at':
+        return (f'MANAGE: {link}/manage\nDL: {link}\n').encode()
+    if not entry['keys']:
+        return f'{link}\n'.encode()
+    value = link
+    for key in reversed(entry['keys']):
+        if isinstance(key, int):
+            value = [{}] * key + [value]
+        else:
+            value = {key: value}
+    return json.dumps({'status': 'ok', **value} if isinstance(value, dict)
+                      else value).encode()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # Imitates the upload API of the host named by the first part of the
+    # path, e.g. `/gofile/uploadFile`.
+
+    protocol_version = 'HTTP/1.1'
+
+    def _read(self) -> int:
+        # Reads (and discards) the body, no faster than the configured
+        # bandwidth of the server.
+        rate = self.server.bandwidth
+        start = time.perf_counter()
+        received = 0
+
+        def pace(n: int) -> None:
+            nonlocal received
+            received += n
+            if rate:
+                lag = start + received / (rate * 1e+6) - time.perf_counter()
+                if lag > 0:
+                    time.sleep(lag)
+
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return received
+                while size:
+                    n = len(self.rfile.read(min(size, READ_SIZE)))
+                    size -= n
+                    pace(n)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            n = len(self.rfile.read(min(remaining, READ_SIZE)))
+            if not n:
+                break
+            remaining -= n
+            pace(n)
+        return received
+
+    def _upload(self) -> None:
+        name = self.path.strip('/').split('/')[0]
+        entry = self.server.data.get(name)
+        self._read()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if entry is None:
+            status, out = 404, b'Not Found'
+        elif self.server.fail():
+            status, out = 502, b'502 Bad Gateway'
+        else:
+            host = urlsplit(entry['server']).netloc
+            link = f'https://{host}/{self.server.token()}'
+            status, out = 200, response(entry, link)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_POST = do_PUT = _upload
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class StandIns(http.server.ThreadingHTTPServer):
+    # Local stand-ins for every host in `data`, with a fixed latency (in
+    # seconds) before each answer, a per-connection bandwidth limit (in
+    # MB/s) and a share of uploads that fail with a 502.
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self,
+                 data: dict,
+                 latency: float = 0,
+                 bandwidth: Optional[float] = None,
+                 failure_rate: float = 0,
+                 seed: int = 0) -> None:
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.data = data
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def token(self) -> str:
+        with self._lock:
+            self._count += 1
+            return f'{self._count:06d}'
+
+    def routed(self) -> dict:
+        # `data` with every host pointed at its stand-in.
+        url = f'http://127.0.0.1:{self.server_port}'
+        routed = {}
+        for k, v in self.data.items():
+            path = urlsplit(v['server']).path
+            routed[k] = {**v, 'server': f'{url}/{k}{path}'}
+        return routed
+
+    def __enter__(self) -> 'StandIns':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class BenchUpload(APIUpload):
+    # The stand-ins are on the loopback interface, so the measured upload
+    # speed of this machine does not apply; only `--max-bandwidth` does.
+
+    def uplink(self) -> Optional[float]:
+        return getattr(self.args, 'max_bandwidth', None)
+
+
+class PeakRSS:
+    # Highest resident set size of this process while the block runs.
+
+    def __init__(self) -> None:
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            if self._stop.wait(RSS_POLL):
+                return
+
+    def __enter__(self) -> 'PeakRSS':
+        self.peak = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values: list, p: float) -> float:
+    # Nearest-rank percentile; 0 for no values.
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1,
+                             math.ceil(p / 100 * len(values)) - 1))]
+
+
+def make_file(folder: str, size: float) -> str:
+    path = f'{folder}/bench-{size:g}MB.bin'
+    remaining = int(size * 1e+6)
+    with open(path, 'wb') as f:
+        while remaining:
+            block = os.urandom(min(remaining, 1024 * 1024))
+            f.write(block)
+            remaining -= len(block)
+    return path
+
+
+def run(data: dict,
+        files: list,
+        workers: int,
+        transport: str = 'native',
+        max_bandwidth: Optional[float] = None) -> dict:
+    # One `api_uploads` run of `files` against the stand-ins in `data`.
+    args = argparse.Namespace(input=files[0],
+                              inputs=files,
+                              number=None,
+                              debug=False,
+                              log=False,
+                              workers=workers,
+                              transport=transport,
+                              max_bandwidth=max_bandwidth)
+    tracer = tracing.enable()
+    quiet = console.quiet
+    console.quiet = True
+    try:
+        # Every run starts without measured hosts, like a first run.
+        with tempfile.TemporaryDirectory() as folder, PeakRSS() as rss:
+            stats = HostStats(f'{folder}/host_stats.json')
+            start = time.perf_counter()
+            links = BenchUpload(data, args, stats=stats).api_uploads()
+            seconds = time.perf_counter() - start
+    finally:
+        console.quiet = quiet
+        tracing.disable()
+    jobs = [s for s in tracer.spans if s['name'] == 'job']
+    latencies = [s['duration'] for s in jobs]
+    size = sum(os.path.getsize(s['attrs']['file']) for s in jobs) / 1e+6
+    return {
+        'files': len(links),
+        'failed': len(jobs) - len(links),
+        'seconds': seconds,
+        'files_per_second': len(links) / seconds,
+        'mb_per_second': size / seconds,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'peak_rss': rss.peak / 1e+6
+    }
+
+
+def bench(sizes: list = None,
+          concurrency: list = None,
+          count: int = 1,
+          servers: list = None,
+          latency: float = 0,
+          bandwidth: Optional[float] = None,
+          failure_rate: float = 0,
+          transport: str = 'native',
+          max_bandwidth: Optional[float] = None,
+          seed: int = 0) -> list:
+    # Every combination of file size (MB) and number of workers, `count`
+    # files per run.
+    data = servers_data()
+    if servers:
+        data = {k: v for k, v in data.items() if k in servers}
+    results = []
+    with tempfile.TemporaryDirectory() as folder, \
+            StandIns(data, latency, bandwidth, failure_rate, seed) as httpd:
+        routed = httpd.routed()
+        for size in sizes or SIZES:
+            path = make_file(folder, size)
+            files = [path]
+            for n in range(1, count):
+                files.append(f'{path[:-4]}-{n}.bin')
+                os.link(path, files[-1])
+            for workers in concurrency or CONCURRENCY:
+                result = run(routed, files, workers, transport, max_bandwidth)
+                results.append({'size': size, 'workers': workers, **result})
+            for file in files:
+                os.remove(file)
+    return results
+
+
+def table(results: list) -> Table:
+    table = Table(title='api_uploads benchmark')
+    columns = ['Size (MB)', 'Workers', 'Files', 'Failed', 'Files/s', 'MB/s',
+               'p50 (s)', 'p99 (s)', 'Peak RSS (MB)']
+    for column in columns:
+        table.add_column(column, justify='right')
+    for r in results:
+        table.add_row(f'{r["size"]:g}', str(r['workers']), str(r['files']),
+                      str(r['failed']), f'{r["files_per_second"]:.2f}',
+                      f'{r["mb_per_second"]:.2f}', f'{r["p50"]:.3f}',
+                      f'{r["p99"]:.3f}', f'{r["peak_rss"]:.1f}')
+    return table
+
+
+def cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m pymirror.bench',
+        description='Benchmark API uploads against local stand-in servers')
+    parser.add_argument('-s',
+                        '--sizes',
+                        help='File sizes in MB (default: %(default)s)',
+                        type=float,
+                        nargs='+',
+                        default=SIZES)
+    parser.add_argument('-w',
+                        '--workers',
+                        help='Concurrency levels (default: %(default)s)',
+                        type=int,
+                        nargs='+',
+                        default=CONCURRENCY)
+    parser.add_argument('-n',
+                        '--count',
+                        help='Files per run (default: %(default)s)',
+                        type=int,
+                        default=1)
+    parser.add_argument('-S',
+                        '--servers',
+                        help='Only imitate these servers (default: all)',
+                        nargs='+')
+    parser.add_argument('-L',
+                        '--latency',
+                        help='Seconds each server takes to answer once the '
+                        'file is received (default: %(default)s)',
+                        type=float,
+                        default=0)
+    parser.add_argument('-B',
+                        '--bandwidth',
+                        help='Per-upload bandwidth of each server in MB/s '
+                        '(default: unlimited)',
+                        type=float)
+    parser.add_argument('-f',
+                        '--failure-rate',
+                        help='Share of uploads answered with a 502 '
+                        '(default: %(default)s)',
+                        type=float,
+                        default=0)
+    parser.add_argument('-t',
+                        '--transport',
+                        help='HTTP transport (default: %(default)s)',
+                        choices=['native', 'curl'],
+                        default='native')
+    parser.add_argument('-b',
+                        '--max-bandwidth',
+                        help='Upper limit for the total upload rate in MB/s '
+                        '(default: unlimited)',
+                        type=float)
+    parser.add_argument('-o',
+                        '--output',
+                        help='Also write the results to this JSON file')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = cli()
+    results = bench(args.sizes, args.workers, args.count, args.servers,
+                    args.latency, args.bandwidth, args.failure_rate,
+                    args.transport, args.max_bandwidth)
+    console.print(table(results))
+    if args.output:
+        with open(args.output, 'w') as j:
+            json.dump(results, j, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from pymirror.config import config
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    hash TEXT NOT NULL,
+    server TEXT NOT NULL,
+    link TEXT NOT NULL,
+    uploaded REAL NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS uploads_hash_server
+    ON uploads (hash, server, uploaded);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watched (
+    hash TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    want INTEGER NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checks (
+    link TEXT PRIMARY KEY,
+    checked REAL NOT NULL,
+    status TEXT NOT NULL,
+    failures INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS checks_checked ON checks (checked);
+'''
+
+
+def file_hash(file: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Catalogue:
+
+    def __init__(self, path: str = None) -> None:
+        if path is None:
+            path = f'{config()["project_path"]}/catalogue.sqlite'
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    @staticmethod
+    def _stat(file: str) -> tuple:
+        st = Path(file).stat()
+        return str(Path(file).resolve()), st.st_size, st.st_mtime_ns
+
+    def fingerprint(self, file: str) -> Optional[str]:
+        # The hash of a file we have seen before, as long as its size and
+        # modification time have not changed; nothing is read from it.
+        path, size, mtime_ns = self._stat(file)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT hash FROM fingerprints '
+                'WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def remember(self, file: str, digest: str) -> None:
+        path, size, mtime_ns = self._stat(file)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)',
+                (path, size, mtime_ns, digest))
+
+    def links(self, digest: str, now: float = None) -> dict:
+        # Links that have not expired and were not found dead.
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT server, uploads.link FROM uploads '
+                'LEFT JOIN checks ON checks.link = uploads.link '
+                'WHERE hash = ? AND (expires IS NULL OR expires > ?) '
+                'AND checks.status IS NOT ? ORDER BY uploaded',
+                (digest, now, 'dead')).fetchall()
+        return dict(rows)
+
+    def record(self,
+               digest: str,
+               server: str,
+               link: str,
+               expires_in: Optional[float] = None) -> None:
+        now = time.time()
+        expires = None if expires_in is None else now + expires_in
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO uploads VALUES (?, ?, ?, ?, ?)',
+                             (digest, server, link, now, expires))
+
+    def watch(self, digest: str, path: str, want: int) -> None:
+        # Keep at least `want` live links to the file with this hash.
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO watched VALUES (?, ?, ?, ?)',
+                (digest, str(Path(path).resolve()), want, time.time()))
+
+    def unwatch(self, path: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM watched WHERE path = ?',
+                             (str(Path(path).resolve()), ))
+
+    def watched(self) -> list:
+        # (hash, path, want) of every watched file.
+        with self._lock:
+            return self._db.execute(
+                'SELECT hash, path, want FROM watched ORDER BY added'
+            ).fetchall()
+
+    def due(self, before: float, limit: int, now: float = None) -> list:
+        # (server, link, failures) of the live links of watched files that
+        # were never checked or not since `before`, oldest check first.
+        # Expired links are not worth a request.
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._db.execute(
+                'SELECT server, uploads.link, COALESCE(failures, 0) '
+                'FROM uploads JOIN watched ON watched.hash = uploads.hash '
+                'LEFT JOIN checks ON checks.link = uploads.link '
+                'WHERE (expires IS NULL OR expires > ?) '
+                'AND (checks.link IS NULL OR (checks.status != ? '
+                'AND checked <= ?)) '
+                'ORDER BY COALESCE(checked, 0) LIMIT ?',
+                (now, 'dead', before, limit)).fetchall()
+
+    def mark(self, checks: list, now: float = None) -> None:
+        # Records (link, status, failures, error) of a batch of checks.
+        now = time.time() if now is None else now
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?)',
+                [(link, now, status, failures, error)
+                 for link, status, failures, error in checks])
+
+    def close(self) -> None:
+        self._db.close()
@@ -2,6 +2,8 @@
 # coding: utf-8
 
 import argparse
+import glob
+from pathlib import Path
 
 from pymirror.__version__ import __version__
 
@@ -23,7 +25,23 @@ def fmt(prog):
     return CustomHelpFormatter(prog)
 
 
-def cli() -> argparse.Namespace:
+def expand_inputs(inputs: list) -> list:
+    files = []
+    for item in inputs:
+        if item.startswith('@') and Path(item[1:]).is_file():
+            with open(item[1:]) as f:
+                paths = [ln.strip() for ln in f if ln.strip()]
+        elif glob.has_magic(item):
+            paths = sorted(glob.glob(item, recursive=True))
+        else:
+            paths = [item]
+        for path in paths:
+            if path not in files:
+                files.append(path)
+    return files
+
+
+def parser() -> argparse.ArgumentParser:
     # noinspection PyTypeChecker
     parser = argparse.ArgumentParser(prog='pymirror',
                                      formatter_class=fmt,
@@ -33,14 +51,18 @@ def cli() -> argparse.Namespace:
                         action='help',
                         default=argparse.SUPPRESS,
                         help='Show this help message and exit')
-    parser.add_argument('-i',
-                        '--input',
-                        help='Path to the input file/folder',
-                        required=True)
+    parser.add_argument(
+        '-i',
+        '--input',
+        help='Path(s) to the input files/folders, glob patterns, or '
+        '@file_list.txt',
+        nargs='+')
     parser.add_argument('-s',
                         '--style',
-                        help='Output style (default: lines)',
-                        choices=['lines', 'list', 'markdown', 'reddit'],
+                        help='Output style; `ndjson` streams one JSON record '
+                        'per link or failure as it happens (default: lines)',
+                        choices=['lines', 'list', 'markdown', 'reddit',
+                                 'ndjson'],
                         default='lines')
     parser.add_argument('-m',
                         '--more-links',
@@ -52,6 +74,50 @@ def cli() -> argparse.Namespace:
         '--number',
         help='Select a specific number of servers to use (default: max)',
         default=None)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Maximum number of concurrent uploads (default: max)',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '-B',
+        '--browsers',
+        help='Maximum number of Firefox instances running at once with '
+        '`--more-links` (default: 2)',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '-b',
+        '--max-bandwidth',
+        help='Upper limit for the total upload rate in MB/s (default: the '
+        'measured upload speed)',
+        type=float,
+        default=None)
+    parser.add_argument(
+        '-t',
+        '--transport',
+        help='HTTP transport for API uploads (default: native)',
+        choices=['native', 'curl'],
+        default='native')
+    parser.add_argument(
+        '-z',
+        '--codec',
+        help='Compression used when the input is a folder (default: gzip)',
+        choices=['gzip', 'zstd'],
+        default='gzip')
+    parser.add_argument('-N',
+                        '--no-cache',
+                        help='Upload again even if a still-valid link for '
+                        'the same file exists',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-r',
+                        '--resume',
+                        help='Resume the last interrupted run, skipping the '
+                        'uploads that already finished',
+                        action='store_true',
+                        default=False)
     parser.add_argument('-d',
                         '--delete',
                         help='Delete the file after the process is complete',
@@ -60,7 +126,19 @@ def cli() -> argparse.Namespace:
     parser.add_argument('-c',
                         '--check-status',
                         help='Check the status of the remote servers',
-                        action='store_false',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-V',
+                        '--verify',
+                        help='Check every link with a small ranged download '
+                        'compared with the start of the file',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-P',
+                        '--profile',
+                        help='Time every phase of every upload and write a '
+                        'trace and metrics to the config folder',
+                        action='store_true',
                         default=False)
     parser.add_argument('-D',
                         '--debug',
@@ -81,4 +159,20 @@ def cli() -> argparse.Namespace:
                         '--version',
                         action='version',
                         version=f'%(prog)s {__version__}')
-    return parser.parse_args()
+    return parser
+
+
+def cli(argv: list = None,
+        parser_: argparse.ArgumentParser = None) -> argparse.Namespace:
+    parser_ = parser_ or parser()
+    args = parser_.parse_args(argv)
+    if args.resume:
+        # The inputs and options come from the interrupted run.
+        return args
+    if not args.input:
+        parser_.error('the following arguments are required: -i/--input')
+    args.inputs = expand_inputs(args.input)
+    if not args.inputs:
+        parser_.error(f'no input matches {" ".join(args.input)}')
+    args.input = args.inputs[0]
+    return args
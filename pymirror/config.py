@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import functools
 import json
-import requests
 import sys
+import threading
 from pathlib import Path
-
-import speedtest
+from typing import Optional
 
 
+@functools.lru_cache(maxsize=None)
 def config():
     home = Path.home()
     CONFIG_DIR = f'{home}/.pymirror/.config'
     if not Path(CONFIG_DIR).exists() or '--refresh-config' in sys.argv:
-        print('Configuring pymirror...')
+        # Not on stdout, which may carry an NDJSON stream.
+        print('Configuring pymirror...', file=sys.stderr)
         Path(f'{CONFIG_DIR}/.addons').mkdir(exist_ok=True, parents=True)
         Path(f'{CONFIG_DIR}/data').mkdir(exist_ok=True, parents=True)
 
@@ -23,12 +25,14 @@ def config():
             'data_path': f'{CONFIG_DIR}/data',
             'log_file': f'{CONFIG_DIR}/pymirror.log',
             'win_gecko': None,
-            'upload_speed': speedtest.Speedtest().upload() / 8e+6
+            # Measured on first use, see `upload_speed()`.
+            'upload_speed': None
         }
 
         with open(f'{CONFIG_DIR}/.config', 'w') as j:
             json.dump(cfg, j, indent=4)
 
+        import requests
         with open(f'{CONFIG_DIR}/data/more_links.json', 'w') as j:
             r = requests.get(
                 'https://raw.githubusercontent.com/Alyetama/pymirror/main/pymirror/data/more_links.json'
@@ -45,3 +49,31 @@ def config():
         with open(f'{CONFIG_DIR}/.config') as j:
             cfg = json.load(j)
     return cfg
+
+
+_speed_lock = threading.Lock()
+_speed_failed = False
+
+
+def upload_speed() -> Optional[float]:
+    # Upload speed in MB/s. The speed test takes a while, so it only runs
+    # when something needs the number and it was never measured; if it
+    # fails (e.g. offline), the run goes on without it and it is tried again
+    # by the next one.
+    global _speed_failed
+    cfg = config()
+    with _speed_lock:
+        if cfg.get('upload_speed') is None and not _speed_failed:
+            print('Measuring the upload speed...', file=sys.stderr)
+            try:
+                import speedtest
+                speed = speedtest.Speedtest().upload() / 8e+6
+            except Exception as e:  # noqa
+                print(f'The speed test failed: {e!r}', file=sys.stderr)
+                _speed_failed = True
+            else:
+                cfg['upload_speed'] = speed
+                with open(f'{cfg["project_path"]}/.config', 'w') as j:
+                    json.dump(cfg, j, indent=4)
+    speed = cfg.get('upload_speed')
+    return float(speed) if speed else None
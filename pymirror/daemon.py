@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from pymirror.api import options, stream
+from pymirror.cli import cli, fmt, parser
+from pymirror.config import config, upload_speed
+from pymirror.deadline import HostStats
+from pymirror.health import probe_all
+from pymirror.registry import registry
+from pymirror.helpers import console, load_data, logger
+from pymirror.results import Result, Results, ndjson
+from pymirror.scheduler import Slots, TokenBucket, capacity, concurrency
+
+STATUS_TTL = 300
+# Options of `pymirror submit` that are not job options.
+CLIENT_ARGS = ['inputs', 'socket', 'port']
+
+
+def default_socket() -> str:
+    return f'{config()["project_path"]}/pymirror.sock'
+
+
+def daemon_token(path: str = None) -> str:
+    # The secret a client sends with every job, so that other local users
+    # cannot have the daemon upload files only its user can read. It is
+    # made on first use, readable by its owner only.
+    path = path or f'{config()["project_path"]}/daemon.token'
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path) as f:
+            return f.read().strip()
+    with os.fdopen(fd, 'w') as f:
+        token = secrets.token_hex(32)
+        f.write(token)
+    return token
+
+
+async def _send(writer: asyncio.StreamWriter, message: dict) -> None:
+    writer.write((json.dumps(message) + '\n').encode())
+    await writer.drain()
+
+
+class Daemon:
+    # Runs the jobs sent by `pymirror submit` in one long-lived process, so
+    # the imports, configuration, HTTP connections, host statistics, server
+    # probes and (with `--more-links`) started browsers are shared by all
+    # of them. Each job is one JSON line with its options; its results are
+    # sent back as JSON lines as they happen, followed by an `end` line.
+
+    def __init__(self,
+                 more_links: bool = False,
+                 browsers: int = None,
+                 data: dict = None,
+                 token: str = None,
+                 max_bandwidth: float = None) -> None:
+        self.data = registry(data or load_data())
+        self.token = token or daemon_token()
+        self.stats = HostStats()
+        # Every job shares one uplink: one bandwidth bucket and one set of
+        # slots for all of them, as a single run would have.
+        uplink = capacity(None if max_bandwidth else upload_speed(),
+                          max_bandwidth)
+        self.bucket = None
+        if uplink:
+            self.bucket = TokenBucket(uplink * 1e+6, burst=uplink * 1e+6 / 4)
+        self.slots = Slots(
+            concurrency([self.stats.measured(k) for k in self.data], uplink)
+            or 1)
+        self.pool = None
+        if more_links:
+            from pymirror.start_driver import POOL_SIZE, DriverPool
+            self.pool = DriverPool(browsers or POOL_SIZE)
+            self.pool.warm()
+        self.jobs = 0
+        self._status = None
+        self._status_lock = None
+
+    async def servers(self) -> list:
+        # Host probes are reused for `STATUS_TTL` seconds.
+        async with self._status_lock:
+            if (self._status is None
+                    or time.monotonic() - self._status[0] > STATUS_TTL):
+                results = await probe_all(self.data)
+                self._status = (time.monotonic(),
+                                [r['server'] for r in results if r['ok']])
+            return self._status[1]
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        self.jobs += 1
+        job = self.jobs
+        try:
+            try:
+                request = json.loads(await reader.readline())
+                if not hmac.compare_digest(str(request.get('token', '')),
+                                           self.token):
+                    logger.warning(f'Job {job}: refused, wrong token')
+                    await _send(writer, {
+                        'type': 'error',
+                        'error': 'Wrong or missing daemon token'
+                    })
+                    return
+                args = options(**request['args'])
+            except (ValueError, KeyError, TypeError, AttributeError,
+                    FileNotFoundError) as e:
+                await _send(writer, {'type': 'error', 'error': str(e)})
+                return
+            logger.info(f'Job {job}: {" ".join(args.inputs)}')
+            servers = await self.servers() if args.check_status else None
+            try:
+                await self._run(args, servers, reader, writer)
+            except (ConnectionError, asyncio.CancelledError):
+                logger.info(f'Job {job}: cancelled')
+                raise
+            except Exception as e:  # noqa
+                await _send(writer, {'type': 'error', 'error': repr(e)})
+                return
+            await _send(writer, {'type': 'end'})
+            logger.info(f'Job {job}: done')
+        finally:
+            writer.close()
+
+    async def _run(self, args: argparse.Namespace, servers: Optional[list],
+                   reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter) -> None:
+        # A client that hangs up cancels its job, even while no result is
+        # on its way.
+        results = stream(args, Results(), servers, data=self.data,
+                         stats=self.stats, pool=self.pool,
+                         bucket=self.bucket, slots=self.slots)
+        gone = asyncio.ensure_future(reader.read())
+        try:
+            while True:
+                step = asyncio.ensure_future(results.__anext__())
+                await asyncio.wait([step, gone],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not step.done():
+                    step.cancel()
+                    await asyncio.wait([step])
+                    raise ConnectionError('The client hung up')
+                try:
+                    result = step.result()
+                except StopAsyncIteration:
+                    return
+                await _send(writer, {'type': 'result', **result._asdict()})
+        finally:
+            gone.cancel()
+            await results.aclose()
+
+    async def start(self, path: str = None, port: int = None):
+        self._status_lock = asyncio.Lock()
+        if port is not None:
+            return await asyncio.start_server(self.handle, '127.0.0.1', port)
+        path = path or default_socket()
+        if Path(path).exists():
+            with socket.socket(socket.AF_UNIX) as s:
+                if s.connect_ex(path) == 0:
+                    raise RuntimeError(f'A daemon is already listening on '
+                                       f'{path}')
+            # Left behind by a daemon that did not shut down cleanly.
+            os.remove(path)
+        # The socket is private to our user from the moment it exists.
+        sock = socket.socket(socket.AF_UNIX)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        return await asyncio.start_unix_server(self.handle, sock=sock)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+        self.stats.save()
+
+
+async def submit(args: argparse.Namespace,
+                 results: Results,
+                 show: Callable[[Result], None],
+                 path: str = None,
+                 port: int = None,
+                 token: str = None) -> None:
+    # Sends one job to the daemon and shows its results as they arrive.
+    if port is not None:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    else:
+        reader, writer = await asyncio.open_unix_connection(
+            path or default_socket())
+    job = {k: v for k, v in vars(args).items() if k not in CLIENT_ARGS}
+    # The daemon does not share our working directory.
+    job['input'] = [str(Path(p).resolve()) for p in args.inputs]
+    try:
+        await _send(writer, {'token': token or daemon_token(), 'args': job})
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError('The daemon closed the connection')
+            message = json.loads(line)
+            kind = message.pop('type')
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise RuntimeError(message['error'])
+            result = Result(**message)
+            results.record(result)
+            show(result)
+    finally:
+        writer.close()
+
+
+def _where(args: argparse.Namespace) -> dict:
+    return {'path': args.socket, 'port': args.port}
+
+
+def _address(parser_: argparse.ArgumentParser) -> None:
+    parser_.add_argument('--socket',
+                         help='Unix socket of the daemon (default: '
+                         'pymirror.sock in the config folder)')
+    parser_.add_argument('--port',
+                         help='Use this local TCP port instead of a Unix '
+                         'socket',
+                         type=int)
+
+
+def serve_main(argv: list) -> None:
+    parser_ = argparse.ArgumentParser(prog='pymirror serve',
+                                      formatter_class=fmt)
+    _address(parser_)
+    parser_.add_argument('-m',
+                         '--more-links',
+                         help='Keep Firefox instances started for jobs that '
+                         'use `--more-links`',
+                         action='store_true',
+                         default=False)
+    parser_.add_argument('-B',
+                         '--browsers',
+                         help='Number of Firefox instances (default: 2)',
+                         type=int,
+                         default=2)
+    parser_.add_argument('-b',
+                         '--max-bandwidth',
+                         help='Upper limit for the total upload rate of all '
+                         'jobs in MB/s (default: the measured upload speed)',
+                         type=float)
+    args = parser_.parse_args(argv)
+    daemon = Daemon(args.more_links,
+                    args.browsers,
+                    max_bandwidth=args.max_bandwidth)
+
+    async def serve() -> None:
+        server = await daemon.start(**_where(args))
+        console.print(f'Listening on '
+                      f'{args.port or args.socket or default_socket()}',
+                      style='#f1fa8c')
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        path = args.socket or default_socket()
+        if args.port is None and Path(path).exists():
+            os.remove(path)
+
+
+def submit_main(argv: list) -> None:
+    from pymirror.main import PyMirror
+    parser_ = parser()
+    parser_.prog = 'pymirror submit'
+    _address(parser_)
+    args = cli(argv, parser_)
+    if args.resume or args.delete:
+        # Daemon jobs are not journaled, and the daemon does not delete
+        # inputs for its clients.
+        console.print('`--resume` and `--delete` are not supported by '
+                      '`pymirror submit`.',
+                      style='#ff5555')
+        sys.exit(1)
+    if args.max_bandwidth:
+        # The daemon paces all of its jobs together.
+        console.print('`--max-bandwidth` is set on `pymirror serve`.',
+                      style='#ff5555')
+        sys.exit(1)
+    front = PyMirror(args)
+    streaming = args.style == 'ndjson'
+    if streaming:
+        console.stderr = True
+    try:
+        asyncio.run(
+            submit(args, front.results,
+                   ndjson() if streaming else front.show, **_where(args)))
+    except (FileNotFoundError, ConnectionRefusedError):
+        console.print('No daemon is running; start one with `pymirror '
+                      'serve`.', style='#ff5555')
+        sys.exit(1)
+    output = front.style_output()
+    console.rule(f'Results: {len(front.results.all_links)}')
+    if not streaming:
+        print(output)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from pymirror.config import config, upload_speed
+
+FLOOR = 30
+CEILING = 6 * 3600
+SLACK = 3
+DEFAULT_SPEED = 1.0
+MIN_SAMPLE = 1.0
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    # A per-job time limit that works from any thread. When it expires, the
+    # registered cancel callbacks run (closing sockets, killing processes or
+    # quitting browsers) so the blocked job fails promptly.
+
+    def __init__(self, seconds: float, label: str = None) -> None:
+        self.seconds = seconds
+        self.label = label
+        self.expires = time.monotonic() + seconds
+        self.expired = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def remaining(self) -> float:
+        return max(self.expires - time.monotonic(), 0)
+
+    def check(self) -> None:
+        if self.expired or self.remaining() <= 0:
+            raise DeadlineExceeded(f'{self.label or "Job"} timed out after '
+                                   f'{self.seconds:.0f}s')
+
+    def on_expire(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            if not self.expired:
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def cancel(self) -> None:
+        # Expire right away, e.g. when the job is no longer needed.
+        self._expire()
+
+    def _expire(self) -> None:
+        with self._lock:
+            self.expired = True
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:  # noqa
+                continue
+
+    def __enter__(self) -> 'Deadline':
+        self._timer = threading.Timer(self.remaining(), self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        _local.deadline = self
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._timer.cancel()
+        _local.deadline = None
+
+
+def current() -> Optional[Deadline]:
+    return getattr(_local, 'deadline', None)
+
+
+def check() -> None:
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+
+def deadline_for(size: float,
+                 throughput: Optional[float],
+                 floor: float = FLOOR,
+                 ceiling: float = CEILING) -> float:
+    # `size` in MB and `throughput` in MB/s.
+    rate = throughput or DEFAULT_SPEED
+    return min(floor + SLACK * size / rate, ceiling)
+
+
+class HostStats:
+    # Measured upload throughput (MB/s) per host, smoothed with an
+    # exponentially weighted moving average and kept between runs.
+
+    ALPHA = 0.3
+
+    def __init__(self, path: str = None) -> None:
+        if path is None:
+            path = f'{config()["project_path"]}/host_stats.json'
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as j:
+                self.stats = json.load(j)
+        except (OSError, ValueError):
+            self.stats = {}
+
+    def measured(self, server: str) -> Optional[float]:
+        with self._lock:
+            if server in self.stats:
+                return self.stats[server]['throughput']
+        return None
+
+    def throughput(self,
+                   server: str,
+                   share: Optional[float] = None) -> Optional[float]:
+        # What one transfer to `server` can expect: its measured rate, but
+        # no more than `share`, the part of the uplink each of the transfers
+        # running together gets. A host not measured yet gets `share`, or
+        # the measured upload speed when there is none.
+        measured = self.measured(server)
+        if share:
+            return min(measured, share) if measured else share
+        return measured or upload_speed()
+
+    def record(self, server: str, size: float, seconds: float) -> None:
+        # Small uploads are dominated by latency and say little about
+        # throughput.
+        if seconds <= 0 or size < MIN_SAMPLE:
+            return
+        rate = size / seconds
+        with self._lock:
+            old = self.stats.get(server)
+            if old is not None:
+                rate = self.ALPHA * rate + (1 - self.ALPHA) * old['throughput']
+            self.stats[server] = {'throughput': rate, 'updated': time.time()}
+
+    def deadline(self,
+                 server: str,
+                 size: float,
+                 share: Optional[float] = None,
+                 **kwargs) -> float:
+        return deadline_for(size, self.throughput(server, share), **kwargs)
+
+    def save(self) -> None:
+        with self._lock:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'w') as j:
+                json.dump(self.stats, j, indent=4)
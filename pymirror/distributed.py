@@ -0,0 +1,663 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import abc
+import argparse
+import concurrent.futures
+import contextlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from pymirror.api import options
+from pymirror.api_upload import APIUpload
+from pymirror.archive import write_archive
+from pymirror.catalogue import Catalogue
+from pymirror.cli import cli, fmt, parser
+from pymirror.config import config
+from pymirror.deadline import HostStats
+from pymirror.helpers import console, load_data, logger
+from pymirror.registry import registry
+from pymirror.results import Result, Results, ndjson
+from pymirror.scheduler import Slots, TokenBucket
+from pymirror.verify import verify
+
+# A worker renews the lease of the job it is running every third of
+# `LEASE_TTL`; a job whose lease runs out goes to the next worker that asks,
+# at most `MAX_ATTEMPTS` times.
+LEASE_TTL = 60
+MAX_ATTEMPTS = 3
+POLL = 1
+WORKER_THREADS = 4
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run TEXT NOT NULL,
+    input TEXT NOT NULL,
+    server TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT,
+    link TEXT,
+    bytes INTEGER,
+    duration REAL,
+    error TEXT,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run, state);
+CREATE TABLE IF NOT EXISTS done (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run TEXT NOT NULL,
+    job INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS done_run ON done (run, seq);
+'''
+
+
+def default_url() -> str:
+    return f'sqlite:///{config()["project_path"]}/queue.sqlite'
+
+
+class Job(dict):
+    # A leased (input, server) job: `id`, `run`, `input`, `server`.
+    pass
+
+
+class JobQueue(abc.ABC):
+    # Where a coordinator puts (input, server) jobs and workers on any
+    # number of machines lease them. A job is leased by one worker at a
+    # time; if the worker stops renewing its lease (it died or lost the
+    # connection), the job is handed to another one. Finished jobs are kept
+    # in the order they finished, so a coordinator can follow its run.
+
+    @abc.abstractmethod
+    def put(self, run: str, jobs: list) -> None:
+        pass
+
+    @abc.abstractmethod
+    def lease(self, worker: str, ttl: float = LEASE_TTL) -> Optional[Job]:
+        pass
+
+    @abc.abstractmethod
+    def renew(self, job: Job, worker: str, ttl: float = LEASE_TTL) -> bool:
+        # False once the job is no longer ours: its lease ran out and it was
+        # handed to someone else, or the run was cancelled.
+        pass
+
+    @abc.abstractmethod
+    def complete(self, job: Job, worker: str, result: Result) -> bool:
+        # A result from a worker that lost its lease is dropped.
+        pass
+
+    @abc.abstractmethod
+    def finished(self, run: str, after: int = 0) -> tuple:
+        # The results of `run` that finished after position `after`, and the
+        # position to ask from next.
+        pass
+
+    @abc.abstractmethod
+    def pending(self, run: str = None) -> int:
+        # Jobs of `run` (of every run by default) that are not finished.
+        pass
+
+    @abc.abstractmethod
+    def cancel(self, run: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteQueue(JobQueue):
+    # A queue in an SQLite file, for workers that share a volume with the
+    # coordinator. It keeps SQLite's default rollback journal: WAL needs
+    # shared memory, which network file systems do not have. Leases are
+    # timed with the clock of each machine, so theirs should agree (NTP) to
+    # within a fraction of `LEASE_TTL`.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path,
+                                   timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # `BEGIN IMMEDIATE` takes the write lock up front, so two workers
+        # can never lease the same job.
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    @staticmethod
+    def _finish(db: sqlite3.Connection, job_id: int, status: str,
+                error: str = None, now: float = None) -> None:
+        db.execute(
+            'UPDATE jobs SET state = ?, status = ?, error = ?, finished = ? '
+            'WHERE id = ?', ('done', status, error, now or time.time(),
+                             job_id))
+        db.execute('INSERT INTO done (run, job) '
+                   'SELECT run, id FROM jobs WHERE id = ?', (job_id, ))
+
+    def put(self, run: str, jobs: list) -> None:
+        with self._transaction() as db:
+            db.executemany('INSERT INTO jobs (run, input, server) '
+                           'VALUES (?, ?, ?)',
+                           [(run, str(f), k) for f, k in jobs])
+
+    def lease(self, worker: str, ttl: float = LEASE_TTL) -> Optional[Job]:
+        now = time.time()
+        with self._transaction() as db:
+            for (job_id, ) in db.execute(
+                    'SELECT id FROM jobs WHERE state = ? AND expires < ? '
+                    'AND attempts >= ?',
+                    ('leased', now, MAX_ATTEMPTS)).fetchall():
+                self._finish(db, job_id, 'lost',
+                             f'No worker finished it in {MAX_ATTEMPTS} '
+                             'attempts', now)
+            row = db.execute(
+                'SELECT id, run, input, server FROM jobs '
+                'WHERE state = ? OR (state = ? AND expires < ?) '
+                'ORDER BY id LIMIT 1', ('queued', 'leased', now)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                'UPDATE jobs SET state = ?, worker = ?, expires = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                ('leased', worker, now + ttl, row[0]))
+        return Job(zip(['id', 'run', 'input', 'server'], row))
+
+    def renew(self, job: Job, worker: str, ttl: float = LEASE_TTL) -> bool:
+        with self._transaction() as db:
+            return db.execute(
+                'UPDATE jobs SET expires = ? '
+                'WHERE id = ? AND state = ? AND worker = ?',
+                (time.time() + ttl, job['id'], 'leased',
+                 worker)).rowcount == 1
+
+    def complete(self, job: Job, worker: str, result: Result) -> bool:
+        with self._transaction() as db:
+            updated = db.execute(
+                'UPDATE jobs SET link = ?, bytes = ?, duration = ? '
+                'WHERE id = ? AND state = ? AND worker = ?',
+                (result.link, result.bytes, result.duration, job['id'],
+                 'leased', worker)).rowcount
+            if updated:
+                self._finish(db, job['id'], result.status, result.error)
+        return updated == 1
+
+    def finished(self, run: str, after: int = 0) -> tuple:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT done.seq, input, server, status, link, bytes, '
+                'duration, error, finished FROM done '
+                'JOIN jobs ON jobs.id = done.job '
+                'WHERE done.run = ? AND done.seq > ? ORDER BY done.seq',
+                (run, after)).fetchall()
+        if not rows:
+            return [], after
+        return [Result(*row[1:]) for row in rows], rows[-1][0]
+
+    def pending(self, run: str = None) -> int:
+        with self._lock:
+            if run is None:
+                row = self._db.execute(
+                    'SELECT COUNT(*) FROM jobs WHERE state != ?',
+                    ('done', )).fetchone()
+            else:
+                row = self._db.execute(
+                    'SELECT COUNT(*) FROM jobs WHERE run = ? AND state != ?',
+                    (run, 'done')).fetchone()
+        return row[0]
+
+    def cancel(self, run: str) -> None:
+        with self._transaction() as db:
+            for (job_id, ) in db.execute(
+                    'SELECT id FROM jobs WHERE run = ? AND state != ?',
+                    (run, 'done')).fetchall():
+                self._finish(db, job_id, 'cancelled')
+
+    def close(self) -> None:
+        self._db.close()
+
+
+# Each script runs atomically on the server and keeps the time by the
+# server's clock, so the workers' clocks do not matter.
+_NOW = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1e6
+local p = ARGV[1]
+local function finish(id, status, err)
+    local job = p .. 'job:' .. id
+    local run = redis.call('HGET', job, 'run')
+    redis.call('HSET', job, 'state', 'done', 'status', status,
+               'finished', tostring(now))
+    if err then redis.call('HSET', job, 'error', err) end
+    redis.call('ZREM', p .. 'leased', id)
+    redis.call('RPUSH', p .. 'done:' .. run, id)
+    redis.call('HINCRBY', p .. 'pending', run, -1)
+    redis.call('HINCRBY', p .. 'pending', '', -1)
+end
+'''
+
+_LEASE = _NOW + '''
+local worker, ttl, max = ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[4])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', p .. 'leased', '-inf',
+                               now)) do
+    redis.call('ZREM', p .. 'leased', id)
+    local attempts = tonumber(redis.call('HGET', p .. 'job:' .. id,
+                                         'attempts'))
+    if attempts >= max then
+        finish(id, 'lost', 'No worker finished it in ' .. max ..
+               ' attempts')
+    else
+        redis.call('LPUSH', p .. 'queued', id)
+    end
+end
+local id = redis.call('LPOP', p .. 'queued')
+if not id then return false end
+local job = p .. 'job:' .. id
+redis.call('HSET', job, 'state', 'leased', 'worker', worker)
+redis.call('HINCRBY', job, 'attempts', 1)
+redis.call('ZADD', p .. 'leased', now + ttl, id)
+return {id, redis.call('HGET', job, 'run'), redis.call('HGET', job, 'input'),
+        redis.call('HGET', job, 'server')}
+'''
+
+_OURS = '''
+local job = p .. 'job:' .. ARGV[2]
+if redis.call('HGET', job, 'state') ~= 'leased'
+        or redis.call('HGET', job, 'worker') ~= ARGV[3] then
+    return 0
+end
+'''
+
+_RENEW = _NOW + _OURS + '''
+redis.call('ZADD', p .. 'leased', now + tonumber(ARGV[4]), ARGV[2])
+return 1
+'''
+
+_COMPLETE = _NOW + _OURS + '''
+for i = 6, #ARGV, 2 do
+    redis.call('HSET', job, ARGV[i], ARGV[i + 1])
+end
+finish(ARGV[2], ARGV[4], ARGV[5] ~= '' and ARGV[5] or nil)
+return 1
+'''
+
+_CANCEL = _NOW + '''
+for _, id in ipairs(redis.call('LRANGE', p .. 'run:' .. ARGV[2], 0, -1)) do
+    if redis.call('HGET', p .. 'job:' .. id, 'state') ~= 'done' then
+        redis.call('LREM', p .. 'queued', 0, id)
+        finish(id, 'cancelled', nil)
+    end
+end
+return 1
+'''
+
+
+class RedisQueue(JobQueue):
+    # A queue in Redis (or any server that speaks its protocol and runs Lua
+    # scripts, e.g. Valkey or KeyDB), for when the queue cannot live on a
+    # shared volume (e.g. SQLite locking is unreliable on it). Workers still
+    # read the inputs by the coordinator's absolute paths, so those must be
+    # mounted at the same place on every machine.
+
+    def __init__(self, url: str, prefix: str = 'pymirror:') -> None:
+        try:
+            import redis
+        except ImportError:
+            raise Exception('The redis queue requires the `redis` package: '
+                            'pip install redis')
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._lease = self._redis.register_script(_LEASE)
+        self._renew = self._redis.register_script(_RENEW)
+        self._complete = self._redis.register_script(_COMPLETE)
+        self._cancel = self._redis.register_script(_CANCEL)
+
+    def put(self, run: str, jobs: list) -> None:
+        p = self.prefix
+        first = self._redis.incrby(f'{p}next', len(jobs)) - len(jobs) + 1
+        with self._redis.pipeline() as pipe:
+            for job_id, (file, k) in enumerate(jobs, first):
+                pipe.hset(f'{p}job:{job_id}', mapping={
+                    'run': run, 'input': str(file), 'server': k,
+                    'state': 'queued', 'attempts': 0})
+                pipe.rpush(f'{p}run:{run}', job_id)
+            pipe.hincrby(f'{p}pending', run, len(jobs))
+            pipe.hincrby(f'{p}pending', '', len(jobs))
+            pipe.rpush(f'{p}queued',
+                       *range(first, first + len(jobs)))
+            pipe.execute()
+
+    def lease(self, worker: str, ttl: float = LEASE_TTL) -> Optional[Job]:
+        row = self._lease(args=[self.prefix, worker, ttl, MAX_ATTEMPTS])
+        if not row:
+            return None
+        return Job(id=int(row[0]), run=row[1], input=row[2], server=row[3])
+
+    def renew(self, job: Job, worker: str, ttl: float = LEASE_TTL) -> bool:
+        return self._renew(args=[self.prefix, job['id'], worker, ttl]) == 1
+
+    def complete(self, job: Job, worker: str, result: Result) -> bool:
+        fields = []
+        for k in ['link', 'bytes', 'duration']:
+            if getattr(result, k) is not None:
+                fields += [k, getattr(result, k)]
+        return self._complete(args=[
+            self.prefix, job['id'], worker, result.status, result.error or ''
+        ] + fields) == 1
+
+    def finished(self, run: str, after: int = 0) -> tuple:
+        ids = self._redis.lrange(f'{self.prefix}done:{run}', after, -1)
+        results = []
+        for job_id in ids:
+            job = self._redis.hgetall(f'{self.prefix}job:{job_id}')
+            results.append(Result(
+                job['input'], job['server'], job['status'], job.get('link'),
+                int(job['bytes']) if 'bytes' in job else None,
+                float(job['duration']) if 'duration' in job else None,
+                job.get('error'), float(job['finished'])))
+        return results, after + len(ids)
+
+    def pending(self, run: str = None) -> int:
+        return int(self._redis.hget(f'{self.prefix}pending', run or '') or 0)
+
+    def cancel(self, run: str) -> None:
+        self._cancel(args=[self.prefix, run])
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+def open_queue(url: str = None) -> JobQueue:
+    # `sqlite:///path/to/queue.sqlite` (or just a path) or
+    # `redis://host:6379/0`.
+    url = url or default_url()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(url)
+    if url.startswith('sqlite://'):
+        url = url[len('sqlite://'):]
+    return SQLiteQueue(url)
+
+
+class Worker:
+    # Leases jobs from the queue and uploads them like a local run would
+    # (same deadlines, transports and bandwidth limit), `threads` at a
+    # time. The links go back through the queue; host statistics and the
+    # catalogue stay on this machine.
+
+    def __init__(self,
+                 queue: JobQueue,
+                 args: argparse.Namespace = None,
+                 data: dict = None,
+                 name: str = None,
+                 ttl: float = LEASE_TTL) -> None:
+        self.queue = queue
+        self.args = args or options(no_cache=True)
+        self.data = registry(data or load_data())
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl
+        self.stats = HostStats()
+        self.catalogue = None if self.args.no_cache else Catalogue()
+        # All the jobs of this worker share its uplink.
+        uplink = APIUpload(self.data, self.args).uplink()
+        self.bucket = None
+        if uplink:
+            self.bucket = TokenBucket(uplink * 1e+6, burst=uplink * 1e+6 / 4)
+        # One slot per thread, set by `run`.
+        self.slots = None
+        self.stopped = threading.Event()
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def _upload(self, job: Job, results: Results) -> None:
+        server = job['server']
+        if server not in self.data:
+            results.emit(job['input'], server, 'error',
+                         error=f'Unknown server: {server}')
+            return
+        api = APIUpload(self.data.subset([server]),
+                        self.args,
+                        self.catalogue,
+                        stats=self.stats,
+                        results=results)
+        api.bucket, api.slots = self.bucket, self.slots
+        try:
+            api.api_uploads(files=[job['input']])
+        except Exception as e:  # noqa
+            results.emit(job['input'], server, 'error', error=repr(e))
+
+    def _heartbeat(self, job: Job, holder: str, results: Results,
+                   finished: threading.Event) -> None:
+        while not finished.wait(self.ttl / 3):
+            if not self.queue.renew(job, holder, self.ttl):
+                # Someone else has the job now, or its run was cancelled.
+                logger.info(f'{holder}: lost the lease of job {job["id"]}')
+                results.cancel()
+                return
+
+    def work(self, job: Job, holder: str = None) -> None:
+        # `holder` names the lease; each thread has its own.
+        holder = holder or self.name
+        found = []
+        results = Results(found.append)
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,
+                                     args=(job, holder, results, finished),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            self._upload(job, results)
+        finally:
+            finished.set()
+            heartbeat.join()
+        # Hosts that cannot take the file produce no result at all.
+        result = found[-1] if found else Result(job['input'], job['server'],
+                                                'skipped')
+        if results.cancelled.is_set():
+            return
+        if self.queue.complete(job, holder, result):
+            with self._lock:
+                self.done += 1
+            logger.info(f'{holder}: {result.server} {result.status} '
+                        f'{result.link or result.error or ""}')
+
+    def _loop(self, holder: str, drain: bool) -> None:
+        while not self.stopped.is_set():
+            job = self.queue.lease(holder, self.ttl)
+            if job is None:
+                # With `drain`, stop once every job is finished; a job still
+                # leased by a worker that died is waited for.
+                if drain and not self.queue.pending():
+                    return
+                self.stopped.wait(POLL)
+                continue
+            self.work(job, holder)
+
+    def run(self, threads: int = None, drain: bool = False) -> None:
+        threads = threads or self.args.workers or WORKER_THREADS
+        self.slots = Slots(threads)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                loops = [
+                    executor.submit(self._loop, f'{self.name}/{n}', drain)
+                    for n in range(threads)
+                ]
+                try:
+                    for future in concurrent.futures.as_completed(loops):
+                        future.result()
+                finally:
+                    # Running jobs are finished; no new ones are leased.
+                    self.stopped.set()
+        finally:
+            self.stats.save()
+            if self.catalogue is not None:
+                self.catalogue.close()
+
+
+def enqueue(queue: JobQueue,
+            args: argparse.Namespace,
+            data: dict = None,
+            run: str = None) -> tuple:
+    # Queues a job for every (input, server) pair a local run would upload
+    # and returns the run id and the number of jobs. Inputs are queued by
+    # their absolute path, which the workers must be able to read.
+    run = run or uuid.uuid4().hex[:12]
+    data = data or load_data()
+    api = APIUpload(data, args)
+    files = [str(Path(f).resolve()) for f in args.inputs]
+    jobs = api.schedule(files, api.servers())
+    queue.put(run, jobs)
+    return run, len(jobs)
+
+
+def follow(queue: JobQueue,
+           run: str,
+           results: Results,
+           poll: float = POLL) -> None:
+    # Passes the results of `run` to `results` as the workers report them,
+    # until every job is finished. Interrupting it cancels the run.
+    after = 0
+    try:
+        while True:
+            # Read after counting, so nothing that finishes in between is
+            # left behind.
+            pending = queue.pending(run)
+            finished, after = queue.finished(run, after)
+            for r in finished:
+                results.emit(r.input, r.server, r.status, r.link, r.bytes,
+                             r.duration, r.error)
+            if not pending:
+                return
+            if not finished:
+                time.sleep(poll)
+    except BaseException:
+        queue.cancel(run)
+        raise
+
+
+def _queue_option(parser_: argparse.ArgumentParser) -> None:
+    parser_.add_argument('--queue',
+                         help='Job queue: `sqlite:///path/queue.sqlite` or '
+                         '`redis://host:port/db` (default: queue.sqlite in '
+                         'the config folder)')
+
+
+def _archives(args: argparse.Namespace) -> list:
+    # Folders are archived next to themselves, where the workers can read
+    # them.
+    archives = []
+    for n, path in enumerate(args.inputs):
+        if Path(path).is_dir():
+            args.inputs[n] = write_archive(path,
+                                           getattr(args, 'codec', 'gzip'))
+            archives.append(args.inputs[n])
+    return archives
+
+
+def coordinate_main(argv: list) -> None:
+    from pymirror.main import PyMirror
+    parser_ = parser()
+    parser_.prog = 'pymirror coordinate'
+    _queue_option(parser_)
+    args = cli(argv, parser_)
+    if args.resume or args.more_links:
+        console.print('`--resume` and `--more-links` are not supported by '
+                      '`pymirror coordinate`.', style='#ff5555')
+        sys.exit(1)
+    front = PyMirror(args)
+    streaming = args.style == 'ndjson'
+    if streaming:
+        console.stderr = True
+    archives = _archives(args)
+    queue = open_queue(args.queue)
+    try:
+        run, count = enqueue(queue, args)
+        console.print(f'Queued {count} jobs (run {run})', style='#f1fa8c')
+        results = front.results
+        results.listener = ndjson() if streaming else front.show
+        follow(queue, run, results)
+        if args.verify:
+            verify(results, data=front.data)
+    except KeyboardInterrupt:
+        console.print('Cancelled', style='#ff5555')
+        sys.exit(1)
+    finally:
+        queue.close()
+        for archive in archives:
+            os.remove(archive)
+    output = front.style_output()
+    console.rule(f'Results: {len(front.results.all_links)}')
+    if not streaming:
+        print(output)
+
+
+def worker_main(argv: list) -> None:
+    parser_ = argparse.ArgumentParser(prog='pymirror worker',
+                                      formatter_class=fmt)
+    _queue_option(parser_)
+    parser_.add_argument('--name',
+                         help='Name of this worker (default: host:pid)')
+    parser_.add_argument('-w',
+                         '--workers',
+                         help='Number of jobs to run at once (default: '
+                         f'{WORKER_THREADS})',
+                         type=int,
+                         default=WORKER_THREADS)
+    parser_.add_argument('-b',
+                         '--max-bandwidth',
+                         help='Upper limit for the upload rate of this '
+                         'machine in MB/s (default: the measured upload '
+                         'speed)',
+                         type=float)
+    parser_.add_argument('-t',
+                         '--transport',
+                         help='HTTP transport for API uploads (default: '
+                         'native)',
+                         choices=['native', 'curl'],
+                         default='native')
+    parser_.add_argument('-N',
+                         '--no-cache',
+                         help='Upload again even if a still-valid link for '
+                         'the same file exists',
+                         action='store_true')
+    parser_.add_argument('--drain',
+                         help='Exit once the queue is empty',
+                         action='store_true')
+    args = parser_.parse_args(argv)
+    queue = open_queue(args.queue)
+    worker = Worker(queue,
+                    options(workers=args.workers,
+                            max_bandwidth=args.max_bandwidth,
+                            transport=args.transport,
+                            no_cache=args.no_cache),
+                    name=args.name)
+    console.print(f'{worker.name} is waiting for jobs', style='#f1fa8c')
+    try:
+        worker.run(drain=args.drain)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+    console.print(f'{worker.name} finished {worker.done} jobs')
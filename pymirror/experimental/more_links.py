@@ -2,10 +2,9 @@
 # coding: utf-8
 
 import argparse
+import concurrent.futures
 import inspect
-import itertools
-import signal
-import statistics
+import threading
 import time
 from pathlib import Path
 from typing import Optional
@@ -13,169 +12,207 @@ from typing import Optional
 from dracula import DraculaPalette as Dp
 from selenium.webdriver.common.by import By
 
-from ..helpers import Shared, console, selenium_exceptions
-from ..start_driver import StartDrive
+from ..deadline import Deadline, DeadlineExceeded, HostStats
+from ..helpers import console, selenium_exceptions
+from ..results import Results
+from ..scheduler import LinkBudget, link_budget
+from .. import tracing, waits
+from ..start_driver import POOL_SIZE, DriverPool, get_pool
+
+
+BROWSER_FLOOR = 120
 
 
 class MoreLinks:
 
-    def __init__(self, args: argparse.Namespace) -> None:
+    def __init__(self,
+                 args: argparse.Namespace,
+                 pool: DriverPool = None,
+                 budget: LinkBudget = None,
+                 results: Results = None) -> None:
         self.args = args
+        self.pool = pool
+        self.budget = budget or link_budget(args)
+        self.results = results or Results()
         self.methods = inspect.getmembers(self, predicate=inspect.ismethod)[1:]
         self.file = str(Path(self.args.input).resolve())
         self.file_size = Path(self.args.input).stat().st_size / 1e+6
         self.headless = True
+        self.browsers = getattr(args, 'browsers', None) or POOL_SIZE
+        self._active = {}
+        # How long each provider ran, in seconds.
+        self._took = {}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
 
     def getdict_(self):
         return dict(self.methods)
 
-    @staticmethod
-    def init_driver():
-        return StartDrive(None).start_driver()
+    def reserve_(self, name: str, function, pool: DriverPool,
+                 stats: HostStats) -> Optional[str]:
+        # A provider holds a slot of the link budget while it runs, so the
+        # link it makes is always kept; `False` when the other stages made
+        # enough links before it started.
+        key = str(self.args.input)
+        if self._stop.is_set() or not self.budget.take(key, wait=True):
+            return False
+        link = None
+        try:
+            link = self.run_provider_(name, function, pool, stats)
+        finally:
+            self.budget.settle(key, 1, 1 if link else 0)
+        return link
+
+    def run_provider_(self, name: str, function, pool: DriverPool,
+                      stats: HostStats) -> Optional[str]:
+        seconds = stats.deadline(name, self.file_size, floor=BROWSER_FLOOR)
+        with pool.lend() as driver, Deadline(seconds, name) as deadline:
+            with self._lock:
+                if self._stop.is_set():
+                    return
+                self._active[name] = deadline
+            deadline.on_expire(driver.quit)
+            start = time.time()
+            try:
+                with tracing.span('provider', server=name):
+                    link = function(driver)
+            finally:
+                with self._lock:
+                    del self._active[name]
+                    self._took[name] = time.time() - start
+        if link:
+            stats.record(name, self.file_size, time.time() - start)
+        return link
+
+    def cancel_(self) -> None:
+        # Stop the providers that are still running; their drivers are
+        # quit and replaced in the pool.
+        with self._lock:
+            self._stop.set()
+            active = list(self._active.values())
+        for deadline in active:
+            deadline.cancel()
+
+    def emit_(self, name: str, status: str, link: str = None,
+              error: str = None) -> None:
+        self.results.emit(self.args.input, name, status, link,
+                          round(self.file_size * 1e+6), self._took.get(name),
+                          error)
 
     def upload_to_all_(self):
-        times = []
         links = []
+        stats = HostStats()
         sites = {
             k: v
-            for k, v in MoreLinks(self.args).getdict_().items()
+            for k, v in self.getdict_().items()
             if not k.endswith('_')
         }
 
-        if (self.args.number
-                and int(self.args.number) < len(Shared.all_links) + 5):
-            left = int(self.args.number) - len(Shared.all_links)
-            sites = dict(itertools.islice(sites.items(), left))
-
-        for name, function in sites.items():
-            try:
-                signal.signal(signal.SIGALRM, lambda x, y: 1 / 0)
-                start = time.time()
-                if len(times) > 2:
-                    signal.alarm(int(statistics.mean(times)) + 5)
-                link = function()
-                times.append(time.time() - start)
-                Shared.all_links.append(links)
+        key = str(self.args.input)
+        if self.budget.full(key):
+            return links
+
+        pool = self.pool or get_pool(self.headless, self.browsers)
+        with concurrent.futures.ThreadPoolExecutor(
+                self.browsers) as executor, \
+                self.results.cancelling(self.cancel_):
+            futures = {
+                executor.submit(self.reserve_, name, function, pool,
+                                stats): name
+                for name, function in sites.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    link = future.result()
+                except (DeadlineExceeded, *selenium_exceptions) as e:
+                    self.emit_(name, 'timeout' if isinstance(
+                        e, DeadlineExceeded) else 'error', error=repr(e))
+                    console.print(
+                        f'[[{Dp.r}] ERROR! [/{Dp.r}]]',
+                        f'Encountered error while attempting to upload to '
+                        f'[{Dp.b}]{name}[/{Dp.b}]')
+                    continue
+                if link is False:
+                    continue
+                if not link:
+                    self.emit_(name, 'failed')
+                    continue
                 links.append(link)
-                console.print(f'[[{Dp.g}] OK [/{Dp.g}]]', link)
-            except selenium_exceptions:
-                console.print(
-                    f'[[{Dp.r}] ERROR! [/{Dp.r}]]',
-                    f'Encountered error while attempting to upload to'
-                    f'[{Dp.b}]{name}[/{Dp.b}]')
-            finally:
-                signal.alarm(0)
+                self.emit_(name, 'ok', link)
+                if self.budget.full(key):
+                    # Providers still waiting for a slot would get none.
+                    for f in futures:
+                        f.cancel()
+        stats.save()
         return links
 
-    def usaupload(self) -> Optional[str]:
+    def usaupload(self, driver) -> Optional[str]:
         if self.file_size > 1000:
             return
-        driver = self.init_driver()
         driver.get('https://usaupload.com/register_non_user')
-        time.sleep(2)
-        driver.find_element(By.ID, 'add_files_btn').send_keys(self.file)
-        driver.find_element(By.CLASS_NAME, 'upload-button').click()
-        while True:
-            try:
-                link = driver.find_element(
-                    By.CLASS_NAME, 'col-xs-4').get_attribute('dtfullurl')
-                if link:
-                    driver.quit()
-                    return link
-            except selenium_exceptions:
-                time.sleep(1)
-
-    def filesharego(self) -> Optional[str]:
+        waits.element(driver, By.ID, 'add_files_btn').send_keys(self.file)
+        waits.clickable(driver, By.CLASS_NAME, 'upload-button').click()
+        return waits.attribute(driver, By.CLASS_NAME, 'col-xs-4', 'dtfullurl')
+
+    def filesharego(self, driver) -> Optional[str]:
         if self.file_size > 5000:
             return
-        driver = self.init_driver()
         driver.get('https://www.filesharego.com')
-        time.sleep(2)
+        waits.element(driver, By.CLASS_NAME, 'nav-item')
         for e in driver.find_elements(By.CLASS_NAME, 'nav-item'):
             if 'Upload File' in e.text:
                 e.click()
                 break
-        time.sleep(2)
-        driver.find_element(By.CLASS_NAME,
-                            'dz-hidden-input').send_keys(self.file)
-        while True:
-            try:
-                link_id = driver.find_element(By.ID,
-                                              'copy').get_attribute('data-id')
-                link = driver.find_element(By.ID,
-                                           link_id).get_attribute('value')
-                if link:
-                    driver.quit()
-                    return link
-            except selenium_exceptions:
-                time.sleep(1)
-
-    def filepizza(self) -> Optional[str]:
-        driver = self.init_driver()
+        waits.element(driver, By.CLASS_NAME,
+                      'dz-hidden-input').send_keys(self.file)
+
+        def link(d) -> Optional[str]:
+            link_id = d.find_element(By.ID, 'copy').get_attribute('data-id')
+            return d.find_element(By.ID, link_id).get_attribute('value')
+
+        return waits.until(driver, link, label='filesharego link')
+
+    def filepizza(self, driver) -> Optional[str]:
         driver.get('https://file.pizza/')
-        driver.find_element(
-            By.CSS_SELECTOR,
+        waits.element(
+            driver, By.CSS_SELECTOR,
             '.select-file-label > input:nth-child(1)').send_keys(self.file)
-        while True:
-            time.sleep(1)
-            link = driver.find_element(By.CLASS_NAME, 'short-url').text
-            if link:
-                driver.quit()
-                break
+        link = waits.text(driver, By.CLASS_NAME, 'short-url')
         link = link.replace('or, for short: ', '')
         return link
 
-    def expirebox(self) -> Optional[str]:
+    def expirebox(self, driver) -> Optional[str]:
         if self.file_size > 200:
             return
-        driver = self.init_driver()
         driver.get('https://expirebox.com/')
-        time.sleep(2)
-        driver.find_element(By.ID, 'fileupload').send_keys(self.file)
-        while True:
-            time.sleep(1)
-            try:
-                link = driver.find_element(
-                    By.CSS_SELECTOR,
-                    'div.input-group:nth-child(3) > input:nth-child(1)'
-                ).get_attribute('value')
-                if link:
-                    driver.quit()
-                    return link
-            except selenium_exceptions:
-                time.sleep(1)
-
-    def filepost(self) -> Optional[str]:
+        waits.element(driver, By.ID, 'fileupload').send_keys(self.file)
+        return waits.attribute(
+            driver, By.CSS_SELECTOR,
+            'div.input-group:nth-child(3) > input:nth-child(1)', 'value')
+
+    def filepost(self, driver) -> Optional[str]:
         if self.file_size > 3000:
             return
-        driver = self.init_driver()
         driver.get('https://filepost.io/')
-        driver.find_element(By.CSS_SELECTOR,
-                            '.drop-region > input:nth-child(4)').send_keys(
-                                self.file)
-        while True:
-            time.sleep(1)
-            try:
-                e = driver.find_element(
-                    By.CSS_SELECTOR,
-                    'div.buttons:nth-child(3) > a:nth-child(1)')
-                link = e.get_attribute('href').split('&body=')[1]
-                if link:
-                    driver.quit()
-                    return link
-            except selenium_exceptions:
-                time.sleep(1)
-
-    def sendcm(self) -> str:
-        driver = self.init_driver()
-        driver.find_element(By.ID, 'file_0').send_keys(self.file)
+        waits.element(
+            driver, By.CSS_SELECTOR,
+            '.drop-region > input:nth-child(4)').send_keys(self.file)
+
+        def link(d) -> Optional[str]:
+            href = d.find_element(
+                By.CSS_SELECTOR,
+                'div.buttons:nth-child(3) > a:nth-child(1)').get_attribute(
+                    'href') or ''
+            return href.split('&body=')[1] if '&body=' in href else None
+
+        return waits.until(driver, link, label='filepost link')
+
+    def sendcm(self, driver) -> str:
+        waits.element(driver, By.ID, 'file_0').send_keys(self.file)
         up = driver.find_element(By.ID, 'upload_controls')
         up.find_element(By.CLASS_NAME, 'btn').click()
-        while True:
-            try:
-                link = driver.find_element(
-                    By.CSS_SELECTOR,
-                    '.input-group > textarea:nth-child(2)').text
-                return link
-            except selenium_exceptions:
-                time.sleep(1)
+        return waits.text(driver, By.CSS_SELECTOR,
+                          '.input-group > textarea:nth-child(2)')
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import abc
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+CHUNK_SIZE = 1 << 20
+WINDOW = 32
+
+_EVICTED = object()
+
+
+class FanOut:
+    # One sequential read shared by any number of consumers. At most `window`
+    # chunks are kept; a consumer that falls behind re-reads on its own
+    # (`Rereadable` sources) or, for one-shot streams, holds the producer
+    # back until it catches up.
+
+    rereadable = False
+
+    def __init__(self,
+                 read: Callable[[], bytes],
+                 size: Optional[int] = None,
+                 window: int = WINDOW) -> None:
+        self._read = read
+        self.size = size
+        self.window = window
+        self.reads = 0
+        self.rereads = 0
+        self._chunks = {}
+        self._next = 0
+        self._eof = None
+        self._positions = {}
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _oldest(self) -> int:
+        return self._next - len(self._chunks)
+
+    def _chunk(self, i: int, consumer: object):
+        with self._cond:
+            self._positions[consumer] = i
+            self._cond.notify_all()
+            while True:
+                if i in self._chunks:
+                    return self._chunks[i]
+                if self._eof is not None and i >= self._eof:
+                    return b''
+                if i < self._next:
+                    return _EVICTED
+                full = len(self._chunks) >= self.window
+                if full and not self.rereadable and min(
+                        self._positions.values()) <= self._oldest():
+                    self._cond.wait()
+                    continue
+                data = self._read()
+                if not data:
+                    self._eof = self._next
+                    continue
+                if full:
+                    del self._chunks[self._oldest()]
+                self.reads += 1
+                self._chunks[self._next] = data
+                self._next += 1
+
+    def _register(self, consumer: object) -> None:
+        with self._cond:
+            self._positions[consumer] = 0
+
+    def _unregister(self, consumer: object) -> None:
+        with self._cond:
+            self._positions.pop(consumer, None)
+            self._cond.notify_all()
+
+    def reader(self) -> 'Reader':
+        return Reader(self)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.reader()
+
+
+class Reader:
+    # A consumer's cursor into a FanOut. It is registered as soon as it is
+    # created, so a one-shot stream cannot run ahead of readers that have
+    # not started yet.
+
+    def __init__(self, fanout: FanOut) -> None:
+        self.fanout = fanout
+        self.size = fanout.size
+        self.i = 0
+        self.handle = None
+        self.closed = False
+        fanout._register(self)
+
+    def __iter__(self) -> 'Reader':
+        return self
+
+    def __next__(self) -> bytes:
+        if self.closed:
+            raise StopIteration
+        data = self.fanout._chunk(self.i, self)
+        if data is _EVICTED:
+            if not self.fanout.rereadable:
+                raise RuntimeError('Chunk evicted from a one-shot stream')
+            if self.handle is None:
+                self.handle = self.fanout._open()
+            self.fanout.rereads += 1
+            data = self.fanout._reread(self.i, self.handle)
+        if not data:
+            self.close()
+            raise StopIteration
+        self.i += 1
+        return data
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.fanout._unregister(self)
+        if self.handle is not None:
+            self.handle.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+
+class Rereadable(FanOut, abc.ABC):
+    # A source whose chunks can be read again, so a consumer that fell out
+    # of the window opens a handle of its own instead of holding the others
+    # back.
+
+    rereadable = True
+
+    @abc.abstractmethod
+    def _open(self):
+        pass
+
+    @abc.abstractmethod
+    def _reread(self, i: int, handle) -> bytes:
+        pass
+
+
+class SharedFile(Rereadable):
+
+    def __init__(self,
+                 file: str,
+                 chunk_size: int = CHUNK_SIZE,
+                 window: int = WINDOW) -> None:
+        self.file = file
+        self.chunk_size = chunk_size
+        self._f = open(file, 'rb')
+        self._hash = hashlib.sha256()
+        super().__init__(self._read_next,
+                         size=Path(file).stat().st_size,
+                         window=window)
+
+    def _read_next(self) -> bytes:
+        data = self._f.read(self.chunk_size)
+        self._hash.update(data)
+        return data
+
+    @property
+    def digest(self) -> Optional[str]:
+        # SHA-256 of the file, available once the shared read reached the
+        # end of it.
+        if self._eof is None:
+            return None
+        return self._hash.hexdigest()
+
+    def _open(self):
+        return open(self.file, 'rb')
+
+    def _reread(self, i: int, handle) -> bytes:
+        handle.seek(i * self.chunk_size)
+        return handle.read(self.chunk_size)
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class SharedFiles:
+    # Opens one SharedFile per input on first use and closes it once all of
+    # the jobs that were counted for it have released it.
+
+    def __init__(self, counts: dict, window: int = WINDOW) -> None:
+        self.counts = dict(counts)
+        self.window = window
+        self.digests = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, file) -> FanOut:
+        with self._lock:
+            if file not in self._sources:
+                if hasattr(file, 'fanout'):
+                    self._sources[file] = file.fanout()
+                else:
+                    self._sources[file] = SharedFile(file, window=self.window)
+            return self._sources[file]
+
+    def release(self, file: str) -> None:
+        with self._lock:
+            self.counts[file] -= 1
+            if self.counts[file] <= 0 and file in self._sources:
+                self._close(file, self._sources.pop(file))
+
+    def _close(self, file, source: FanOut) -> None:
+        if isinstance(source, SharedFile):
+            source.close()
+            if source.digest is not None:
+                self.digests[file] = source.digest
+
+    def close(self) -> None:
+        with self._lock:
+            for file, source in self._sources.items():
+                self._close(file, source)
+            self._sources.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -6,15 +6,15 @@ import time
 import traceback
 from typing import NoReturn
 
-import psutil
 from dracula import DraculaPalette as Dp
 
-from pymirror.helpers import console, logger, Shared
+from pymirror.helpers import console, logger
 
 
 def firefoxInterrupt(pids) -> list:
     terminated = []
     if pids:
+        import psutil
         for pid in pids:
             try:
                 p = psutil.Process(pid)
@@ -27,13 +27,15 @@ def firefoxInterrupt(pids) -> list:
 
 def keyboardInterruptHandler(*args) -> NoReturn:  # noqa
     sys.tracebacklimit = 0
-    print('', end='\r')
+    # Same stream as the console, so `--style ndjson` output stays clean.
+    print('', end='\r', file=console.file)
     time.sleep(0.5)
     console.print(f'[{Dp.y}]Quitting...')
-    terminated = firefoxInterrupt(Shared.pids)
+    # Finished uploads are already in the journal.
+    console.print(f'[{Dp.y}]Run `pymirror --resume` to pick up where this '
+                  'run stopped.')
+    # The interrupted run has already quit its browsers.
     logger.info('Interrupted by the user.')
-    if terminated:
-        logger.info('Terminated interrupted Firefox instances:', terminated)
     sys.exit(0)
 
 
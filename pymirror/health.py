@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import asyncio
+import socket
+import ssl
+import time
+from typing import Mapping
+from urllib.parse import urlsplit
+
+from dracula import DraculaPalette as Dp
+
+from pymirror.helpers import console, logger
+from pymirror.registry import registry
+
+PHASES = ['dns', 'connect', 'tls', 'http']
+
+
+async def _probe(url: str,
+                 result: dict,
+                 method: str = 'HEAD',
+                 headers: dict = None) -> None:
+    loop = asyncio.get_running_loop()
+    parts = urlsplit(url)
+    https = parts.scheme == 'https'
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+
+    start = time.perf_counter()
+
+    def lap(phase: str) -> None:
+        nonlocal start
+        now = time.perf_counter()
+        result[phase] = now - start
+        start = now
+
+    result['phase'] = 'dns'
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    family, _, proto, _, address = infos[0]
+    lap('dns')
+
+    result['phase'] = 'connect'
+    sock = socket.socket(family, socket.SOCK_STREAM, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    lap('connect')
+
+    result['phase'] = 'tls'
+    reader, writer = await asyncio.open_connection(
+        sock=sock,
+        ssl=ssl.create_default_context() if https else None,
+        server_hostname=host if https else None)
+    if https:
+        lap('tls')
+
+    result['phase'] = 'http'
+    extra = ''.join(f'{k}: {v}\r\n' for k, v in (headers or {}).items())
+    try:
+        # Only the status line is read; the connection is closed before
+        # any body arrives.
+        writer.write(f'{method} {path} HTTP/1.1\r\n'
+                     f'Host: {parts.netloc}\r\n'
+                     'User-Agent: curl/7.81.0\r\n'
+                     f'{extra}'
+                     'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        lap('http')
+        result['status'] = int(status_line.split()[1])
+    finally:
+        writer.close()
+    result['phase'] = None
+
+
+async def probe(server: str,
+                url: str,
+                timeout: float = 10,
+                method: str = 'HEAD',
+                headers: dict = None) -> dict:
+    # A server is healthy when its upload endpoint answers HTTP at all with
+    # a non-5xx status; 4xx for a bare HEAD is expected.
+    result = {'server': server, 'url': url, 'status': None, 'error': None}
+    try:
+        await asyncio.wait_for(_probe(url, result, method, headers), timeout)
+    except asyncio.TimeoutError:
+        result['error'] = f'{result["phase"]} timed out'
+    except (OSError, ssl.SSLError, ValueError, IndexError) as e:
+        result['error'] = f'{result["phase"]}: {e}'
+    result['ok'] = result['status'] is not None and result['status'] < 500
+    return result
+
+
+async def probe_all(data: Mapping, timeout: float = 10) -> list:
+    return await asyncio.gather(
+        *[probe(k, v.url, timeout) for k, v in registry(data).items()])
+
+
+def _latency(result: dict) -> str:
+    return ', '.join(f'{phase} {result[phase] * 1000:.0f}ms'
+                     for phase in PHASES if phase in result)
+
+
+def report(result: dict) -> bool:
+    server = result['server']
+    if result['ok']:
+        console.print(f'[[{Dp.g}] OK [/{Dp.g}]] [{Dp.c}]{server}[/{Dp.c}] '
+                      f'is online! ({_latency(result)})')
+        logger.info(f'{server} is online! ({_latency(result)})')
+        return True
+    reason = result['error'] or f'HTTP {result["status"]}'
+    console.print(f'[[{Dp.r}] ERROR! [/{Dp.r}]] [{Dp.c}]{server}[/{Dp.c}] '
+                  f'is down! ({reason})')
+    logger.warning(f'{server} is offline! ({reason})')
+    return False
+
+
+def check_status(data: Mapping, timeout: float = 10) -> list:
+    results = asyncio.run(probe_all(data, timeout))
+    return [report(result) for result in results]
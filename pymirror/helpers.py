@@ -2,22 +2,11 @@
 # coding: utf-8
 
 import inspect
-import json
 import re
-from pathlib import Path
 
 import loguru
-import psutil
-import selenium.common.exceptions
 from rich.console import Console
 
-from pymirror.config import config
-
-
-class Shared:
-    all_links = []
-    pids = []
-
 
 def logger():
     logger_ = loguru.logger
@@ -26,6 +15,7 @@ def logger():
 
 
 def selenium_exceptions_classes():
+    import selenium.common.exceptions
     selenium_exceptions_list = inspect.getmembers(selenium.common.exceptions,
                                                   predicate=inspect.isclass)
     return list(zip(*selenium_exceptions_list))[1]
@@ -49,18 +39,13 @@ def _match_links(links_raw: list) -> list:
 
 
 def load_data():
-    with open(f'{config()["data_path"]}/servers_data.json') as j:  # noqa
-        data = json.load(j)
-    return data
-
-
-def download_time(file: str) -> float:
-
-    file_size = Path(file).stat().st_size / 1e+6
-    return file_size / float(config()['upload_speed'])
+    # The compiled server registry, parsed once per change of the file.
+    from pymirror.registry import load
+    return load()
 
 
 def kill_firefox_zombies() -> list:
+    import psutil
     terminated = []
     for p in psutil.process_iter():
         if 'firefox-bin' in p.name():
@@ -77,6 +62,13 @@ def kill_firefox_zombies() -> list:
     return terminated
 
 
+def __getattr__(name: str):
+    # Selenium is only imported once a browser-based provider needs it.
+    if name == 'selenium_exceptions':
+        globals()[name] = selenium_exceptions_classes()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 console = Console()
 logger = logger()
-selenium_exceptions = selenium_exceptions_classes()
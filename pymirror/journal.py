@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from pymirror.config import config
+
+RESTORED_ARGS = ['resume', 'log']
+# Journals of past runs kept in the journal folder.
+KEEP = 20
+
+
+def default_folder() -> str:
+    return f'{config()["project_path"]}/journals'
+
+
+def _lines(path: str) -> list:
+    with open(path) as f:
+        return f.read().split('\n')
+
+
+def _records(lines: list) -> list:
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # A line cut short by the interruption.
+            continue
+    return records
+
+
+def _running(records: list) -> bool:
+    # Whether another process is still writing the journal: it has not
+    # ended and the process that last started or resumed it is alive.
+    if any(r.get('type') == 'end' for r in records):
+        return False
+    pids = [r['pid'] for r in records if r.get('type') in ('run', 'resume')]
+    if not pids or pids[-1] == os.getpid():
+        return False
+    import psutil
+    return psutil.pid_exists(pids[-1])
+
+
+def last_run(folder: str = None) -> Optional[str]:
+    # The journal of the latest run that is not running any more.
+    for path in sorted(Path(folder or default_folder()).glob('*.jsonl'),
+                       reverse=True):
+        if not _running(_records(_lines(str(path)))):
+            return str(path)
+    return None
+
+
+class Journal:
+    # Append-only record of every (input, server) job of one run, in a file
+    # of its own so that runs side by side do not mix. Each line is flushed
+    # and fsynced as soon as the job finishes, so an interrupted run can be
+    # resumed without losing finished links.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.args = {}
+        self.records = []
+        self._lock = threading.Lock()
+        self._f = None
+
+    @classmethod
+    def start(cls,
+              args: argparse.Namespace,
+              path: str = None,
+              folder: str = None) -> 'Journal':
+        folder = folder or default_folder()
+        if path is None:
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            # Named so that they sort by start time.
+            path = f'{folder}/{time.time_ns()}-{os.getpid()}.jsonl'
+            for old in sorted(Path(folder).glob('*.jsonl'))[:-KEEP]:
+                old.unlink()
+        journal = cls(path)
+        Path(journal.path).parent.mkdir(parents=True, exist_ok=True)
+        journal._f = open(journal.path, 'w')
+        journal.args = {
+            k: v
+            for k, v in vars(args).items() if k not in RESTORED_ARGS
+        }
+        journal._write({'type': 'run', 'args': journal.args,
+                        'started': time.time(), 'pid': os.getpid()})
+        return journal
+
+    @classmethod
+    def resume(cls, path: str = None, folder: str = None) -> 'Journal':
+        # The latest run that is not running, unless it completed.
+        path = path or last_run(folder)
+        if path is None or not Path(path).exists():
+            raise FileNotFoundError('There is no interrupted run to resume.')
+        lines = _lines(path)
+        records = _records(lines)
+        if any(r.get('type') == 'end' for r in records):
+            raise FileNotFoundError('The last run completed; there is '
+                                    'nothing to resume.')
+        journal = cls(path)
+        for record in records:
+            if record.get('type') == 'run':
+                journal.args = record['args']
+            elif record.get('type') == 'job':
+                journal.records.append(record)
+        journal._f = open(journal.path, 'a')
+        if lines[-1]:
+            # Keep the next record off the torn line.
+            journal._f.write('\n')
+        journal._write({'type': 'resume', 'time': time.time(),
+                        'pid': os.getpid()})
+        return journal
+
+    def restore(self, args: argparse.Namespace) -> argparse.Namespace:
+        restored = argparse.Namespace(**self.args)
+        for k in RESTORED_ARGS:
+            setattr(restored, k, getattr(args, k, None))
+        return restored
+
+    def _write(self, record: dict) -> None:
+        with self._lock:
+            self._f.write(json.dumps(record) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def record(self,
+               file: str,
+               server: str,
+               status: str,
+               links: list = None,
+               error: Optional[str] = None) -> None:
+        record = {
+            'type': 'job',
+            'input': str(file),
+            'server': server,
+            'status': status,
+            'links': links or [],
+            'error': error,
+            'time': time.time()
+        }
+        self._write(record)
+        with self._lock:
+            self.records.append(record)
+
+    def done(self, file: str, server: str) -> bool:
+        with self._lock:
+            return any(r['input'] == str(file) and r['server'] == server
+                       and r['status'] == 'ok' for r in self.records)
+
+    def finished(self) -> list:
+        # (input, link) pairs of every job that completed, in order.
+        with self._lock:
+            return [(r['input'], link) for r in self.records
+                    if r['status'] == 'ok' for link in r['links']]
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._write({'type': 'end', 'time': time.time()})
+            self._f.close()
+            self._f = None
@@ -2,65 +2,39 @@
 # coding: utf-8
 
 import argparse
+import asyncio
 import json
-import multiprocessing
 import os
 import shutil
-import signal
-import socket
 import sys
-import tarfile
 import time
 from pathlib import Path
-from typing import Union, NoReturn
+from typing import Union
 
 from dracula import DraculaPalette as Dp
 from rich.panel import Panel
 
-from pymirror.api_upload import APIUpload
+from pymirror import tracing
+from pymirror.api import stream
 from pymirror.config import config
-from pymirror.experimental.more_links import MoreLinks
 from pymirror.handlers import keyboardInterruptHandler
-from pymirror.helpers import Shared, console, logger, load_data
-from pymirror.mirroredto import Mirroredto
-from pymirror.multiup import MultiUp
+from pymirror.health import check_status
+from pymirror.helpers import console, logger, load_data
+from pymirror.journal import Journal
+from pymirror.results import Result, Results, ndjson
 
 
 class PyMirror:
+    # The command line front end: it reads the options, shows the results
+    # of `pymirror.api.stream` as they come and formats them at the end.
 
     def __init__(self, args: argparse.Namespace) -> None:
         self.args = args
         self.data = load_data()
         self.config = config()
+        self.results = Results()
 
-    @staticmethod
-    def initializer() -> NoReturn:
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    def tgz(self) -> str:
-        out_file = f'{Path(self.args.input).parent}/' \
-                   f'{Path(self.args.input).name}.tar.gz '
-        with tarfile.open(out_file, 'w:gz') as t:
-            t.add(self.args.input, arcname=Path(self.args.input).name)
-        return out_file
-
-    def return_ips(self) -> list:
-        ips = []
-        for k, _ in self.data.items():
-            try:
-                server = self.data[k]['server'].split('/')[2]
-            except IndexError:
-                server = self.data[k]['server']
-            ip = socket.gethostbyname(server)
-            ips.append((ip, k))
-        return ips
-
-    def style_output(self,
-                     links_list: Union[list, str] = None) -> Union[list, str]:
-        if isinstance(links_list, str):
-            links_list = [x for x in links_list.split('\n') if x != '']
-        if links_list is None:
-            links_list = Shared.all_links
+    def _style(self, links_list: list) -> Union[list, str]:
         links_dict = {}
         for link in links_list:
             try:
@@ -75,30 +49,142 @@ class PyMirror:
                 continue
         names = list(links_dict.keys())
         links = list(links_dict.values())
+        # Links that failed `--verify` are marked in every style.
+        broken = self.results.broken
+
+        def plain(link: str) -> str:
+            if link in broken:
+                return f'{link} [broken: {broken[link]}]'
+            return link
+
+        def struck(text: str, link: str) -> str:
+            return f'~~{text}~~ (broken: {broken[link]})' if (
+                link in broken) else text
+
         style = self.args.style
         if style == 'list':
-            output = links
+            output = [plain(link) for link in links]
         elif style == 'markdown':
-            output = '\n'.join(
-                [f'- [{name}]({link})' for name, link in zip(names, links)])
+            output = '\n'.join([
+                f'- {struck(f"[{name}]({link})", link)}'
+                for name, link in zip(names, links)
+            ])
         elif style == 'reddit':
-            output = ' | '.join(
-                [f'[Mirror {n + 1}]({link})' for n, link in enumerate(links)])
+            output = ' | '.join([
+                struck(f'[Mirror {n + 1}]({link})', link)
+                for n, link in enumerate(links)
+            ])
+        elif style == 'ndjson':
+            output = '\n'.join([
+                json.dumps({
+                    'server': name,
+                    'link': link,
+                    **({
+                        'status': 'broken',
+                        'error': broken[link]
+                    } if link in broken else {})
+                }) for name, link in zip(names, links)
+            ])
         else:
-            output = '\n'.join(links)
+            output = '\n'.join([plain(link) for link in links])
         return output
 
+    def style_output(self,
+                     links_list: Union[list, str, dict] = None
+                     ) -> Union[list, str, dict]:
+        if isinstance(links_list, str):
+            links_list = [x for x in links_list.split('\n') if x != '']
+        if links_list is None:
+            if len(self.results.links_by_file) > 1:
+                links_list = self.results.links_by_file
+            else:
+                links_list = self.results.all_links
+        if not isinstance(links_list, dict):
+            return self._style(links_list)
+
+        # Inputs go by their file name, or by their path as given when
+        # another input has the same name (e.g. `-i '*/README.md'`).
+        names = [Path(file).name for file in links_list]
+        grouped = {
+            name if names.count(name) == 1 else str(file): self._style(links)
+            for name, (file, links) in zip(names, links_list.items())
+        }
+        style = self.args.style
+        if style == 'list':
+            return grouped
+        elif style == 'markdown':
+            return '\n\n'.join(
+                [f'### {name}\n\n{out}' for name, out in grouped.items()])
+        elif style == 'reddit':
+            return '\n\n'.join(
+                [f'**{name}**: {out}' for name, out in grouped.items()])
+        elif style == 'ndjson':
+            return '\n'.join([
+                json.dumps({'input': name, **json.loads(line)})
+                for name, out in grouped.items() for line in out.split('\n')
+                if line
+            ])
+        return '\n\n'.join(
+            [f'{name}\n{out}' for name, out in grouped.items()])
+
+    def _recover(self, journal: Journal) -> None:
+        finished = journal.finished()
+        for file, link in finished:
+            self.results.add(file, link)
+        console.print(f'Resuming: recovered {len(finished)} links from the '
+                      'interrupted run.', style='#f1fa8c')
+
+    @staticmethod
+    def show(result: Result) -> None:
+        if result.status == 'ok':
+            console.print(f'[[{Dp.g}] OK [/{Dp.g}]]', result.link)
+            logger.info(f'[ OK ] {result.link}')
+        elif result.status == 'broken':
+            console.print(f'[[{Dp.r}] BROKEN [/{Dp.r}]]', result.link,
+                          f'({result.error})')
+            logger.warning(f'[ BROKEN ] {result.link} ({result.error})')
+
+    async def _consume(self, journal: Journal, servers: list = None) -> None:
+        show = ndjson() if self.args.style == 'ndjson' else self.show
+        async for result in stream(self.args, self.results, servers,
+                                   journal):
+            show(result)
+
+    def _profile(self, tracer: tracing.Tracer) -> None:
+        trace = f'{self.config["project_path"]}/trace.json'
+        metrics = f'{self.config["project_path"]}/pymirror.prom'
+        tracer.write_json(trace)
+        tracer.write_prometheus(metrics)
+        console.print(tracer.table())
+        console.print(f'Trace: {trace}\nMetrics: {metrics}')
+        tracing.disable()
+
     def uploader(self) -> Union[list, str]:
         start_time = time.time()
-        signal.signal(signal.SIGINT, keyboardInterruptHandler)
+        tracer = None
+        if getattr(self.args, 'profile', False):
+            tracer = tracing.enable()
+        streaming = self.args.style == 'ndjson'
+        if streaming:
+            # Records go to stdout as they happen; everything meant for
+            # people goes to stderr.
+            console.stderr = True
+
+        if getattr(self.args, 'resume', False):
+            try:
+                journal = Journal.resume()
+            except FileNotFoundError as e:
+                console.print(str(e), style='#ff5555')
+                sys.exit(1)
+            self.args = journal.restore(self.args)
+            self._recover(journal)
+        else:
+            journal = Journal.start(self.args)
 
         if self.args.experimental and not self.args.more_links:
             raise Exception('You need to add the `--more-links` flag to use '
                             '`--experimental`')
 
-        with open(f'{self.config["data_path"]}/servers_data.json') as j:
-            data = json.load(j)
-
         if self.args.log:
             logger.remove()
             logger.add(self.config['log_file'], level='DEBUG')
@@ -106,54 +192,46 @@ class PyMirror:
 
         console.print('Press `CTRL+C` at any time to quit.', style='#f1fa8c')
 
+        servers = None
         if self.args.check_status:
             console.rule('Checking servers status...')
-            ips = self.return_ips()
-            cpus = multiprocessing.cpu_count() - 1
-            with multiprocessing.Pool(cpus, initializer=self.initializer) as p:
-                responses = p.map(APIUpload.ping, ips)
-        else:
-            responses = []
+            responses = check_status(self.data)
+            servers = [k for k, up in zip(self.data, responses) if up]
 
         console.rule('Uploading...')
 
-        file = self.args.input
-        if not Path(file).exists():
-            raise FileNotFoundError('If you are sure the path is correct, '
-                                    'rename the file removing any illegal '
-                                    'characters, then try again.')
-        if Path(file).is_dir():
-            file = self.tgz()
+        try:
+            asyncio.run(self._consume(journal, servers))
+        except KeyboardInterrupt:
+            # The run has been cancelled and its browsers quit by now.
+            keyboardInterruptHandler()
 
-        if len(responses) == 0:
-            responses = [True] * len(data.keys())
-
-        APIUpload(self.data, self.args).api_uploads(responses)
-
-        if self.args.more_links:
-            Mirroredto(self.args).upload()
-            MultiUp(self.args).upload()
-            if self.args.experimental:
-                MoreLinks(self.args).upload_to_all_()
+        if self.args.more_links and self.args.log:
+            from pymirror import waits
+            waits.report()
+        journal.close()
 
         output = self.style_output()
 
         if self.args.delete:
-            if Path(self.args.input).is_dir():
-                shutil.rmtree(self.args.input)
-            else:
-                os.remove(file)
-        if Path(file).suffixes == ['.tar', '.gz']:
-            os.remove(file)
-        console.rule(f'Results: {len(Shared.all_links)}')
-        print(output)
-        os.rename(file, file)
-        for x in Shared.all_links:
+            for path in self.args.inputs:
+                if Path(path).is_dir():
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        console.rule(f'Results: {len(self.results.all_links)}')
+        if not streaming:
+            print(output)
+        for x in self.results.all_links:
             logger.info(x)
         run_time = time.strftime('%H:%M:%S',
                                  time.gmtime(time.time() - start_time))
         h, m, s = [int(_) for _ in run_time.split(':')]
         console.print(
             Panel.fit(f'[{Dp.k}]Process took[{Dp.k}] [{Dp.y}]{h}h {m}m {s}s'))
+        if tracer is not None:
+            self._profile(tracer)
         console.rule('END')
+        if streaming:
+            console.stderr = False
         return output
@@ -3,43 +3,70 @@
 
 import argparse
 import concurrent.futures
-import json
 import time
 from pathlib import Path
 
 from dracula import DraculaPalette as Dp
-from loguru import logger
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 
-from pymirror.config import config
-from pymirror.helpers import Shared, console, logger, selenium_exceptions
-from pymirror.start_driver import StartDrive
+from pymirror import tracing, waits
+from pymirror.config import config, upload_speed
+from pymirror.deadline import deadline_for
+from pymirror.helpers import console, selenium_exceptions
+from pymirror.registry import more_links
+from pymirror.results import Results
+from pymirror.scheduler import LinkBudget, link_budget
+from pymirror.start_driver import DriverPool, get_pool
+
+HOME = 'https://www.mirrored.to/'
+FILE_INPUT = '#uploadifive-html_file_upload > input[type=file]:nth-child(3)'
 
 
 class Mirroredto:
 
-    def __init__(self, args: argparse.Namespace):
+    def __init__(self,
+                 args: argparse.Namespace,
+                 budget: LinkBudget = None,
+                 results: Results = None,
+                 pool: DriverPool = None):
         self.args = args
         self.config = config()
+        self.budget = budget or link_budget(args)
+        self.results = results or Results()
+        self.pool = pool
+        self.limits = more_links()['mirroredto']
+
+    def _mirroredto(self, pool: DriverPool) -> list:
+
+        def process(batch):
+            # A batch holds a slot of the link budget for every host it
+            # mirrors to while it runs, and keeps no more links than it got.
+            key = str(self.args.input)
+            if self.results.cancelled.is_set():
+                return
+            granted = self.budget.take(key, len(batch), wait=True)
+            if not granted:
+                return
+            links = []
+            start = time.time()
+            try:
+                with pool.lend() as driver, \
+                        tracing.span('batch', server='mirroredto'):
+                    links = _process(driver, batch, start, granted) or []
+            finally:
+                self.budget.settle(key, granted, len(links))
+            return links
 
-    def _mirroredto(self, drivers: list) -> list:
-
-        def process(driver, batch):
-            file_size = Path(self.args.input).stat().st_size / 1e+6
-            with open(f'{self.config["data_path"]}/more_links.json') as j:
-                more_links = json.load(j)
+        def _process(driver, batch, start, granted):
+            size = Path(self.args.input).stat().st_size
+            file_size = size / 1e+6
 
-            local_limit = len(Shared.all_links)
             mirroredto_links = []
             try:
-                if self.args.number:
-                    if local_limit >= int(self.args.number):
-                        return
-                    local_limit += 1
-                time.sleep(2)
-                driver.get('https://www.mirrored.to/')
-                time.sleep(5)
+                driver.get(HOME)
+                file_input = waits.element(driver, By.CSS_SELECTOR,
+                                           FILE_INPUT)
                 html = driver.find_element(By.TAG_NAME, 'html')
                 _ = [html.send_keys(Keys.ARROW_DOWN) for _ in range(3)]
 
@@ -47,44 +74,29 @@ class Mirroredto:
                     try:
                         if len(batch) > 8 and x == 'GoFileIo':
                             driver.find_element(By.ID, x.lower()).click()
-                        elif more_links['mirroredto'][x]['limit'] \
-                                > file_size:
+                        elif self.limits[x]['limit'] > file_size:
                             driver.find_element(By.ID, x.lower()).click()
                     except selenium_exceptions as e:
                         # console.print(SeleniumExceptionInfo(e))
                         continue
 
-                time.sleep(2)
                 resolved_file = str(Path(self.args.input).resolve())
-                driver.find_element(
-                    By.CSS_SELECTOR, '#uploadifive-html_file_upload > '
-                    'input[type=file]:nth-child(3)').send_keys(resolved_file)
-                time.sleep(1)
-
-                driver.find_element(By.ID, 'upload_button').click()
-                time.sleep(5)
-
-                while True:
-                    if driver.current_url != 'https://www.mirrored.to/':
-                        time.sleep(1)
-                        break
-
-                link = driver.find_element(By.CLASS_NAME, 'mlink').text
+                file_input.send_keys(resolved_file)
+                waits.clickable(driver, By.ID, 'upload_button').click()
+                waits.url_changes(driver,
+                                  HOME,
+                                  timeout=deadline_for(
+                                      file_size, upload_speed()))
+
+                link = waits.text(driver, By.CLASS_NAME, 'mlink')
                 driver.get(link)
-                time.sleep(2)
-                driver.find_element(By.CLASS_NAME, 'secondary').click()
-                time.sleep(2)
-
-                start = time.time()
-
-                while True:
-                    time.sleep(5)
-                    status = [
-                        x.text for x in driver.find_elements(
-                            By.CLASS_NAME, 'id_Success')
-                    ]
-                    if len(status) >= 8 or time.time() - start > 60:
-                        break
+                waits.clickable(driver, By.CLASS_NAME, 'secondary').click()
+                waits.elements(driver,
+                               By.CLASS_NAME,
+                               'id_Success',
+                               8,
+                               timeout=60,
+                               strict=False)
 
                 for x in driver.find_elements(By.CLASS_NAME, 'get_btn'):
                     try:
@@ -94,14 +106,16 @@ class Mirroredto:
 
                 current_window = driver.current_window_handle
                 for handle in driver.window_handles:
+                    if len(mirroredto_links) >= granted:
+                        break
                     driver.switch_to.window(handle)
                     try:
                         link = driver.find_element(By.CLASS_NAME,
                                                    'code_wrap').text
-                        Shared.all_links.append(link)
                         mirroredto_links.append(link)
-                        console.print(f'[[{Dp.g}] OK [/{Dp.g}]] {link}')
-                        logger.info(f'[ OK ] {link}')
+                        self.results.emit(self.args.input, 'mirroredto',
+                                          'ok', link, size,
+                                          time.time() - start)
                         if handle != current_window:
                             driver.close()
                     except selenium_exceptions:
@@ -111,10 +125,9 @@ class Mirroredto:
                 raise exception
 
             finally:
-                driver.quit()
                 if self.args.debug:
-                    console.print(f'[{Dp.y}]Closed driver instance spawned '
-                                  f'in {__file__}')
+                    console.print(f'[{Dp.y}]Returned driver instance to the '
+                                  f'pool in {__file__}')
             return mirroredto_links
 
         first_batch = [
@@ -134,21 +147,12 @@ class Mirroredto:
 
         with concurrent.futures.ThreadPoolExecutor() as executor:
             mirroredto_urls = []
-            results = [
-                executor.submit(process, driver, batch)
-                for driver, batch in zip(drivers, batches)
-            ]
+            results = [executor.submit(process, batch) for batch in batches]
             for future in concurrent.futures.as_completed(results):
                 mirroredto_urls.append(future.result())
 
         return mirroredto_urls
 
     def upload(self, headless=True):
-        if self.args.debug:
-            driver = StartDrive(cur_module=Path(__file__).name).start_driver
-            drivers = [driver(headless)]
-        else:
-            driver = StartDrive(None).start_driver
-            drivers = [driver(headless), driver(headless)]
-        mirroredto_urls = self._mirroredto(drivers)
+        mirroredto_urls = self._mirroredto(self.pool or get_pool(headless))
         return mirroredto_urls
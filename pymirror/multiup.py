@@ -3,37 +3,137 @@
 
 import argparse
 import json
-import shlex
-import subprocess
 import time
+from html.parser import HTMLParser
 from pathlib import Path
 from typing import Union, Optional
 
 from dracula import DraculaPalette as Dp
-from selenium.webdriver.common.by import By
 
+from pymirror import tracing
 from pymirror.config import config
-from pymirror.helpers import Shared, console
-from pymirror.start_driver import StartDrive
+from pymirror.deadline import check as check_deadline
+from pymirror.helpers import console
+from pymirror.registry import more_links
+from pymirror.results import Results
+from pymirror.scheduler import LinkBudget, link_budget
+from pymirror.transport import TransportError, get_transport
+
+MIRROR_TIMEOUT = 120
+MIN_POLL = 1
+MAX_POLL = 10
+BACKOFF = 1.5
+VOID_TAGS = {'area', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+             'meta', 'source', 'wbr'}
+# Words in the status of a host whose mirror failed for good.
+ERRORS = ('error', 'failed', 'unavailable')
+
+
+class HostParser(HTMLParser):
+    # The `host` elements of a multiup mirror page: each one's `link`
+    # attribute and text, which ends in `(0)` once the mirror is up.
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.hosts = []
+        self._depth = 0
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag in VOID_TAGS:
+            return
+        if self._depth:
+            self._depth += 1
+            return
+        attrs = dict(attrs)
+        if 'host' in (attrs.get('class') or '').split():
+            self.hosts.append({'link': attrs.get('link'), 'text': ''})
+            self._depth = 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if self._depth and tag not in VOID_TAGS:
+            self._depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self._depth:
+            self.hosts[-1]['text'] += data
+
+
+def parse_hosts(page: str) -> list:
+    parser = HostParser()
+    parser.feed(page)
+    parser.close()
+    return parser.hosts
+
+
+def final(host: dict) -> bool:
+    # The mirror is up (`(0)`) or failed; anything else is still uploading.
+    text = host['text'].lower()
+    return '(0)' in text or any(e in text for e in ERRORS)
+
+
+def reported(hosts: list, names: list) -> int:
+    # How many of the hosts called `names` are listed with a final status.
+    return sum(
+        any(name.lower() in (h['text'] + (h['link'] or '')).lower()
+            and final(h) for h in hosts) for name in names)
+
+
+def poll_mirrors(transport,
+                 url: str,
+                 names: list,
+                 timeout: float = MIRROR_TIMEOUT) -> list:
+    # Polls the mirror page until every host in `names` has reported (its
+    # mirror is up or failed), or `timeout` runs out. The delay grows while
+    # nothing changes and drops back when a host reports.
+    hosts = []
+    done = 0
+    delay = MIN_POLL
+    end = time.monotonic() + timeout
+    while True:
+        check_deadline()
+        try:
+            page = transport.get(url).decode('UTF-8', 'replace')
+        except TransportError:
+            page = None
+        if page is not None:
+            hosts = parse_hosts(page)
+            now_done = reported(hosts, names)
+            if now_done > done:
+                delay = MIN_POLL
+            else:
+                delay = min(delay * BACKOFF, MAX_POLL)
+            done = now_done
+        if done >= len(names) or time.monotonic() >= end:
+            return hosts
+        time.sleep(min(delay, max(end - time.monotonic(), 0)))
 
 
 class MultiUp:
 
-    def __init__(self, args: argparse.Namespace):
+    def __init__(self,
+                 args: argparse.Namespace,
+                 budget: LinkBudget = None,
+                 results: Results = None):
         self.args = args
         self.config = config()
+        self.budget = budget or link_budget(args)
+        self.results = results or Results()
 
-    def _multiup(self, driver) -> Optional[list]:
+    def _multiup(self) -> Optional[list]:
 
-        def cURL_request(url: str) -> Union[None, dict]:
-            curl = shlex.split(url)
+        transport = get_transport(getattr(self.args, 'transport', 'native'))
+
+        def request(url: str, **kwargs) -> Union[None, dict]:
             try:
-                out = subprocess.run(curl, stdout=subprocess.PIPE, check=True)
-            except subprocess.CalledProcessError:
+                if kwargs:
+                    out = transport.upload(url, self.args.input, **kwargs)
+                else:
+                    out = transport.get(url)
+            except TransportError:
                 console.print(f'{Dp.r}Encountered an unexpected issue with '
                               'multiup')
                 return
-            res = out.stdout.decode('UTF-8').replace('\\', '')
+            res = out.decode('UTF-8').replace('\\', '')
             try:
                 res = json.loads(res)
             except json.JSONDecodeError as error:
@@ -41,78 +141,53 @@ class MultiUp:
             return res
 
         multiup_links = []
+        start = time.time()
 
-        with open(f'{self.config["data_path"]}/more_links.json') as j:
-            more_links = json.load(j)
-
-        server = cURL_request(
-            'curl -s https://www.multiup.org/api/get-fastest-server')['server']
+        server = request(
+            'https://www.multiup.org/api/get-fastest-server')['server']
         selected_hosts_lst = [
             'filerio.in', 'drop.download', 'download.gg', 'uppit.com',
             'uploadbox.io'
         ]
-        limit_n = len(Shared.all_links)
-        file_size = Path(self.args.input).stat().st_size / 1e+6
-        for x in selected_hosts_lst:
-            if self.args.number and int(self.args.number) <= limit_n:
-                selected_hosts_lst.remove(x)
-                continue
-            if file_size > more_links['multiup'][x]['limit']:
-                selected_hosts_lst.remove(x)
-            else:
-                limit_n += 1
+        size = Path(self.args.input).stat().st_size
+        file_size = size / 1e+6
+        limits = more_links()['multiup']
+        selected_hosts_lst = [
+            x for x in selected_hosts_lst if file_size <= limits[x]['limit']
+        ]
+        key = str(self.args.input)
+        granted = self.budget.take(key, len(selected_hosts_lst), wait=True)
+        selected_hosts_lst = selected_hosts_lst[:granted]
         if not selected_hosts_lst:
             return
 
-        if self.args.debug:
-            s = ''
-        else:
-            s = 's'
-        selected_hosts = ' '.join([f'-F {x}=true' for x in selected_hosts_lst])
-        upload = cURL_request(
-            f'curl -{s}F "files[]=@{self.args.input}" {selected_hosts}'
-            f' {server}')
-        if len(upload['files']) == 0:
-            upload = cURL_request(f'curl -{s}F "files[]=@{self.args.input}" '
-                                  f'{server}')
-        link = upload['files'][0]['url'].replace('download', 'en/mirror')
-        driver.get(link)
-
-        i = 0
-        j = 0
-        es_len = None
-        elements = []
-
-        while True:
-            time.sleep(2)
-            if es_len != len(elements):
-                j = 0
-            driver.refresh()
-            elements = driver.find_elements(By.CLASS_NAME, 'host')
-            es_len = len(elements)
-            if es_len == 2:
-                i += 1
-            else:
-                j += 1
-            if (j > i + 10) or (len(elements) == len(selected_hosts_lst) + 1):
-                break
-
-        for e in elements:
-            if '(0)' in e.text:
-                link = e.get_attribute('link')
-                Shared.all_links.append(link)
-                multiup_links.append(link)
-                console.print(f'[[{Dp.g}] OK [/{Dp.g}]]', link)
-
-        driver.quit()
+        try:
+            upload = request(server,
+                             field='files[]',
+                             fields={x: 'true'
+                                     for x in selected_hosts_lst})
+            if len(upload['files']) == 0:
+                upload = request(server, field='files[]')
+            link = upload['files'][0]['url'].replace('download', 'en/mirror')
+            with tracing.span('mirror status', server='multiup'):
+                hosts = poll_mirrors(transport, link, selected_hosts_lst)
+
+            for host in hosts:
+                if '(0)' in host['text'] and host['link']:
+                    link = host['link']
+                    multiup_links.append(link)
+                    self.results.emit(self.args.input, 'multiup', 'ok', link,
+                                      size, time.time() - start)
+                else:
+                    self.results.emit(self.args.input, 'multiup', 'failed',
+                                      None, size, time.time() - start,
+                                      host['text'].strip())
+        finally:
+            self.budget.settle(key, granted, len(multiup_links))
 
         return multiup_links
 
     def upload(self, headless=True):
-        if self.args.debug:
-            driver = StartDrive(
-                cur_module=Path(__file__).name).start_driver(headless)
-        else:
-            driver = StartDrive(None).start_driver()
-        multiup_links = self._multiup(driver)
+        # `headless` is kept for compatibility; no browser is needed.
+        multiup_links = self._multiup()
         return multiup_links
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import bisect
+import json
+import mimetypes
+import sys
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+from pymirror.config import config
+from pymirror.transport import from_flags
+
+# Hosts that only take audio, video and images (unless the `media_only`
+# field of their entry says otherwise).
+MEDIA_ONLY = {'midi'}
+MEDIA = {'audio', 'video', 'image'}
+# Hours a link is reused for when an entry does not say: never, since it
+# may be a single-download host (copies of `servers_data.json` from before
+# `expires` existed have none).
+DEFAULT_EXPIRES = 0
+
+
+class InvalidServer(ValueError):
+    pass
+
+
+def _oshi(text: str) -> Optional[str]:
+    # `MANAGE: <url>` and `DL: <url>` lines.
+    for line in text.split('\n'):
+        if line.startswith('DL: '):
+            return line[len('DL: '):]
+    return None
+
+
+# Hosts that answer with text the link has to be picked out of.
+TEXT_LINKS = {'oshi': _oshi}
+
+
+def compile_keys(keys: list) -> Callable[[object], object]:
+    # Follows the `keys` path of an entry (dict keys and list indexes) into
+    # a parsed reply; `None` as soon as a step is missing.
+    keys = tuple(keys)
+
+    def extract(value: object) -> object:
+        for key in keys:
+            if isinstance(key, int):
+                if not isinstance(value, list) or not (-len(value) <= key
+                                                       < len(value)):
+                    return None
+            elif not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    return extract
+
+
+def link_extractor(key: str, keys: list) -> Callable[[bytes], Optional[str]]:
+    # The link in the reply of host `key`: at the end of its `keys` path
+    # when it answers with JSON, otherwise the whole text or the part of it
+    # `TEXT_LINKS` picks out.
+    path = compile_keys(keys)
+    text = TEXT_LINKS.get(key)
+
+    def extract(out: bytes) -> Optional[str]:
+        if keys:
+            try:
+                link = path(json.loads(out))
+            except ValueError:
+                return None
+            return link if isinstance(link, str) else None
+        out = out.decode('UTF-8').strip('\n')
+        return text(out) if text is not None else out
+
+    return extract
+
+
+class Server(NamedTuple):
+    key: str
+    url: str
+    keys: tuple
+    flags: str
+    parameter: str
+    # MB
+    limit: float
+    # Hours a link stays valid; `None` for never, 0 to never reuse it.
+    expires: Optional[float]
+    # Known to serve a link once only: an explicit `expires` of 0 or
+    # `single_download`, not an entry that does not say.
+    single_download: bool
+    chunked: bool
+    media_only: bool
+    # The request the native transport sends, or `None` for curl.
+    spec: Optional[dict]
+    extract: Callable[[bytes], Optional[str]]
+
+
+def _number(value: object) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compile_server(key: str, entry: dict) -> Server:
+    # Checks an entry of `servers_data.json` and turns it into a `Server`.
+    if isinstance(entry, Server):
+        return entry
+    if not isinstance(entry, dict):
+        raise InvalidServer(f'{key}: expected an object, not {entry!r}')
+    url = entry.get('server')
+    if not isinstance(url, str) or not url.startswith(('http://',
+                                                       'https://')):
+        raise InvalidServer(f'{key}: `server` must be an http(s) URL')
+    keys = entry.get('keys', [])
+    if not isinstance(keys, list) or not all(
+            isinstance(k, (str, int)) and not isinstance(k, bool)
+            for k in keys):
+        raise InvalidServer(f'{key}: `keys` must be a list of object keys '
+                            'and list indexes')
+    for field in ['flags', 'parameter']:
+        if not isinstance(entry.get(field), str):
+            raise InvalidServer(f'{key}: `{field}` must be a string')
+    limit = entry.get('limit')
+    if not _number(limit) or limit <= 0:
+        raise InvalidServer(f'{key}: `limit` must be a positive number '
+                            '(MB)')
+    expires = entry.get('expires', DEFAULT_EXPIRES)
+    if expires is not None and (not _number(expires) or expires < 0):
+        raise InvalidServer(f'{key}: `expires` must be a number of hours '
+                            'or null')
+    single_download = entry.get('single_download', 'expires' in entry
+                                and expires == 0)
+    chunked = entry.get('chunked', False)
+    media_only = entry.get('media_only', key in MEDIA_ONLY)
+    if not all(
+            isinstance(x, bool)
+            for x in [single_download, chunked, media_only]):
+        raise InvalidServer(f'{key}: `single_download`, `chunked` and '
+                            '`media_only` must be true or false')
+    return Server(key, url, tuple(keys), entry['flags'], entry['parameter'],
+                  float(limit), expires, single_download, chunked,
+                  media_only,
+                  from_flags(entry['flags'], entry['parameter']),
+                  link_extractor(key, keys))
+
+
+def mime_class(name: str) -> str:
+    # `media` (audio, video, images), `other`, or `unknown` when the type
+    # cannot be told from the name.
+    mime = mimetypes.guess_type(name)[0]
+    if mime is None:
+        return 'unknown'
+    return 'media' if mime.split('/')[0] in MEDIA else 'other'
+
+
+class Registry(Mapping):
+    # The hosts of `servers_data.json`, checked and compiled once, in their
+    # original order. `eligible` answers which of them can take a file from
+    # an index by size limit and MIME class, without going over every host.
+
+    def __init__(self, data: Mapping) -> None:
+        self._servers = {k: compile_server(k, v) for k, v in data.items()}
+        # No entry says how long its links last, as in copies of
+        # `servers_data.json` from before `expires` existed.
+        self.undated = bool(data) and not any(
+            isinstance(v, dict) and ('expires' in v or 'single_download' in v)
+            for v in data.values())
+        # One tuple per distinct size limit: the hosts that take at least
+        # that much, for each MIME class.
+        self._limits = sorted({s.limit for s in self._servers.values()})
+        self._index = {
+            cls: [
+                tuple(k for k, s in self._servers.items()
+                      if s.limit >= limit and not (s.media_only
+                                                   and cls == 'other'))
+                for limit in self._limits
+            ]
+            for cls in ['media', 'other', 'unknown']
+        }
+
+    def __getitem__(self, key: str) -> Server:
+        return self._servers[key]
+
+    def __iter__(self):
+        return iter(self._servers)
+
+    def __len__(self) -> int:
+        return len(self._servers)
+
+    def eligible(self, name: str, size: float) -> tuple:
+        # The hosts that take a file called `name` of `size` MB.
+        i = bisect.bisect_left(self._limits, size)
+        if i == len(self._limits):
+            return ()
+        return self._index[mime_class(name)][i]
+
+    def subset(self, keys: list) -> 'Registry':
+        subset = Registry({k: s for k, s in self.items() if k in keys})
+        subset.undated = self.undated
+        return subset
+
+
+def registry(data: Mapping) -> Registry:
+    # `data` as a `Registry`, compiled only if it is not one already.
+    return data if isinstance(data, Registry) else Registry(data)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _cached(path: str, build: Callable[[dict], object]) -> object:
+    # Parsed once, and again only when the file changes.
+    stamp = Path(path).stat().st_mtime_ns
+    with _cache_lock:
+        if path in _cache and _cache[path][0] == stamp:
+            return _cache[path][1]
+    with open(path) as j:
+        value = build(json.load(j))
+    with _cache_lock:
+        _cache[path] = (stamp, value)
+    return value
+
+
+def _registry(data: dict) -> Registry:
+    servers = Registry(data)
+    if servers.undated:
+        # Once per change of the file, as it is only parsed then. Not on
+        # stdout, which may carry an NDJSON stream.
+        print('servers_data.json does not say how long links last, so none '
+              'are reused; run `pymirror --refresh-config` to update it.',
+              file=sys.stderr)
+    return servers
+
+
+def load(path: str = None) -> Registry:
+    return _cached(path or f'{config()["data_path"]}/servers_data.json',
+                   _registry)
+
+
+def more_links(path: str = None) -> dict:
+    # The size limits of the hosts behind the browser-based providers.
+    return _cached(path or f'{config()["data_path"]}/more_links.json',
+                   lambda data: data)
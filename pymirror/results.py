@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import contextlib
+import json
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, TextIO
+
+
+class Result(NamedTuple):
+    # One finished job: a link (`status` is `ok`) or a failed, timed out or
+    # crashed upload.
+    input: str
+    server: str
+    status: str
+    link: Optional[str] = None
+    bytes: Optional[int] = None
+    duration: Optional[float] = None
+    error: Optional[str] = None
+    time: float = 0
+
+
+class Results:
+    # Everything one run produces, owned by that run: its links (all of
+    # them and per input) and a `Result` for every finished job, passed to
+    # `listener` as soon as it happens. Cancelling the run calls the cancel
+    # hooks of the jobs that are still running.
+
+    def __init__(self, listener: Callable[[Result], None] = None) -> None:
+        self.all_links = []
+        self.links_by_file = {}
+        # The server of each link, and why a link failed verification.
+        self.servers = {}
+        self.broken = {}
+        self.listener = listener
+        self.cancelled = threading.Event()
+        self._cancels = []
+        self._lock = threading.Lock()
+
+    def add(self, file: str, link: str) -> None:
+        with self._lock:
+            self.all_links.append(link)
+            self.links_by_file.setdefault(str(file), []).append(link)
+
+    def emit(self,
+             file: str,
+             server: str,
+             status: str,
+             link: Optional[str] = None,
+             size: Optional[int] = None,
+             duration: Optional[float] = None,
+             error: Optional[str] = None) -> Result:
+        result = Result(str(file), server, status, link, size,
+                        None if duration is None else round(duration, 3),
+                        error, time.time())
+        self.record(result)
+        if self.listener is not None:
+            self.listener(result)
+        return result
+
+    def record(self, result: Result) -> None:
+        # Keeps what `result` says about its link; also for results that
+        # come from elsewhere, e.g. the daemon.
+        if not result.link:
+            return
+        if result.status == 'ok':
+            self.add(result.input, result.link)
+            self.servers[result.link] = result.server
+        elif result.status == 'broken':
+            self.broken[result.link] = result.error or 'broken'
+
+    @contextlib.contextmanager
+    def cancelling(self, fn: Callable[[], None]):
+        # Calls `fn` if the run is cancelled while the block runs.
+        with self._lock:
+            cancelled = self.cancelled.is_set()
+            if not cancelled:
+                self._cancels.append(fn)
+        if cancelled:
+            fn()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if fn in self._cancels:
+                    self._cancels.remove(fn)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled.set()
+            cancels, self._cancels = self._cancels, []
+        for fn in cancels:
+            try:
+                fn()
+            except Exception:  # noqa
+                continue
+
+
+def ndjson(out: TextIO = None) -> Callable[[Result], None]:
+    # A listener that writes each result to `out` (stdout by default) as
+    # one line of JSON, flushed right away.
+    lock = threading.Lock()
+
+    def write(result: Result) -> None:
+        with lock:
+            stream = out or sys.stdout
+            stream.write(json.dumps(result._asdict()) + '\n')
+            stream.flush()
+
+    return write
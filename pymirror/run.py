@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-# import sys
+import sys
 # from pathlib import Path
 
 from pymirror.cli import cli
 from pymirror.main import PyMirror
 from pymirror.helpers import kill_firefox_zombies
 
+# `pymirror <command>`: the module and function that run it.
+COMMANDS = {
+    'serve': ('pymirror.daemon', 'serve_main'),
+    'submit': ('pymirror.daemon', 'submit_main'),
+    'coordinate': ('pymirror.distributed', 'coordinate_main'),
+    'worker': ('pymirror.distributed', 'worker_main'),
+    'watch': ('pymirror.watchdog', 'watch_main')
+}
+
 
 def main():
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        import importlib
+        module, func = COMMANDS[sys.argv[1]]
+        return getattr(importlib.import_module(module), func)(sys.argv[2:])
     args = cli()
     PyMirror(args).uploader()
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import threading
+import time
+from typing import Optional
+
+SMALL_JOB = 1.0
+HEADROOM = 0.95
+UNKNOWN_SHARE = 0.25
+
+
+class TokenBucket:
+    # Paces all uploads together to `rate` bytes per second. Consumers may
+    # overdraw the bucket and then sleep off the debt, so chunks larger
+    # than the burst size still go through.
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+class Slots(threading.BoundedSemaphore):
+    # The bandwidth slots large transfers wait for, `size` of them.
+
+    def __init__(self, size: int) -> None:
+        super().__init__(size)
+        self.size = size
+
+
+def capacity(upload_speed: Optional[float],
+             max_bandwidth: Optional[float] = None) -> Optional[float]:
+    # Usable uplink in MB/s: a little under the measured speed so the
+    # uploads do not queue up in the uplink, and never above the cap.
+    rates = [r for r in [upload_speed and upload_speed * HEADROOM,
+                         max_bandwidth] if r]
+    return min(rates) if rates else None
+
+
+def concurrency(rates: list,
+                uplink: Optional[float],
+                minimum: int = 2) -> int:
+    # How many large transfers it takes to fill the uplink, given each
+    # host's measured throughput (MB/s, `None` when unknown). A host we
+    # have not measured yet is assumed to take a quarter of the uplink.
+    if not rates:
+        return 0
+    if not uplink:
+        return len(rates)
+    rates = [min(r or uplink * UNKNOWN_SHARE, uplink) for r in rates]
+    n, total = 0, 0.0
+    for rate in sorted(rates, reverse=True):
+        n += 1
+        total += rate
+        if total >= uplink:
+            break
+    return max(n, min(minimum, len(rates)))
+
+
+class LinkBudget:
+    # The `--number` limit, shared by every stage of a run and kept per
+    # input file. A stage takes slots before it starts uploading and
+    # settles them with the number of links it actually made, so stages
+    # running at the same time never overshoot together. `limit=None`
+    # means no limit.
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self._used = {}
+        self._taken = {}
+        self._cond = threading.Condition()
+
+    def _free(self, key: str) -> int:
+        return (self.limit - self._used.get(key, 0) -
+                self._taken.get(key, 0))
+
+    def take(self, key: str, n: int = 1, wait: bool = False) -> int:
+        # Returns how many of the `n` slots were granted. With `wait`, an
+        # empty budget waits for slots still held by other stages, in case
+        # their uploads fail and give them back.
+        if self.limit is None:
+            return n
+        with self._cond:
+            while (wait and self._free(key) <= 0
+                   and self._taken.get(key, 0) > 0):
+                self._cond.wait()
+            granted = max(min(n, self._free(key)), 0)
+            self._taken[key] = self._taken.get(key, 0) + granted
+            return granted
+
+    def settle(self, key: str, taken: int, made: int) -> None:
+        with self._cond:
+            self._taken[key] = self._taken.get(key, 0) - taken
+            self._used[key] = self._used.get(key, 0) + made
+            self._cond.notify_all()
+
+    def full(self, key: str) -> bool:
+        if self.limit is None:
+            return False
+        with self._cond:
+            return self._used.get(key, 0) >= self.limit
+
+
+def link_budget(args) -> LinkBudget:
+    number = getattr(args, 'number', None)
+    return LinkBudget(int(number) if number else None)
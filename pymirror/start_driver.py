@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import contextlib
 import os
 import platform
 import shlex
 import subprocess
-import time
+import threading
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 from dracula import DraculaPalette as Dp
 from loguru import logger
@@ -17,15 +18,18 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options
 from webdriver_manager.firefox import GeckoDriverManager
 
+from pymirror import tracing, waits
 from pymirror.config import config
-from pymirror.helpers import Shared, console, selenium_exceptions
+from pymirror.helpers import console, selenium_exceptions
 
 
 class StartDrive:
 
-    def __init__(self, cur_module: Any = None) -> None:
+    def __init__(self, cur_module: Any = None, pids: list = None) -> None:
         self.cur_module = cur_module
         self.config = config()
+        # Firefox process ids, to kill them if the run is interrupted.
+        self.pids = [] if pids is None else pids
 
     def download_ublock(self) -> None:
         Path(Path(self.config['ublock']).parent).mkdir(exist_ok=True)
@@ -83,23 +87,185 @@ class StartDrive:
                           'Try again or remove the `--more-links` flag')
             raise se
 
-        ublock_exists = False
         driver.install_addon(self.config['ublock'], temporary=True)  # noqa
-        time.sleep(1)
         driver.get('about:support')
-        body = driver.find_element(By.ID, 'addons-tbody')
-        rows = body.find_elements(By.TAG_NAME, 'tr')
-        for row in rows:
-            cells = row.find_elements(By.TAG_NAME, 'td')
-            for cell in cells:
-                if 'uBlock' in cell.text:
-                    ublock_exists = True
+        ublock_exists = waits.until(
+            driver,
+            lambda d: 'uBlock' in d.find_element(By.ID, 'addons-tbody').text,
+            timeout=5,
+            label='uBlock installed',
+            strict=False)
         if not ublock_exists:
             logger.warning('Could not find uBlock. Will attempt to continue...')
 
         capabilities = driver.capabilities
         pid = capabilities['moz:processID']
-        Shared.pids.append(pid)
+        self.pids.append(pid)
         if self.cur_module is not None:
             console.print(f'Spawned a driver in {self.cur_module}: {pid}')
         return driver
+
+
+MAX_USES = 10
+POOL_SIZE = 2
+
+
+class DriverPool:
+    # Started, add-on-ready drivers lent to the browser providers. A driver
+    # goes back to the pool with its cookies, storage and extra tabs wiped,
+    # and is replaced after `max_uses` lends or when a job using it fails.
+
+    def __init__(self,
+                 size: int = POOL_SIZE,
+                 max_uses: int = MAX_USES,
+                 headless: bool = True,
+                 factory: Callable[[], Any] = None) -> None:
+        self.size = size
+        self.max_uses = max_uses
+        self.pids = []
+        self.factory = factory or (
+            lambda: StartDrive(None, self.pids).start_driver(headless))
+        self.started = 0
+        self._idle = []
+        self._lent = {}
+        self._uses = {}
+        self._live = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _start(self):
+        try:
+            with tracing.span('browser launch', server='firefox'):
+                driver = self.factory()
+        except BaseException:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.started += 1
+            self._uses[id(driver)] = 0
+        return driver
+
+    def _put(self, driver) -> None:
+        with self._cond:
+            if not self._closed:
+                self._idle.append(driver)
+                self._cond.notify()
+                return
+        self._discard(driver)
+
+    def _warm_one(self) -> None:
+        try:
+            driver = self._start()
+        except Exception as e:  # noqa
+            logger.warning(f'Could not start a driver in advance: {e}')
+            return
+        self._put(driver)
+
+    def warm(self, n: int = None) -> None:
+        # Start drivers in the background, so they are ready by the time a
+        # provider asks for one.
+        with self._cond:
+            n = max(min(n or self.size, self.size - self._live), 0)
+            self._live += n
+        for _ in range(n):
+            threading.Thread(target=self._warm_one, daemon=True).start()
+
+    def acquire(self):
+        with self._cond:
+            while not self._idle and self._live >= self.size:
+                self._cond.wait()
+            if self._idle:
+                driver = self._idle.pop()
+                self._lent[id(driver)] = driver
+                return driver
+            self._live += 1
+        driver = self._start()
+        with self._cond:
+            self._lent[id(driver)] = driver
+        return driver
+
+    def release(self, driver, broken: bool = False) -> None:
+        with self._cond:
+            self._lent.pop(id(driver), None)
+            self._uses[id(driver)] += 1
+            retire = (broken or self._closed
+                      or self._uses[id(driver)] >= self.max_uses)
+        if not retire:
+            try:
+                self.reset(driver)
+            except Exception:  # noqa
+                retire = True
+        if retire:
+            self._discard(driver)
+        else:
+            self._put(driver)
+
+    @staticmethod
+    def reset(driver) -> None:
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        # Storage and cookies are cleared for the site the provider was
+        # on; every provider finishes on its own site.
+        try:
+            driver.execute_script('window.localStorage.clear();'
+                                  'window.sessionStorage.clear();')
+        except selenium_exceptions:
+            pass
+        driver.delete_all_cookies()
+        driver.get('about:blank')
+
+    def _discard(self, driver) -> None:
+        try:
+            driver.quit()
+        except Exception:  # noqa
+            pass
+        with self._cond:
+            self._uses.pop(id(driver), None)
+            self._live -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def lend(self):
+        # A driver that crashed (or was quit by a deadline) fails the reset
+        # and is replaced.
+        driver = self.acquire()
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for driver in idle:
+            self._discard(driver)
+
+    def terminate(self) -> None:
+        # Close the pool and quit the drivers that are still lent out; the
+        # providers using them fail right away.
+        self.close()
+        with self._cond:
+            lent = list(self._lent.values())
+        for driver in lent:
+            try:
+                driver.quit()
+            except Exception:  # noqa
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(headless: bool = True, size: int = POOL_SIZE) -> DriverPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = DriverPool(size, headless=headless)
+    return _pool
@@ -1,17 +1,61 @@
+import argparse
+import asyncio
+import contextlib
+import gzip
+import http.server
+import io
+import json
+import multiprocessing
+import os
 import re
+import shutil
+import socket
+import subprocess
+import tarfile
 import sys
+import threading
+import time
 import unittest
 import warnings
 from pathlib import Path
 
 import psutil
 
+from pymirror.api import options, stream
 from pymirror.api_upload import APIUpload
-from pymirror.cli import cli
+from pymirror.cli import cli, expand_inputs
+from pymirror.archive import ArchiveStream, tar_blocks, write_archive
+from pymirror.bench import (BenchUpload, StandIns, bench, response,
+                            servers_data)
+from pymirror.catalogue import Catalogue, file_hash
+from pymirror.config import config
+from pymirror.daemon import Daemon, submit
+from pymirror.distributed import (JobQueue, SQLiteQueue, Worker, enqueue,
+                                  follow)
+from pymirror.deadline import (Deadline, DeadlineExceeded, HostStats,
+                               deadline_for)
+from pymirror.experimental.more_links import MoreLinks
+from pymirror.fanout import Rereadable, SharedFile
+from pymirror.health import probe_all
+from pymirror.journal import Journal
 from pymirror.helpers import load_data, kill_firefox_zombies
 from pymirror.main import PyMirror
 from pymirror.mirroredto import Mirroredto
-from pymirror.multiup import MultiUp
+from pymirror.multiup import MultiUp, parse_hosts, poll_mirrors
+from pymirror.registry import InvalidServer, Registry, load, registry
+from pymirror.results import Result, Results, ndjson
+from pymirror.scheduler import (LinkBudget, TokenBucket, capacity,
+                                concurrency)
+from pymirror.start_driver import DriverPool
+from pymirror.transport import CurlTransport, HTTPTransport, from_flags
+from pymirror.verify import verify
+from pymirror.watchdog import HostLimiter, Watchdog
+from pymirror import tracing, waits
+
+
+# Regression budget for `python -X importtime -c 'import pymirror.main'`, in
+# microseconds: about 3x what it takes now (~100 ms).
+IMPORT_BUDGET = 300000
 
 
 class Options:
@@ -86,6 +130,1180 @@ class PyMirrorTests(unittest.TestCase):
             self.assertEqual(pid_exists, False)
 
 
+def _server(name, **kwargs):
+    # A `servers_data.json` entry.
+    return {'server': f'https://{name}.example', 'keys': [], 'flags': '-sF',
+            'parameter': 'file=@', 'limit': 1, **kwargs}
+
+
+class SlowAPIUpload(APIUpload):
+    calls = 0
+
+    def curl(self, server, source=None, file=None):
+        SlowAPIUpload.calls += 1
+        time.sleep(0.3)
+        return f'https://{server}.example/foo.txt'
+
+
+class OfflineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+        self.data = {f'srv{n}': _server(f'srv{n}') for n in range(6)}
+
+    def tearDown(self):
+        self.foo.unlink()
+
+    def _args(self, options):
+        sys.argv[1:] = ['-i', str(self.foo)] + options
+        return cli()
+
+    def test_concurrent_api_uploads(self):
+        start = time.time()
+        links = SlowAPIUpload(self.data, self._args([])).api_uploads()
+        self.assertEqual(len(links), 6)
+        self.assertLess(time.time() - start, 1.2)
+
+    def test_concurrent_api_uploads_number(self):
+        args = self._args(['--number', '3', '--workers', '2'])
+        links = SlowAPIUpload(self.data, args).api_uploads()
+        self.assertEqual(sorted(links), [
+            f'https://srv{n}.example/foo.txt' for n in range(3)
+        ])
+
+    def test_catalogue_reuses_links(self):
+        data = {k: {**v, 'expires': 24} for k, v in self.data.items()}
+        data['srv5'] = _server('srv5', expires=0)
+        catalogue = Catalogue(':memory:')
+        first = SlowAPIUpload(data, self._args([]), catalogue).api_uploads()
+        calls = SlowAPIUpload.calls
+        second = SlowAPIUpload(data, self._args([]), catalogue).api_uploads()
+        self.assertEqual(sorted(first), sorted(second))
+        self.assertEqual(SlowAPIUpload.calls, calls + 1)
+        self.assertEqual(catalogue.fingerprint('foo.txt'), file_hash('foo.txt'))
+
+    def test_journal_resume(self):
+        path = 'test_journal.jsonl'
+
+        class Failing(SlowAPIUpload):
+
+            def curl(self, server, source=None, file=None):
+                if server == 'srv2':
+                    return None
+                return super().curl(server, source, file)
+
+        try:
+            args = self._args([])
+            journal = Journal.start(args, path)
+            Failing(self.data, args, journal=journal).api_uploads()
+            with open(path, 'a') as f:
+                f.write('{"type": "job", "inp')
+            journal = Journal.resume(path)
+            self.assertEqual(journal.restore(args).inputs, ['foo.txt'])
+            self.assertEqual(len(journal.finished()), 5)
+            calls = SlowAPIUpload.calls
+            links = SlowAPIUpload(self.data, args,
+                                  journal=journal).api_uploads()
+            self.assertEqual(links, ['https://srv2.example/foo.txt'])
+            self.assertEqual(SlowAPIUpload.calls, calls + 1)
+            self.assertEqual(len(journal.finished()), 6)
+            journal.close()
+            # A run that completed is not resumed.
+            with self.assertRaises(FileNotFoundError):
+                Journal.resume(path)
+        finally:
+            Path(path).unlink()
+
+    def test_journal_per_run(self):
+        folder = 'test-journals'
+        args = self._args([])
+        try:
+            Journal.start(args, folder=folder).close()
+            interrupted = Journal.start(args, folder=folder)
+            interrupted._f.close()
+            # A later run of another process that is still going.
+            with open(f'{folder}/{time.time_ns()}-0.jsonl', 'w') as f:
+                f.write(json.dumps({'type': 'run', 'args': {},
+                                    'pid': os.getppid()}) + '\n')
+            journal = Journal.resume(folder=folder)
+            self.assertEqual(journal.path, interrupted.path)
+            journal.close()
+            with self.assertRaises(FileNotFoundError):
+                Journal.resume(folder=folder)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_ndjson_records(self):
+
+        class Failing(SlowAPIUpload):
+
+            def curl(self, server, source=None, file=None):
+                if server == 'srv2':
+                    raise DeadlineExceeded('srv2 took too long')
+                return super().curl(server, source, file)
+
+        out = io.StringIO()
+        results = Results(ndjson(out))
+        Failing(self.data, self._args(['--style', 'ndjson']),
+                results=results).api_uploads()
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), 6)
+        by_server = {r['server']: r for r in lines}
+        self.assertEqual(by_server['srv2']['status'], 'timeout')
+        self.assertIsNone(by_server['srv2']['link'])
+        self.assertEqual(by_server['srv0']['status'], 'ok')
+        self.assertEqual(by_server['srv0']['link'],
+                         'https://srv0.example/foo.txt')
+        self.assertEqual(by_server['srv0']['bytes'], 4)
+        self.assertGreaterEqual(by_server['srv0']['duration'], 0.3)
+
+    def test_link_budget(self):
+        budget = LinkBudget(3)
+        self.assertEqual(budget.take('f', 2), 2)
+        self.assertEqual(budget.take('f', 5), 1)
+        self.assertEqual(budget.take('g'), 1)
+        got = []
+        waiter = threading.Thread(
+            target=lambda: got.append(budget.take('f', 2, wait=True)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(got, [])
+        # One of the first two uploads failed.
+        budget.settle('f', 2, 1)
+        waiter.join(1)
+        self.assertEqual(got, [1])
+        self.assertFalse(budget.full('f'))
+        budget.settle('f', 2, 2)
+        self.assertTrue(budget.full('f'))
+        self.assertEqual(LinkBudget().take('f', 7), 7)
+
+    def test_api_uploads_share_budget(self):
+        args = self._args(['--number', '3'])
+        budget = LinkBudget(3)
+        budget.settle('foo.txt', 0, 2)
+        api = SlowAPIUpload(self.data, args, budget=budget)
+        links = api.api_uploads()
+        self.assertEqual(links, ['https://srv0.example/foo.txt'])
+        self.assertTrue(api.planned.is_set())
+        self.assertTrue(budget.full('foo.txt'))
+
+    def test_import_budget(self):
+        out = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import pymirror.main'],
+            stderr=subprocess.PIPE,
+            universal_newlines=True).stderr
+        cumulative = {}
+        for ln in out.splitlines()[1:]:
+            _, us, module = ln.split('|')
+            cumulative[module.strip()] = int(us)
+        for heavy in ['selenium', 'speedtest', 'psutil']:
+            self.assertNotIn(heavy, cumulative)
+        self.assertLess(cumulative['pymirror.main'], IMPORT_BUDGET)
+
+    def test_token_bucket_paces(self):
+        bucket = TokenBucket(1e+6, burst=1e+5)
+        start = time.time()
+        for _ in range(6):
+            bucket.consume(1e+5)
+        self.assertGreater(time.time() - start, 0.45)
+
+    def test_bandwidth_concurrency(self):
+        self.assertEqual(capacity(10, 4), 4)
+        self.assertEqual(capacity(10), 9.5)
+        self.assertIsNone(capacity(None))
+        self.assertEqual(concurrency([None] * 10, 8), 4)
+        self.assertEqual(concurrency([1, 1, 5, None], 8), 3)
+        self.assertEqual(concurrency([20, 20], 8), 2)
+        self.assertEqual(concurrency([1, 1, 1], None), 3)
+
+    def test_uplink_uses_the_upload_speed(self):
+        cfg = config()
+        speed = cfg.get('upload_speed')
+        cfg['upload_speed'] = 4.0
+        try:
+            data = load_data()
+            self.assertEqual(APIUpload(data, options()).uplink(), 3.8)
+            self.assertEqual(HostStats('-').throughput('0x0'), 4.0)
+            upload = APIUpload(data, options(max_bandwidth=2))
+            self.assertEqual(upload.uplink(), 2)
+        finally:
+            cfg['upload_speed'] = speed
+
+    def test_expand_inputs(self):
+        with open('files.txt', 'w') as f:
+            f.write('foo.txt\nbar.txt\n')
+        try:
+            self.assertEqual(expand_inputs(['fo*.txt', '@files.txt']),
+                             ['foo.txt', 'bar.txt'])
+        finally:
+            Path('files.txt').unlink()
+
+    def test_shared_uplink_deadlines(self):
+        # Four large uploads to hosts never measured share a 4 MB/s uplink:
+        # each gets a quarter of it, and its deadline has to allow for that.
+
+        class QuickStats(HostStats):
+
+            def deadline(self, server, size, share=None, **kwargs):
+                return super().deadline(server, size, share, floor=0.2)
+
+        big = Path('big.bin')
+        with open(str(big), 'wb') as f:
+            f.write(bytes(4 << 20))
+        data = {k: v for k, v in servers_data().items()
+                if k in ['gofile', 'transfersh', 'oshi', '0x0']}
+        results = Results()
+        try:
+            with StandIns(data) as httpd:
+                api = APIUpload(httpd.routed(),
+                                options(max_bandwidth=4, no_cache=True),
+                                stats=QuickStats('test_host_stats.json'),
+                                results=results)
+                links = api.api_uploads(files=[str(big)])
+        finally:
+            big.unlink()
+            Path('test_host_stats.json').unlink()
+        self.assertEqual(len(links), 4)
+        self.assertEqual(results.all_links, links)
+        self.assertEqual(api.slots.size, 4)
+
+    def test_schedule_interleaves_files(self):
+        api = SlowAPIUpload(self.data, self._args([]))
+        jobs = api.schedule(['foo.txt', 'foo.txt'], ['srv0', 'srv1', 'srv2'])
+        self.assertEqual([k for _, k in jobs],
+                         ['srv0', 'srv1', 'srv0', 'srv2', 'srv1', 'srv2'])
+
+    def test_grouped_styles(self):
+        links = {
+            'a/foo.txt': ['https://0x0.st/a.txt', 'https://ttm.sh/b.txt'],
+            'bar.txt': ['https://0x0.st/c.txt']
+        }
+        expected = {
+            'lines': 'foo.txt\nhttps://0x0.st/a.txt\nhttps://ttm.sh/b.txt'
+            '\n\nbar.txt\nhttps://0x0.st/c.txt',
+            'markdown': '### foo.txt\n\n- [0x0.st](https://0x0.st/a.txt)\n'
+            '- [ttm.sh](https://ttm.sh/b.txt)\n\n### bar.txt\n\n'
+            '- [0x0.st](https://0x0.st/c.txt)',
+            'reddit': '**foo.txt**: [Mirror 1](https://0x0.st/a.txt) | '
+            '[Mirror 2](https://ttm.sh/b.txt)\n\n**bar.txt**: '
+            '[Mirror 1](https://0x0.st/c.txt)',
+            'ndjson': '{"input": "foo.txt", "server": "0x0.st", "link": '
+            '"https://0x0.st/a.txt"}\n{"input": "foo.txt", "server": '
+            '"ttm.sh", "link": "https://ttm.sh/b.txt"}\n{"input": '
+            '"bar.txt", "server": "0x0.st", "link": "https://0x0.st/c.txt"}'
+        }
+        for style, output in expected.items():
+            args = self._args(['--style', style])
+            self.assertEqual(PyMirror(args).style_output(links), output)
+        args = self._args(['--style', 'list'])
+        self.assertEqual(
+            PyMirror(args).style_output(links)['bar.txt'],
+            ['https://0x0.st/c.txt'])
+        # Inputs with the same name keep their own links.
+        same_name = {
+            'a/README.md': ['https://0x0.st/aaa'],
+            'b/README.md': ['https://0x0.st/bbb']
+        }
+        args = self._args(['--style', 'lines'])
+        self.assertEqual(
+            PyMirror(args).style_output(same_name),
+            'a/README.md\nhttps://0x0.st/aaa\n\nb/README.md\n'
+            'https://0x0.st/bbb')
+
+
+class RegistryTests(unittest.TestCase):
+
+    def test_links_from_each_reply(self):
+        data = servers_data()
+        servers = Registry(data)
+        for k, entry in data.items():
+            link = f'https://{k}.example/foo'
+            self.assertEqual(servers[k].extract(response(entry, link)), link)
+        self.assertIsNone(servers['uguu'].extract(b'{"files": []}'))
+        self.assertIsNone(servers['uguu'].extract(b'502 Bad Gateway'))
+
+    def test_eligible(self):
+        servers = Registry({
+            'small': _server('small', limit=1),
+            'big': _server('big', limit=100),
+            'midi': _server('midi', limit=100)
+        })
+        self.assertEqual(servers.eligible('foo.txt', 0.5), ('small', 'big'))
+        self.assertEqual(servers.eligible('foo.mp3', 1), ('small', 'big',
+                                                          'midi'))
+        self.assertEqual(servers.eligible('foo', 50), ('big', 'midi'))
+        self.assertEqual(servers.eligible('foo.txt', 500), ())
+        self.assertEqual(list(servers.subset(['midi', 'small'])),
+                         ['small', 'midi'])
+
+    def test_unknown_expiry_is_never_reused(self):
+        servers = Registry({'old': _server('old'),
+                            'kept': _server('kept', expires=None)})
+        self.assertEqual(servers['old'].expires, 0)
+        self.assertIsNone(servers['kept'].expires)
+        # Not reused, but not known to be single-download either.
+        self.assertFalse(servers['old'].single_download)
+        self.assertFalse(servers.undated)
+
+    def test_single_download(self):
+        servers = Registry({
+            'once': _server('once', expires=0),
+            'flagged': _server('flagged', expires=24, single_download=True),
+            'old': _server('old')
+        })
+        self.assertTrue(servers['once'].single_download)
+        self.assertTrue(servers['flagged'].single_download)
+        self.assertFalse(servers['old'].single_download)
+        with self.assertRaises(InvalidServer):
+            Registry({'x': _server('x', single_download=1)})
+
+    def test_undated_registry_warns_once(self):
+        path = Path('test_servers_data.json')
+        path.write_text(json.dumps({'old': _server('old')}))
+        err = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(err):
+                servers = load(str(path))
+                load(str(path))
+        finally:
+            path.unlink()
+        self.assertTrue(servers.undated)
+        self.assertTrue(servers.subset(['old']).undated)
+        self.assertEqual(err.getvalue().count('--refresh-config'), 1)
+
+    def test_invalid_entry(self):
+        for entry in [{'limit': 1}, _server('x', limit='1'),
+                      _server('x', keys=['files', None])]:
+            with self.assertRaises(InvalidServer):
+                Registry({'x': entry})
+
+
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        body = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+            if size == 0:
+                return body
+
+    def _echo(self):
+        body = self._body()
+        out = f'{self.command} {self.path}\n'.encode() + body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_POST = do_PUT = _echo
+
+    def do_GET(self):
+        # `/files/<name>` serves a local file, honouring `Range`.
+        if self.path.split('?')[0] == '/page':
+            status, out = 200, b'<!DOCTYPE html><html>Download</html>'
+        elif self.path.startswith('/files/'):
+            with open(self.path[len('/files/'):], 'rb') as f:
+                out = f.read()
+            status = 200
+            if self.headers.get('Range'):
+                end = int(self.headers['Range'].split('-')[1])
+                status, out = 206, out[:end + 1]
+        else:
+            status, out = 404, b'Not Found'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def do_HEAD(self):
+        self.send_response(405)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     EchoHandler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.foo.unlink()
+
+    def test_health_check(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        data = {
+            'up': _server('up', server=f'{self.url}/upload.php'),
+            'down': _server('down', server='http://127.0.0.1:'
+                            f'{closed.getsockname()[1]}')
+        }
+        up, down = asyncio.run(probe_all(data, timeout=5))
+        closed.close()
+        self.assertTrue(up['ok'])
+        self.assertEqual(up['status'], 405)
+        self.assertEqual(set(up) & {'dns', 'connect', 'http'},
+                         {'dns', 'connect', 'http'})
+        self.assertFalse(down['ok'])
+        self.assertTrue(down['error'].startswith('connect'))
+
+    def test_verify_links(self):
+        bar = Path('bar.bin')
+        with open(str(bar), 'wb') as f:
+            f.write(bytes(range(256)) * 64)
+        links = {
+            'verified': f'{self.url}/files/bar.bin',
+            'reachable': f'{self.url}/page',
+            'gone': f'{self.url}/gone',
+            'wrong': f'{self.url}/files/foo.txt'
+        }
+        checked = []
+        results = Results()
+        for link in links.values():
+            results.emit('bar.bin', 'srv', 'ok', link)
+        # A host whose entry does not say how long links last is checked.
+        results.emit('bar.bin', 'old', 'ok', links['verified'])
+        # Downloading a link of a single-download host would use it up.
+        once = f'{self.url}/files/bar.bin?once'
+        results.emit('bar.bin', 'once', 'ok', once)
+        data = {'once': _server('once', expires=0), 'old': _server('old')}
+        results.listener = checked.append
+        verify(results, size=1024, data=registry(data))
+        bar.unlink()
+        statuses = {r.link: r.status for r in checked}
+        self.assertEqual(statuses, {
+            links['verified']: 'verified',
+            links['reachable']: 'reachable',
+            links['gone']: 'broken',
+            links['wrong']: 'broken',
+            once: 'unchecked'
+        })
+        self.assertEqual(results.broken[links['gone']], 'HTTP 404')
+        front = PyMirror(options(style='markdown'))
+        front.results = results
+        self.assertIn('~~', front.style_output([links['gone']]))
+        self.assertNotIn('~~', front.style_output([links['verified']]))
+
+    def test_deadline_cancels_stalled_upload(self):
+        stalled = socket.socket()
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen(1)
+        start = time.time()
+        with self.assertRaises(DeadlineExceeded):
+            with Deadline(1):
+                HTTPTransport().upload(
+                    f'http://127.0.0.1:{stalled.getsockname()[1]}/',
+                    str(self.foo))
+        self.assertLess(time.time() - start, 3)
+        stalled.close()
+
+    def test_deadline_kills_subprocess(self):
+        start = time.time()
+        with self.assertRaises(DeadlineExceeded):
+            with Deadline(0.5):
+                CurlTransport.run(['sleep', '10'])
+        self.assertLess(time.time() - start, 2)
+
+    def test_deadline_for(self):
+        self.assertEqual(deadline_for(0.001, 5), 30 + 3 * 0.001 / 5)
+        self.assertEqual(deadline_for(1000, 1, floor=10), 3010)
+        self.assertEqual(deadline_for(1e+6, 0.1), 6 * 3600)
+
+    def test_from_flags(self):
+        self.assertEqual(from_flags('-sF', 'files[]=@'), {
+            'method': 'POST',
+            'field': 'files[]'
+        })
+        self.assertEqual(from_flags('-sT', '')['method'], 'PUT')
+        self.assertEqual(from_flags('-s --upload-file', '')['method'], 'PUT')
+        self.assertIsNone(from_flags('-sLF', 'file=@'))
+
+    def test_native_multipart(self):
+        out = HTTPTransport().upload(f'{self.url}/upload.php',
+                                     str(self.foo),
+                                     field='files[]',
+                                     fields={'host': 'true'})
+        self.assertTrue(out.startswith(b'POST /upload.php\n'))
+        self.assertIn(b'name="files[]"; filename="foo.txt"', out)
+        self.assertIn(b'name="host"\r\n\r\ntrue', out)
+        self.assertIn(b'\r\n\r\nfoo\n\r\n', out)
+
+    def test_native_put(self):
+        out = HTTPTransport().upload(self.url, str(self.foo), method='PUT')
+        self.assertEqual(out, b'PUT /foo.txt\nfoo\n')
+
+    def test_tracing_phases(self):
+        self.assertIs(tracing.span('job'), tracing.span('parse'))
+        tracer = tracing.enable()
+        try:
+            with tracing.span('job', server='echo'):
+                HTTPTransport().upload(self.url, str(self.foo))
+        finally:
+            tracing.disable()
+        spans = {s['name']: s for s in tracer.spans}
+        self.assertEqual(set(spans),
+                         {'job', 'resolve', 'connect', 'send', 'server'})
+        self.assertEqual(spans['send']['attrs'], {'server': 'echo'})
+        job = spans['job']
+        for name in ['resolve', 'connect', 'send', 'server']:
+            self.assertGreaterEqual(spans[name]['start'], job['start'])
+            self.assertLessEqual(spans[name]['duration'], job['duration'])
+        path = 'test_metrics.prom'
+        try:
+            tracer.write_prometheus(path)
+            with open(path) as f:
+                metrics = f.read()
+        finally:
+            Path(path).unlink()
+        self.assertIn('pymirror_span_seconds_count{span="send",'
+                      'server="echo"} 1', metrics)
+
+
+class WatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     EchoHandler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.catalogue = Catalogue(':memory:')
+        self.digest = file_hash('foo.txt')
+        self.catalogue.remember('foo.txt', self.digest)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.catalogue.close()
+        self.foo.unlink()
+
+    def test_dead_links_are_replaced(self):
+        live, dead = f'{self.url}/files/foo.txt', f'{self.url}/gone'
+        self.catalogue.record(self.digest, 'a', live)
+        self.catalogue.record(self.digest, 'b', dead)
+        self.catalogue.watch(self.digest, 'foo.txt', 2)
+        data = {k: v for k, v in servers_data().items()
+                if k in ['0x0', 'oshi', 'uguu']}
+        replaced = []
+        with StandIns(data) as httpd:
+            watchdog = Watchdog(self.catalogue, options(no_cache=False),
+                                httpd.routed(), limiter=HostLimiter(rate=50))
+            counts = watchdog.run_once(Results(replaced.append))
+            self.assertEqual(counts, {'live': 1, 'dead': 1, 'unknown': 0})
+            # The replacement goes to the host that keeps files longest.
+            self.assertEqual([r.server for r in replaced], ['0x0'])
+            self.assertEqual(sorted(self.catalogue.links(self.digest)),
+                             ['0x0', 'a'])
+            # Nothing is due or missing until the links are old enough.
+            replaced.clear()
+            counts = watchdog.run_once(Results(replaced.append))
+        self.assertEqual(sum(counts.values()), 0)
+        self.assertEqual(replaced, [])
+
+    def test_passes_share_the_limiter(self):
+        # More links of one host than it takes at once, checked on two
+        # passes (two event loops) by the same limiter.
+        for k in ['a', 'b', 'c']:
+            self.catalogue.record(self.digest, k, f'{self.url}/page?{k}')
+        self.catalogue.watch(self.digest, 'foo.txt', 3)
+        watchdog = Watchdog(self.catalogue, options(), servers_data(),
+                            recheck=0,
+                            limiter=HostLimiter(concurrency=1, rate=100))
+        for _ in range(2):
+            time.sleep(0.01)
+            counts = watchdog.run_once(Results(lambda result: None))
+            self.assertEqual(counts, {'live': 3, 'dead': 0, 'unknown': 0})
+
+    def test_due_links(self):
+        self.catalogue.record(self.digest, 'a', f'{self.url}/a')
+        self.catalogue.record(self.digest, 'b', f'{self.url}/b', -1)
+        self.assertEqual(self.catalogue.due(time.time(), 10), [])
+        self.catalogue.watch(self.digest, 'foo.txt', 2)
+        self.assertEqual(self.catalogue.due(time.time(), 10),
+                         [('a', f'{self.url}/a', 0)])
+        self.catalogue.mark([(f'{self.url}/a', 'unknown', 1, 'HTTP 503')])
+        self.assertEqual(self.catalogue.due(time.time() - 60, 10), [])
+        self.assertEqual(self.catalogue.due(time.time() + 60, 10),
+                         [('a', f'{self.url}/a', 1)])
+
+
+class BenchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+
+    def tearDown(self):
+        self.foo.unlink()
+
+    def test_stand_ins_answer_like_each_host(self):
+        data = servers_data()
+        sys.argv[1:] = ['-i', str(self.foo)]
+        args = cli()
+        with StandIns(data) as httpd:
+            upload = BenchUpload(httpd.routed(), args)
+            links = {k: upload.curl(k) for k in data if k != 'midi'}
+        for k, link in links.items():
+            host = data[k]['server'].split('/')[2]
+            self.assertRegex(link, rf'^https://{host}/\d{{6}}$')
+
+    def test_bench_reports_failures(self):
+        results = bench([0.01], [2, 4], servers=['0x0', 'oshi', 'uguu'],
+                        failure_rate=0.5, seed=1)
+        self.assertEqual([r['workers'] for r in results], [2, 4])
+        for r in results:
+            self.assertEqual(r['files'] + r['failed'], 3)
+            self.assertLessEqual(r['p50'], r['p99'])
+            self.assertGreater(r['peak_rss'], 0)
+        self.assertGreater(sum(r['failed'] for r in results), 0)
+
+
+class APITests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+        self.data = {k: v for k, v in servers_data().items()
+                     if k in ['0x0', 'oshi', 'uguu']}
+
+    def tearDown(self):
+        self.foo.unlink()
+
+    @staticmethod
+    async def _collect(args, data, results=None):
+        return [r async for r in stream(args, results, data=data)]
+
+    def test_options(self):
+        args = options(input=['foo.*'], workers=4)
+        self.assertEqual((args.inputs, args.workers, args.style),
+                         (['foo.txt'], 4, 'lines'))
+        with self.assertRaises(TypeError):
+            options(speed=4)
+
+    def test_concurrent_runs_keep_their_own_results(self):
+        args = options(input=str(self.foo), no_cache=True)
+
+        async def both(data):
+            return await asyncio.gather(
+                *[self._collect(args, data, r) for r in runs])
+
+        runs = [Results(), Results()]
+        with StandIns(self.data) as httpd:
+            first, second = asyncio.run(both(httpd.routed()))
+        for results, run in zip([first, second], runs):
+            self.assertEqual(sorted(r.server for r in results),
+                             ['0x0', 'oshi', 'uguu'])
+            self.assertEqual([r.link for r in results], run.all_links)
+        self.assertFalse(set(runs[0].all_links) & set(runs[1].all_links))
+
+    def test_cancel_stops_the_run(self):
+        args = options(input=str(self.foo), no_cache=True)
+        results = Results()
+        with StandIns(self.data, latency=5) as httpd:
+            start = time.time()
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(
+                    self._collect(args, httpd.routed(), results), 0.5))
+            self.assertLess(time.time() - start, 3)
+        self.assertTrue(results.cancelled.is_set())
+        self.assertEqual(results.all_links, [])
+
+
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+        self.sock = str(Path('test-pymirror.sock').resolve())
+        self.data = {k: v for k, v in servers_data().items()
+                     if k in ['0x0', 'oshi', 'uguu']}
+
+    def tearDown(self):
+        self.foo.unlink()
+        if Path(self.sock).exists():
+            Path(self.sock).unlink()
+
+    def test_jobs_share_the_daemon(self):
+        args = options(input=str(self.foo), no_cache=True, check_status=False)
+        args.socket, args.port = self.sock, None
+        runs = [Results(), Results()]
+
+        class CountingBucket(TokenBucket):
+            consumed = 0
+
+            def consume(self, n):
+                CountingBucket.consumed += n
+                super().consume(n)
+
+        async def jobs(data):
+            daemon = Daemon(data=data, token='secret', max_bandwidth=100)
+            self.assertEqual(daemon.bucket.rate, 100e+6)
+            # Every job draws on the daemon's bucket.
+            daemon.bucket = CountingBucket(100e+6)
+            server = await daemon.start(path=self.sock)
+            self.assertEqual(Path(self.sock).stat().st_mode & 0o777, 0o600)
+            async with server:
+                shown = []
+                for results in runs:
+                    await submit(args, results, shown.append, self.sock,
+                                 token='secret')
+                bad = argparse.Namespace(**{**vars(args), 'speed': 4})
+                with self.assertRaises(RuntimeError):
+                    await submit(bad, Results(), shown.append, self.sock,
+                                 token='secret')
+                with self.assertRaisesRegex(RuntimeError, 'token'):
+                    await submit(args, Results(), shown.append, self.sock,
+                                 token='guess')
+            return daemon, shown
+
+        with StandIns(self.data) as httpd:
+            daemon, shown = asyncio.run(jobs(httpd.routed()))
+        self.assertEqual(len(shown), 6)
+        for results in runs:
+            self.assertEqual(len(results.all_links), 3)
+        self.assertEqual(daemon.jobs, 4)
+        self.assertGreaterEqual(CountingBucket.consumed, 2 * 3 * 4)
+
+
+def _work(path, data, name):
+    # A worker process of `DistributedTests`.
+    Worker(SQLiteQueue(path), options(no_cache=True), data,
+           name).run(threads=2, drain=True)
+
+
+class DistributedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.files = [Path('foo.txt'), Path('bar.txt')]
+        for file in self.files:
+            with open(str(file), 'w') as f:
+                f.write(f'{file}\n')
+        self.path = 'test-queue.sqlite'
+        self.data = {k: v for k, v in servers_data().items()
+                     if k in ['0x0', 'oshi', 'uguu']}
+
+    def tearDown(self):
+        for file in self.files + [Path(self.path)]:
+            file.unlink()
+
+    def test_queue_backend_is_complete(self):
+
+        class PutOnly(JobQueue):
+
+            def put(self, run, jobs):
+                pass
+
+        with self.assertRaises(TypeError):
+            PutOnly()
+        SQLiteQueue(self.path).close()
+
+    def test_expired_lease_moves_on(self):
+        queue = SQLiteQueue(self.path)
+        queue.put('run', [('foo.txt', '0x0'), ('bar.txt', '0x0')])
+        first = queue.lease('a', ttl=0.05)
+        self.assertEqual(queue.lease('b')['input'], 'bar.txt')
+        self.assertIsNone(queue.lease('c'))
+        time.sleep(0.1)
+        again = queue.lease('c')
+        self.assertEqual(again['id'], first['id'])
+        self.assertFalse(queue.renew(first, 'a'))
+        self.assertFalse(
+            queue.complete(first, 'a', Result('foo.txt', '0x0', 'ok', 'x')))
+        self.assertTrue(
+            queue.complete(again, 'c', Result('foo.txt', '0x0', 'ok', 'y')))
+        results, after = queue.finished('run')
+        self.assertEqual([r.link for r in results], ['y'])
+        self.assertEqual(queue.pending('run'), 1)
+        queue.cancel('run')
+        results, _ = queue.finished('run', after)
+        self.assertEqual([r.status for r in results], ['cancelled'])
+        self.assertEqual(queue.pending(), 0)
+        queue.close()
+
+    def test_worker_processes(self):
+        queue = SQLiteQueue(self.path)
+        args = options(input=[str(f) for f in self.files], no_cache=True)
+        results = Results()
+        with StandIns(self.data) as httpd:
+            data = httpd.routed()
+            run, count = enqueue(queue, args, data)
+            context = multiprocessing.get_context('spawn')
+            workers = [
+                context.Process(target=_work,
+                                args=(self.path, data, f'worker-{n}'))
+                for n in range(2)
+            ]
+            for worker in workers:
+                worker.start()
+            follow(queue, run, results, poll=0.1)
+            for worker in workers:
+                worker.join(30)
+        self.assertEqual(count, 6)
+        self.assertEqual([w.exitcode for w in workers], [0, 0])
+        self.assertEqual(len(results.all_links), 6)
+        self.assertEqual(sorted(results.links_by_file),
+                         sorted(str(f.resolve()) for f in self.files))
+        queue.close()
+
+
+class FanOutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bar = Path('bar.bin')
+        self.content = bytes(range(256)) * 4096
+        with open(str(self.bar), 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.bar.unlink()
+
+    def test_each_chunk_read_once(self):
+        with SharedFile(str(self.bar), chunk_size=4096, window=4) as source:
+            readers = [source.reader() for _ in range(5)]
+            chunks = [[] for _ in readers]
+            for _ in range(len(self.content) // 4096):
+                for reader, out in zip(readers, chunks):
+                    out.append(next(reader))
+            for out in chunks:
+                self.assertEqual(b''.join(out), self.content)
+            self.assertEqual(source.reads, len(self.content) // 4096)
+            self.assertEqual(source.rereads, 0)
+
+    def test_digest_from_shared_read(self):
+        with SharedFile(str(self.bar), chunk_size=4096, window=4) as source:
+            reader = source.reader()
+            self.assertIsNone(source.digest)
+            b''.join(reader)
+            self.assertEqual(source.digest, file_hash(str(self.bar)))
+
+    def test_slow_consumer_rereads(self):
+        with SharedFile(str(self.bar), chunk_size=4096, window=4) as source:
+            first = b''.join(source.reader())
+            second = b''.join(source.reader())
+            self.assertEqual(first, self.content)
+            self.assertEqual(second, self.content)
+            self.assertEqual(len(source._chunks), 4)
+            self.assertEqual(source.rereads, len(self.content) // 4096 - 4)
+
+    def test_rereadable_source_is_complete(self):
+
+        class NoReread(Rereadable):
+
+            def _open(self):
+                return None
+
+        with self.assertRaises(TypeError):
+            NoReread(lambda: b'')
+
+
+class ArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = Path('foo_folder')
+        (self.folder / 'sub').mkdir(parents=True, exist_ok=True)
+        for n in range(3):
+            with open(str(self.folder / 'sub' / f'{n}.bin'), 'wb') as f:
+                f.write(bytes([n]) * (1 << 20) + b'tail')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.folder))
+        if Path('foo_folder.tar.gz').exists():
+            Path('foo_folder.tar.gz').unlink()
+
+    def _names(self, data):
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as t:
+            return sorted(t.getnames())
+
+    def test_parallel_gzip_archive(self):
+        out = write_archive(str(self.folder))
+        self.assertEqual(Path(out), Path('foo_folder.tar.gz'))
+        with open(out, 'rb') as f:
+            data = f.read()
+        self.assertIn('foo_folder/sub/2.bin', self._names(data))
+        with tarfile.open(out) as t:
+            member = t.extractfile('foo_folder/sub/1.bin').read()
+        self.assertEqual(member, b'\x01' * (1 << 20) + b'tail')
+
+    def test_abandoned_stream_stops_its_producer(self):
+        # More blocks than the producer queue holds.
+        with open(str(self.folder / 'big.bin'), 'wb') as f:
+            f.write(bytes(12 << 20))
+        before = threading.active_count()
+        blocks = tar_blocks(str(self.folder))
+        next(blocks)
+        # Until the queue is full and the producer waits on it.
+        time.sleep(0.5)
+        blocks.close()
+        end = time.time() + 5
+        while threading.active_count() > before and time.time() < end:
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_stream_fans_out_without_temp_file(self):
+        stream = ArchiveStream(str(self.folder))
+        fanout = stream.fanout()
+        readers = [fanout.reader() for _ in range(3)]
+        outputs = [[] for _ in readers]
+
+        def consume(reader, out):
+            out.extend(reader)
+
+        threads = [
+            threading.Thread(target=consume, args=(r, o))
+            for r, o in zip(readers, outputs)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertFalse(Path('foo_folder.tar.gz').exists())
+        data = [b''.join(out) for out in outputs]
+        self.assertEqual(data[0], data[1])
+        self.assertEqual(data[0], data[2])
+        self.assertEqual(len(self._names(data[0])), 5)
+        self.assertGreater(len(gzip.decompress(data[0])), 3 << 20)
+
+    def test_chunked_upload(self):
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            stream = ArchiveStream(str(self.folder))
+            out = HTTPTransport().upload(
+                f'http://127.0.0.1:{httpd.server_port}/',
+                stream.name,
+                method='PUT',
+                source=stream.fanout().reader())
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        head, body = out.split(b'\n', 1)
+        self.assertEqual(head, b'PUT /foo_folder.tar.gz')
+        self.assertEqual(len(self._names(body)), 5)
+
+
+class FakeDriver:
+    # Just enough of a WebDriver for the pool.
+
+    def __init__(self):
+        self.window_handles = ['main']
+        self.cookies = {'session': 'x'}
+        self.quit_called = False
+        self.switch_to = self
+
+    def window(self, handle):
+        if self.quit_called:
+            raise ConnectionRefusedError(handle)
+
+    def close(self):
+        self.window_handles.pop()
+
+    def execute_script(self, script):
+        pass
+
+    def delete_all_cookies(self):
+        self.cookies = {}
+
+    def get(self, url):
+        pass
+
+    def quit(self):
+        self.quit_called = True
+
+
+class DriverPoolTests(unittest.TestCase):
+
+    def test_reuses_and_resets_drivers(self):
+        pool = DriverPool(size=2, factory=FakeDriver)
+        pool.warm()
+        with pool.lend() as driver:
+            driver.window_handles.append('popup')
+        with pool.lend() as again:
+            self.assertEqual(again.window_handles, ['main'])
+            self.assertEqual(again.cookies, {})
+        self.assertEqual(pool.started, 2)
+        pool.close()
+        self.assertTrue(driver.quit_called)
+
+    def test_recycles_drivers(self):
+        pool = DriverPool(size=1, max_uses=2, factory=FakeDriver)
+        with pool.lend() as first:
+            pass
+        with pool.lend() as driver:
+            self.assertIs(driver, first)
+        with pool.lend() as driver:
+            self.assertIsNot(driver, first)
+            driver.quit()
+        with pool.lend():
+            pass
+        self.assertEqual(pool.started, 3)
+
+    def test_waits_for_a_free_driver(self):
+        pool = DriverPool(size=1, factory=FakeDriver)
+        lent = []
+
+        def borrow():
+            with pool.lend() as d:
+                lent.append(d)
+                time.sleep(0.2)
+
+        threads = [threading.Thread(target=borrow) for _ in range(3)]
+        _ = [t.start() for t in threads]
+        _ = [t.join() for t in threads]
+        self.assertEqual(len(set(map(id, lent))), 1)
+        self.assertEqual(pool.started, 1)
+
+
+class MirrorPageHandler(http.server.BaseHTTPRequestHandler):
+    # Every host is listed from the start; one more of h0-h2 reports on
+    # every request, and h3 failed.
+    requests = 0
+
+    def do_GET(self):
+        MirrorPageHandler.requests += 1
+        status = ['(0)' if n < MirrorPageHandler.requests else 'uploading'
+                  for n in range(3)] + ['Error']
+        hosts = ''.join(
+            f'<div class="host col" link="https://h{n}.example/f">'
+            f'<img src="h{n}.png"><b>h{n}</b> {s}</div>'
+            for n, s in enumerate(status))
+        out = f'<html><body>{hosts}</body></html>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+class MultiUpTests(unittest.TestCase):
+
+    def test_parse_hosts(self):
+        hosts = parse_hosts('<ul><li class="host" link="https://a.example">'
+                            '<span>a.example</span><br> (0)</li>'
+                            '<li class="hosts">x</li></ul>')
+        self.assertEqual(hosts, [{
+            'link': 'https://a.example',
+            'text': 'a.example (0)'
+        }])
+
+    def test_poll_mirrors_until_all_reported(self):
+        MirrorPageHandler.requests = 0
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                MirrorPageHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            hosts = poll_mirrors(HTTPTransport(),
+                                 f'http://127.0.0.1:{httpd.server_port}/',
+                                 ['h0', 'h1', 'h2', 'h3'],
+                                 timeout=10)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual([h['link'] for h in hosts if '(0)' in h['text']],
+                         [f'https://h{n}.example/f' for n in range(3)])
+        self.assertEqual(MirrorPageHandler.requests, 3)
+
+
+class WaitsTests(unittest.TestCase):
+
+    def test_until_returns_value_and_records(self):
+        calls = []
+
+        def ready(driver):
+            calls.append(driver)
+            return len(calls) >= 3 and 'done'
+
+        start = time.time()
+        value = waits.until('driver', ready, poll=0.05, label='test ready')
+        self.assertEqual(value, 'done')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(waits.stats.summary()['test ready']['count'], 1)
+
+    def test_until_timeout(self):
+        self.assertIsNone(
+            waits.until(None, lambda d: False, timeout=0.2, strict=False))
+        with self.assertRaises(waits.TimeoutException):
+            waits.until(None, lambda d: False, timeout=0.2)
+
+    def test_until_stops_at_deadline(self):
+        start = time.time()
+        with self.assertRaises(DeadlineExceeded):
+            with Deadline(0.3, 'wait'):
+                waits.until(None, lambda d: False, timeout=30, poll=0.05)
+        self.assertLess(time.time() - start, 1)
+
+
+def fast_provider(self, driver):
+    time.sleep(0.1)
+    return f'https://{len(driver.window_handles)}.example/foo.txt'
+
+
+class FakeMoreLinks(MoreLinks):
+    expirebox = filepost = filesharego = sendcm = usaupload = fast_provider
+
+    def filepizza(self, driver):
+        time.sleep(0.05)
+        return None
+
+
+class MoreLinksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.foo = Path('foo.txt')
+        with open(str(self.foo), 'w') as f:
+            f.write('foo\n')
+
+    def tearDown(self):
+        self.foo.unlink()
+
+    def test_parallel_providers_stop_at_number(self):
+        sys.argv[1:] = ['-i', str(self.foo), '--number', '3', '-B', '3']
+        pool = DriverPool(size=3, factory=FakeDriver)
+        start = time.time()
+        links = FakeMoreLinks(cli(), pool).upload_to_all_()
+        self.assertEqual(len(links), 3)
+        self.assertLess(time.time() - start, 2)
+        self.assertLessEqual(pool.started, 4)
+
+    def test_providers_wait_for_the_budget(self):
+        # Another stage holds every slot: no provider starts until it gives
+        # them back, and none at all once it made its links.
+        sys.argv[1:] = ['-i', str(self.foo), '--number', '2', '-B', '3']
+        args = cli()
+        for made, expected in [(2, 0), (1, 1)]:
+            budget = LinkBudget(2)
+            budget.take('foo.txt', 2)
+            pool = DriverPool(size=3, factory=FakeDriver)
+            threading.Timer(0.3, budget.settle,
+                            ['foo.txt', 2, made]).start()
+            links = FakeMoreLinks(args, pool, budget).upload_to_all_()
+            self.assertEqual(len(links), expected)
+            self.assertTrue(budget.full('foo.txt'))
+            if not expected:
+                self.assertEqual(pool.started, 0)
+
+
 if __name__ == '__main__':
     Options.remove_config = True
     warnings.filterwarnings(action='ignore', category=ResourceWarning)
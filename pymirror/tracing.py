@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+_tracer = None
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+
+class Tracer:
+    # Timed spans of every job, kept in memory until the run ends. Each span
+    # carries the attributes (server, file, ...) of the spans around it in
+    # the same thread.
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, end: float,
+               attrs: dict) -> None:
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'start': start - self.origin,
+                'duration': end - start,
+                'thread': threading.get_ident(),
+                'attrs': attrs
+            })
+
+    def aggregate(self) -> list:
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                key = (s['name'], s['attrs'].get('server', ''))
+                count, total, longest = totals.get(key, (0, 0.0, 0.0))
+                totals[key] = (count + 1, total + s['duration'],
+                               max(longest, s['duration']))
+        return sorted([(*k, *v) for k, v in totals.items()],
+                      key=lambda x: -x[3])
+
+    def write_json(self, path: str) -> None:
+        # Chrome trace event format; open it in chrome://tracing or
+        # https://ui.perfetto.dev.
+        with self._lock:
+            events = [{
+                'name': s['name'],
+                'cat': s['attrs'].get('server', 'pymirror'),
+                'ph': 'X',
+                'ts': s['start'] * 1e+6,
+                'dur': s['duration'] * 1e+6,
+                'pid': os.getpid(),
+                'tid': s['thread'],
+                'args': {k: str(v) for k, v in s['attrs'].items()}
+            } for s in self.spans]
+        with open(path, 'w') as j:
+            json.dump({'traceEvents': events}, j)
+
+    def write_prometheus(self, path: str) -> None:
+        # Written to a temporary file first: the node exporter textfile
+        # collector must never see a partial file.
+        lines = [
+            '# HELP pymirror_span_seconds Time spent per phase of a job.',
+            '# TYPE pymirror_span_seconds summary'
+        ]
+        for name, server, count, total, _ in self.aggregate():
+            labels = f'span="{name}",server="{server}"'
+            lines.append(f'pymirror_span_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'pymirror_span_seconds_count{{{labels}}} {count}')
+        with open(f'{path}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{path}.tmp', path)
+
+    def table(self):
+        from rich.table import Table
+        table = Table(title='Profile')
+        for column in ['Span', 'Server', 'Count', 'Total (s)', 'Mean (s)',
+                       'Max (s)']:
+            table.add_column(column,
+                             justify='left' if column in ['Span', 'Server']
+                             else 'right')
+        for name, server, count, total, longest in self.aggregate():
+            table.add_row(name, server, str(count), f'{total:.3f}',
+                          f'{total / count:.3f}', f'{longest:.3f}')
+        return table
+
+
+def enable() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable() -> None:
+    global _tracer
+    _tracer = None
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+@contextlib.contextmanager
+def _span(name: str, attrs: dict):
+    parent = getattr(_local, 'attrs', {})
+    attrs = {**parent, **attrs}
+    _local.attrs = attrs
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.attrs = parent
+        _tracer.record(name, start, time.perf_counter(), attrs)
+
+
+def span(name: str, **attrs):
+    # A no-op context manager unless tracing was enabled.
+    if _tracer is None:
+        return _null
+    return _span(name, attrs)
+
+
+def record(name: str, start: float, end: float, **attrs) -> None:
+    if _tracer is None:
+        return
+    _tracer.record(name, start, end, {**getattr(_local, 'attrs', {}),
+                                      **attrs})
+
+
+def mark(name: str) -> None:
+    # Notes when something happened in this thread (e.g. the last byte of
+    # a body was sent), for a span recorded later.
+    if _tracer is None:
+        return
+    if not hasattr(_local, 'marks'):
+        _local.marks = {}
+    _local.marks[name] = time.perf_counter()
+
+
+def take_mark(name: str) -> Optional[float]:
+    return getattr(_local, 'marks', {}).pop(name, None)
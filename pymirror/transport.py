@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import mimetypes
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import quote, urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from pymirror import tracing
+from pymirror.deadline import DeadlineExceeded
+from pymirror.deadline import check as check_deadline
+from pymirror.deadline import current as current_deadline
+
+CHUNK_SIZE = 1 << 16
+
+
+class TransportError(Exception):
+    pass
+
+
+def from_flags(flags: str, parameter: str) -> Optional[dict]:
+    # Translate the curl flags used in `servers_data.json` into a request
+    # the native transport understands; `None` means "use curl".
+    tokens = shlex.split(flags)
+    opts = [t for t in tokens if t != '-s']
+    if opts in (['-sF'], ['-F']) and parameter.endswith('=@'):
+        return {'method': 'POST', 'field': parameter[:-2]}
+    if opts in (['-sT'], ['-T'], ['--upload-file']) and not parameter:
+        return {'method': 'PUT', 'field': None}
+    return None
+
+
+def put_url(url: str, file: str) -> str:
+    # Same rule as `curl -T`: append the file name if the URL has no file
+    # part of its own.
+    path = urlsplit(url).path
+    if not path or path.endswith('/'):
+        return f'{url.rstrip("/")}/{quote(Path(file).name)}'
+    return url
+
+
+class FileBody:
+
+    def __init__(self,
+                 file: str,
+                 chunk_size: int = CHUNK_SIZE,
+                 source=None) -> None:
+        self.file = file
+        self.chunk_size = chunk_size
+        self.source = source
+        if source is not None:
+            self.size = source.size
+        else:
+            self.size = Path(file).stat().st_size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.source is not None:
+            yield from self.source
+            return
+        with open(self.file, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class MultipartBody:
+
+    def __init__(self,
+                 field: str,
+                 file: str,
+                 fields: dict = None,
+                 source=None) -> None:
+        self.boundary = f'------------------------{uuid.uuid4().hex}'
+        self.body = FileBody(file, source=source)
+        mime = mimetypes.guess_type(file)[0] or 'application/octet-stream'
+        head = ''
+        for k, v in (fields or {}).items():
+            head += (f'--{self.boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{k}"\r\n\r\n'
+                     f'{v}\r\n')
+        head += (f'--{self.boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{field}"; '
+                 f'filename="{Path(file).name}"\r\n'
+                 f'Content-Type: {mime}\r\n\r\n')
+        self.head = head.encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def size(self) -> Optional[int]:
+        if self.body.size is None:
+            return None
+        return len(self.head) + self.body.size + len(self.tail)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.head
+        yield from self.body
+        yield self.tail
+
+
+def _shutdown(conn) -> None:
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        sock.shutdown(socket.SHUT_RDWR)
+
+
+class _DeadlineConnection:
+    # Lets the job's deadline shut the socket down from the timer thread,
+    # which unblocks a send or a wait for the response.
+
+    def putrequest(self, *args, **kwargs):
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.on_expire(lambda: _shutdown(self))
+        return super().putrequest(*args, **kwargs)
+
+
+class _TracedConnection:
+    # Splits connection setup into resolve, connect and TLS spans when
+    # tracing is on. The name is resolved up front and the connection made
+    # to that address, so DNS time is not counted twice.
+
+    def _new_conn(self):
+        if not tracing.enabled():
+            return super()._new_conn()
+        start = time.perf_counter()
+        host = self._dns_host
+        try:
+            with tracing.span('resolve'):
+                info = socket.getaddrinfo(host, self.port, 0,
+                                          socket.SOCK_STREAM)
+            self._dns_host = info[0][4][0]
+            with tracing.span('connect'):
+                return super()._new_conn()
+        finally:
+            self._dns_host = host
+            self._setup = time.perf_counter() - start
+            tracing.mark('connected')
+
+    def connect(self):
+        if not tracing.enabled() or not self.is_https:
+            return super().connect()
+        start = time.perf_counter()
+        self._setup = 0.0
+        super().connect()
+        end = time.perf_counter()
+        tracing.record('tls', start + self._setup, end)
+        tracing.mark('connected')
+
+
+class _HTTPConnection(_DeadlineConnection, _TracedConnection,
+                      urllib3.connection.HTTPConnection):
+    is_https = False
+
+
+class _HTTPSConnection(_DeadlineConnection, _TracedConnection,
+                       urllib3.connection.HTTPSConnection):
+    is_https = True
+
+
+class _HTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _Adapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _HTTPConnectionPool,
+            'https': _HTTPSConnectionPool
+        }
+
+
+class _Paced:
+    # Draws each chunk from the shared bandwidth bucket, stops sending the
+    # body as soon as the job's deadline has passed and notes when the last
+    # byte went out.
+
+    def __init__(self, body, bucket=None) -> None:
+        self.body = body
+        self.bucket = bucket
+        self.size = body.size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.body:
+            if self.bucket is not None:
+                self.bucket.consume(len(chunk))
+            check_deadline()
+            yield chunk
+        tracing.mark('sent')
+
+
+class HTTPTransport:
+
+    def __init__(self, pool_connections: int = 32, pool_maxsize: int = 8):
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'curl/7.81.0'
+        adapter = _Adapter(pool_connections=pool_connections,
+                           pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def _timeout() -> Optional[float]:
+        deadline = current_deadline()
+        return deadline.remaining() if deadline is not None else None
+
+    @staticmethod
+    def _raise(e: Exception):
+        deadline = current_deadline()
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(str(e)) from e
+        raise TransportError(e) from e
+
+    def get(self, url: str) -> bytes:
+        try:
+            return self.session.get(url, timeout=self._timeout()).content
+        except requests.RequestException as e:
+            self._raise(e)
+
+    def peek(self, url: str, size: int) -> tuple:
+        # The status, content type and first `size` bytes (at most) at
+        # `url`. They are asked for with a Range header, and a server that
+        # ignores it is cut off after `size` bytes.
+        try:
+            with self.session.get(url,
+                                  headers={'Range': f'bytes=0-{size - 1}'},
+                                  stream=True,
+                                  timeout=self._timeout()) as r:
+                body = b''
+                for chunk in r.iter_content(min(size, CHUNK_SIZE)):
+                    body += chunk
+                    if len(body) >= size:
+                        break
+                return (r.status_code, r.headers.get('Content-Type', ''),
+                        body[:size])
+        except requests.RequestException as e:
+            self._raise(e)
+
+    def upload(self,
+               url: str,
+               file: str,
+               method: str = 'POST',
+               field: Optional[str] = 'file',
+               fields: dict = None,
+               source=None,
+               bucket=None) -> bytes:
+        if method == 'PUT':
+            body = FileBody(file, source=source)
+            url = put_url(url, file)
+            headers = {}
+        else:
+            body = MultipartBody(field, file, fields, source)
+            headers = {'Content-Type': body.content_type}
+        # Bodies of unknown length (e.g. archives compressed on the fly) are
+        # passed as a plain iterator so they go out chunked.
+        if (current_deadline() is not None or bucket is not None
+                or tracing.enabled()):
+            body = _Paced(body, bucket)
+        data = body if body.size is not None else iter(body)
+        start = time.perf_counter()
+        try:
+            content = self.session.request(method,
+                                           url,
+                                           data=data,
+                                           headers=headers,
+                                           timeout=self._timeout()).content
+        except requests.RequestException as e:
+            self._raise(e)
+        if tracing.enabled():
+            # A reused connection has no setup of its own.
+            end = time.perf_counter()
+            connected = max(tracing.take_mark('connected') or start, start)
+            sent = tracing.take_mark('sent') or end
+            sent = sent if sent >= connected else end
+            tracing.record('send', connected, sent)
+            tracing.record('server', sent, end)
+        return content
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class CurlTransport:
+
+    @staticmethod
+    def run(cmd: list) -> bytes:
+        with tracing.span(cmd[0]):
+            return CurlTransport._run(cmd)
+
+    @staticmethod
+    def _run(cmd: list) -> bytes:
+        deadline = current_deadline()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        if deadline is not None:
+            deadline.on_expire(p.kill)
+        try:
+            stdout, _ = p.communicate(
+                timeout=deadline.remaining() if deadline else None)
+        except subprocess.TimeoutExpired as e:
+            p.kill()
+            p.communicate()
+            raise DeadlineExceeded(f'{cmd[0]} timed out') from e
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(f'{cmd[0]} timed out')
+        if p.returncode != 0:
+            raise TransportError(
+                subprocess.CalledProcessError(p.returncode, cmd, stdout))
+        return stdout
+
+    def get(self, url: str) -> bytes:
+        return self.run(['curl', '-s', url])
+
+    def upload(self,
+               url: str,
+               file: str,
+               method: str = 'POST',
+               field: Optional[str] = 'file',
+               fields: dict = None,
+               source=None,
+               bucket=None) -> bytes:
+        if method == 'PUT':
+            return self.run(['curl', '-sT', file, url])
+        cmd = ['curl', '-s']
+        for k, v in (fields or {}).items():
+            cmd += ['-F', f'{k}={v}']
+        return self.run(cmd + ['-F', f'{field}=@{file}', url])
+
+
+_transport = None
+_lock = threading.Lock()
+
+
+def get_transport(name: str = 'native'):
+    global _transport
+    if name == 'curl':
+        return CurlTransport()
+    with _lock:
+        if _transport is None:
+            _transport = HTTPTransport()
+    return _transport
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import concurrent.futures
+from pathlib import Path
+from typing import Mapping, Optional
+
+from pymirror import tracing
+from pymirror.deadline import Deadline, DeadlineExceeded
+from pymirror.helpers import load_data
+from pymirror.results import Results
+from pymirror.transport import TransportError, get_transport
+
+# Bytes downloaded per link.
+VERIFY_BYTES = 4096
+VERIFY_TIMEOUT = 20
+VERIFY_WORKERS = 16
+
+
+def head(file: str, size: int = VERIFY_BYTES) -> bytes:
+    with open(file, 'rb') as f:
+        return f.read(size)
+
+
+def _html(content_type: str, body: bytes) -> bool:
+    start = body.lstrip()[:15].lower()
+    return ('text/html' in content_type.lower()
+            or start.startswith((b'<!doctype html', b'<html')))
+
+
+def check(link: str,
+          expected: Optional[bytes],
+          size: int = VERIFY_BYTES) -> tuple:
+    # (status, error) for one link: `verified` when it serves the file,
+    # `reachable` when it answers with a page (e.g. a download page) or
+    # there is no local copy to compare with, else `broken`.
+    try:
+        status, content_type, body = get_transport().peek(link, size)
+    except (TransportError, DeadlineExceeded) as e:
+        return 'broken', str(e)
+    if status >= 400:
+        return 'broken', f'HTTP {status}'
+    if not body:
+        return 'broken', 'Empty response'
+    if expected is None:
+        return 'reachable', None
+    if body[:len(expected)] == expected:
+        return 'verified', None
+    if _html(content_type, body) and not _html('', expected):
+        return 'reachable', None
+    if expected.startswith(body):
+        return 'broken', 'Shorter than the file'
+    return 'broken', 'Does not match the file'
+
+
+def verify(results: Results,
+           files: dict = None,
+           workers: int = VERIFY_WORKERS,
+           size: int = VERIFY_BYTES,
+           data: Mapping = None) -> None:
+    # Checks every link in `results` at once and emits a result for each.
+    # `files` maps an input to the local file to compare its links with
+    # (`None` for none); by default the input itself, if it is a file.
+    # Links to known single-download hosts are not downloaded, as that
+    # would use them up; they are reported `unchecked`. Hosts whose entry
+    # does not say how long links last are checked.
+    data = load_data() if data is None else data
+    jobs = []
+    for file, links in results.links_by_file.items():
+        for link in links:
+            server = results.servers.get(link, '')
+            if server in data and data[server].single_download:
+                results.emit(file, server, 'unchecked', link,
+                             error='Single-download host')
+            else:
+                jobs.append((file, link))
+    if not jobs:
+        return
+    heads = {}
+    for file, _ in jobs:
+        if file not in heads:
+            local = file if files is None else files.get(file)
+            heads[file] = (head(local, size) if local is not None
+                           and Path(local).is_file() else None)
+
+    def job(file: str, link: str) -> tuple:
+        if results.cancelled.is_set():
+            return None, None
+        with tracing.span('verify', server=results.servers.get(link, '')), \
+                Deadline(VERIFY_TIMEOUT, 'verify') as deadline, \
+                results.cancelling(deadline.cancel):
+            checked = check(link, heads[file], size)
+        if results.cancelled.is_set():
+            return None, None
+        return checked
+
+    with concurrent.futures.ThreadPoolExecutor(min(workers,
+                                                   len(jobs))) as executor:
+        futures = {executor.submit(job, *j): j for j in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            file, link = futures[future]
+            status, error = future.result()
+            if status is not None:
+                results.emit(file, results.servers.get(link, ''), status,
+                             link, error=error)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+from pymirror import tracing
+from pymirror.deadline import check as check_deadline
+from pymirror.deadline import current as current_deadline
+from pymirror.helpers import logger
+
+TIMEOUT = 30
+POLL = 0.5
+
+
+class WaitStats:
+    # How long each labelled wait took, to see where a browser flow spends
+    # its time.
+
+    def __init__(self) -> None:
+        self.waits = {}
+        self._lock = threading.Lock()
+
+    def record(self, label: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.waits.setdefault(label, []).append((seconds, ok))
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                label: {
+                    'count': len(waits),
+                    'total': sum(s for s, _ in waits),
+                    'max': max(s for s, _ in waits),
+                    'timeouts': sum(1 for _, ok in waits if not ok)
+                }
+                for label, waits in self.waits.items()
+            }
+
+
+stats = WaitStats()
+
+
+def until(driver,
+          condition: Callable[[Any], Any],
+          timeout: float = None,
+          label: str = 'wait',
+          poll: float = POLL,
+          strict: bool = True) -> Any:
+    # Waits until `condition(driver)` is truthy and returns its value. The
+    # wait never outlives the deadline of the current job. On timeout it
+    # raises `TimeoutException`, or returns `None` when not `strict`.
+    deadline = current_deadline()
+    if timeout is None:
+        timeout = TIMEOUT if deadline is None else deadline.remaining()
+    elif deadline is not None:
+        timeout = min(timeout, deadline.remaining())
+
+    def check(d) -> Any:
+        check_deadline()
+        return condition(d)
+
+    start = time.perf_counter()
+    ok = False
+    try:
+        wait = WebDriverWait(driver, timeout, poll_frequency=poll)
+        value = wait.until(check)
+        ok = True
+        return value
+    except TimeoutException:
+        # Running out of the job's time is reported as such.
+        check_deadline()
+        if strict:
+            raise
+        return None
+    finally:
+        end = time.perf_counter()
+        seconds = end - start
+        stats.record(label, seconds, ok)
+        tracing.record('page wait', start, end, wait=label)
+        logger.debug(f'Waited {seconds:.2f}s for {label}'
+                     f'{"" if ok else " (timed out)"}')
+
+
+def element(driver, by: str, value: str, **kwargs):
+    kwargs.setdefault('label', f'{by}={value}')
+    return until(driver, EC.presence_of_element_located((by, value)),
+                 **kwargs)
+
+
+def clickable(driver, by: str, value: str, **kwargs):
+    kwargs.setdefault('label', f'{by}={value} clickable')
+    return until(driver, EC.element_to_be_clickable((by, value)), **kwargs)
+
+
+def url_changes(driver, url: str, **kwargs) -> str:
+    kwargs.setdefault('label', f'url != {url}')
+    until(driver, EC.url_changes(url), **kwargs)
+    return driver.current_url
+
+
+def elements(driver,
+             by: str,
+             value: str,
+             count: int,
+             refresh: bool = False,
+             **kwargs) -> list:
+    # At least `count` matching elements; with `refresh`, the page is
+    # reloaded before every check. When not `strict`, whatever was found
+    # last is returned on timeout.
+    found = []
+
+    def condition(d) -> Optional[list]:
+        if refresh:
+            d.refresh()
+        found[:] = d.find_elements(by, value)
+        return list(found) if len(found) >= count else None
+
+    kwargs.setdefault('label', f'{count} x {by}={value}')
+    return until(driver, condition, **kwargs) or list(found)
+
+
+def attribute(driver, by: str, value: str, name: str, **kwargs) -> str:
+    kwargs.setdefault('label', f'{by}={value} @{name}')
+    return until(driver, lambda d: d.find_element(by, value).get_attribute(
+        name), **kwargs)
+
+
+def text(driver, by: str, value: str, **kwargs) -> str:
+    kwargs.setdefault('label', f'{by}={value} text')
+    return until(driver, lambda d: d.find_element(by, value).text, **kwargs)
+
+
+def report() -> None:
+    for label, s in sorted(stats.summary().items(),
+                           key=lambda x: -x[1]['total']):
+        logger.info(f'Waits for {label}: {s["count"]}x, {s["total"]:.1f}s '
+                    f'total, {s["max"]:.1f}s max, {s["timeouts"]} timed out')
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import asyncio
+import contextlib
+import time
+from pathlib import Path
+from typing import Mapping
+from urllib.parse import urlsplit
+
+from pymirror.api import options
+from pymirror.api_upload import APIUpload
+from pymirror.catalogue import Catalogue, file_hash
+from pymirror.cli import expand_inputs, fmt
+from pymirror.deadline import HostStats
+from pymirror.health import probe
+from pymirror.helpers import console, load_data, logger
+from pymirror.registry import registry
+from pymirror.results import Result, Results
+
+# Seconds between two checks of the same link, and between two passes.
+RECHECK = 6 * 3600
+EVERY = 3600
+# Links checked per batch, requests in flight, and per host.
+BATCH = 5000
+CONCURRENCY = 256
+HOST_CONCURRENCY = 4
+# Requests per second to one host.
+HOST_RATE = 5
+CHECK_TIMEOUT = 15
+# A link is dead on a 404 or 410, or after this many failed checks in a
+# row (timeouts, 5xx, refused connections).
+DEAD_AFTER = 3
+WANT = 3
+
+
+class HostLimiter:
+    # At most `concurrency` requests at once and `rate` per second to each
+    # host, however many links of it are due. Each pass runs on a new event
+    # loop, and a semaphore only works on the loop it was first used on, so
+    # they are made again for every loop; the rate carries over, since loop
+    # time is monotonic time.
+
+    def __init__(self,
+                 concurrency: int = HOST_CONCURRENCY,
+                 rate: float = HOST_RATE) -> None:
+        self.concurrency = concurrency
+        self.rate = rate
+        self._loop = None
+        self._slots = {}
+        self._next = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._slots = loop, {}
+        if host not in self._slots:
+            self._slots[host] = asyncio.Semaphore(self.concurrency)
+        async with self._slots[host]:
+            now = loop.time()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + 1 / self.rate
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+def classify(status: int, error: str, failures: int) -> tuple:
+    # (status, failures, error) to record for one check.
+    if status is not None and status < 400:
+        return 'live', 0, None
+    if status in (404, 410):
+        return 'dead', failures + 1, f'HTTP {status}'
+    failures += 1
+    return ('dead' if failures >= DEAD_AFTER else 'unknown', failures,
+            error or f'HTTP {status}')
+
+
+def durability(entry) -> float:
+    # Hosts that keep files longest get the replacements first.
+    return float('inf') if entry.expires is None else entry.expires
+
+
+class Watchdog:
+    # Keeps at least `want` live links to every watched file: checks the
+    # links the catalogue has for them in large batches of cheap requests
+    # (a 1-byte ranged GET whose body is never read), then uploads
+    # replacements for the files that fell short.
+
+    def __init__(self,
+                 catalogue: Catalogue,
+                 args: argparse.Namespace = None,
+                 data: Mapping = None,
+                 recheck: float = RECHECK,
+                 limiter: HostLimiter = None) -> None:
+        self.catalogue = catalogue
+        self.args = args or options()
+        self.data = registry(data or load_data())
+        self.recheck = recheck
+        self.limiter = limiter or HostLimiter()
+        self.stats = HostStats()
+
+    async def _check(self, row: tuple, slots: asyncio.Semaphore) -> tuple:
+        server, link, failures = row
+        async with slots, self.limiter.slot(urlsplit(link).netloc):
+            result = await probe(server,
+                                 link,
+                                 CHECK_TIMEOUT,
+                                 method='GET',
+                                 headers={'Range': 'bytes=0-0'})
+        return (link, ) + classify(result['status'], result['error'],
+                                   failures)
+
+    async def check(self) -> dict:
+        # Checks every link that is due, a batch at a time, and returns how
+        # many ended up in each state.
+        counts = {'live': 0, 'dead': 0, 'unknown': 0}
+        slots = asyncio.Semaphore(CONCURRENCY)
+        now = time.time()
+        while True:
+            rows = self.catalogue.due(now - self.recheck, BATCH)
+            if not rows:
+                break
+            checks = await asyncio.gather(
+                *[self._check(row, slots) for row in rows])
+            self.catalogue.mark(checks)
+            for _, status, _, _ in checks:
+                counts[status] += 1
+            for link, status, _, error in checks:
+                if status == 'dead':
+                    logger.info(f'Dead link: {link} ({error})')
+            if len(rows) < BATCH:
+                break
+        return counts
+
+    def remirror(self, results: Results) -> None:
+        # Uploads the files short of live links to as many hosts as they
+        # are short, preferring the hosts that keep files longest.
+        for digest, path, want in self.catalogue.watched():
+            live = self.catalogue.links(digest)
+            missing = want - len(live)
+            if missing <= 0:
+                continue
+            if not Path(path).is_file() or (self.catalogue.fingerprint(path)
+                                            or file_hash(path)) != digest:
+                logger.warning(f'{path} is gone or has changed; its links '
+                               'cannot be replaced')
+                results.emit(path, 'watchdog', 'error',
+                             error='The file is gone or has changed')
+                continue
+            api = APIUpload(self.data, self.args)
+            # Links to single-download hosts are never kept, so they could
+            # never count towards `want`.
+            candidates = [
+                k for k in api.eligible_servers(path)
+                if k not in live and self.data[k].expires != 0
+            ]
+            candidates.sort(key=lambda k: -durability(self.data[k]))
+            if not candidates:
+                continue
+            links = APIUpload(self.data.subset(candidates[:missing]),
+                              self.args,
+                              self.catalogue,
+                              stats=self.stats,
+                              results=results).api_uploads(files=[path])
+            # A link that was just made is not due before `recheck`.
+            self.catalogue.mark([(link, 'live', 0, None)
+                                 for link in links or []])
+
+    def run_once(self, results: Results) -> dict:
+        counts = asyncio.run(self.check())
+        self.remirror(results)
+        return counts
+
+
+def watch_main(argv: list) -> None:
+    parser_ = argparse.ArgumentParser(prog='pymirror watch',
+                                      formatter_class=fmt)
+    parser_.add_argument('-a',
+                         '--add',
+                         help='Watch these files (paths, glob patterns or '
+                         '@file_list.txt)',
+                         nargs='+')
+    parser_.add_argument('-n',
+                         '--number',
+                         help='Live links to keep per file (default: '
+                         f'{WANT})',
+                         type=int,
+                         default=WANT)
+    parser_.add_argument('--remove',
+                         help='Stop watching these files',
+                         nargs='+')
+    parser_.add_argument('--list',
+                         help='Show the watched files and their live links',
+                         action='store_true')
+    parser_.add_argument('--once',
+                         help='Check and re-mirror once, then exit (e.g. '
+                         'from cron)',
+                         action='store_true')
+    parser_.add_argument('--every',
+                         help='Minutes between two passes (default: '
+                         f'{EVERY // 60})',
+                         type=float,
+                         default=EVERY / 60)
+    parser_.add_argument('--recheck',
+                         help='Hours before a link is checked again '
+                         f'(default: {RECHECK // 3600})',
+                         type=float,
+                         default=RECHECK / 3600)
+    parser_.add_argument('-b',
+                         '--max-bandwidth',
+                         help='Upper limit for the upload rate of '
+                         'replacements in MB/s (default: the measured '
+                         'upload speed)',
+                         type=float)
+    args = parser_.parse_args(argv)
+    catalogue = Catalogue()
+    try:
+        if args.add or args.remove:
+            for path in expand_inputs(args.add or []):
+                digest = catalogue.fingerprint(path) or file_hash(path)
+                catalogue.remember(path, digest)
+                catalogue.watch(digest, path, args.number)
+                console.print(f'Watching {path} ({args.number} links)')
+            for path in expand_inputs(args.remove or []):
+                catalogue.unwatch(path)
+                console.print(f'Stopped watching {path}')
+            return
+        if args.list:
+            for digest, path, want in catalogue.watched():
+                live = catalogue.links(digest)
+                console.print(f'{path}: {len(live)}/{want} live')
+                for server, link in live.items():
+                    console.print(f'  {server}: {link}')
+            return
+        watchdog = Watchdog(catalogue,
+                            options(max_bandwidth=args.max_bandwidth),
+                            recheck=args.recheck * 3600)
+
+        def show(result: Result) -> None:
+            if result.status == 'ok':
+                console.print(f'Replacement for {Path(result.input).name}:',
+                              result.link)
+
+        while True:
+            counts = watchdog.run_once(Results(show))
+            console.print(f'Checked {sum(counts.values())} links: '
+                          f'{counts["live"]} live, {counts["dead"]} dead, '
+                          f'{counts["unknown"]} unreachable')
+            if args.once:
+                return
+            time.sleep(args.every * 60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        catalogue.close()